@@ -22,10 +22,18 @@
 
 """ Detects installed OSes """
 
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import math
+import mmap
 import os
 import subprocess
 import re
 import tempfile
+import threading
+
+import parted3.fs_module as fs
+import parted3.mount_table as mount_table
 
 # constants
 WIN_DIRS = ["windows", "Windows", "WINDOWS"]
@@ -36,16 +44,58 @@ SECEVENT_NAMES = ["SecEvent.Evt", "secevent.evt"]
 DOS_NAMES = ["IO.SYS", "io.sys"]
 LINUX_NAMES = ["issue", "slackware_version"]
 
+# Windows stores these as UTF-16 (that's what the dots are for)
 VISTA_MARK = "W.i.n.d.o.w.s. .V.i.s.t.a"
 SEVEN_MARK = "W.i.n.d.o.w.s. .7"
 DOS_MARKS = ["MS-DOS", "MS-DOS 6.22", "MS-DOS 6.21", "MS-DOS 6.0",
              "MS-DOS 5.0", "MS-DOS 4.01", "MS-DOS 3.3", "Windows 98",
              "Windows 95"]
 
+# Partitions we look into (sda1, hda1, vda1, xvda1, nvme0n1p1, mmcblk0p1)
+PARTITION_RE = re.compile(r'^((s|h|v|xv)d[a-z]+\d+|nvme\d+n\d+p\d+|mmcblk\d+p\d+)$')
+
+# Filesystems where no OS can be found
+SKIP_FS_TYPES = ['', 'swap', 'crypto_LUKS', 'LVM2_member', 'linux_raid_member']
+
+# Mount options that do not write anything (not even a journal replay)
+RO_MOUNT_OPTIONS = {'ext3': 'ro,noload',
+                    'ext4': 'ro,noload',
+                    'xfs': 'ro,norecovery'}
+
+# How many partitions we look into at the same time
+MAX_WORKERS = 4
+
+# Seconds we give each partition (get_os_dict waits for all of them as if
+# they were probed MAX_WORKERS at a time)
+DEVICE_TIMEOUT = 30
+
+# Our temporary mount directories are named like this
+TMP_PREFIX = "thus-os-"
+
+# Detected OSes by filesystem UUID (only partitions we could look into)
+_cache = {}
+_cache_lock = threading.Lock()
+
 if __name__ == '__main__':
     import gettext
     _ = gettext.gettext
 
+def find_marks(path, marks, literal=False):
+    """ Returns the marks (regular expressions, unless literal) found in path's contents """
+    found = []
+    try:
+        with open(path, "rb") as system_file:
+            if os.fstat(system_file.fileno()).st_size == 0:
+                return found
+            with mmap.mmap(system_file.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                for mark in marks:
+                    pattern = re.escape(mark) if literal else mark
+                    if re.search(pattern.encode(), contents):
+                        found.append(mark)
+    except (IOError, OSError, ValueError) as err:
+        logging.warning(_("Can't read %s: %s"), path, err)
+    return found
+
 def get_os(mountname):
     """ Detect installed OSes """
     #  If partition is mounted, try to identify the Operating System
@@ -58,11 +108,11 @@ def get_os(mountname):
             for name in WINLOAD_NAMES:
                 path = os.path.join(mountname, windows, system, name)
                 if os.path.exists(path):
-                    with open(path, "rb") as system_file:
-                        if VISTA_MARK in system_file:
-                            detected_os = "Windows Vista"
-                        elif SEVEN_MARK in system_file:
-                            detected_os = "Windows 7"
+                    found = find_marks(path, [VISTA_MARK, SEVEN_MARK])
+                    if VISTA_MARK in found:
+                        detected_os = "Windows Vista"
+                    elif SEVEN_MARK in found:
+                        detected_os = "Windows 7"
             if detected_os == _("unknown"):
                 for name in SECEVENT_NAMES:
                     path = os.path.join(mountname, windows, system, "config", name)
@@ -77,10 +127,10 @@ def get_os(mountname):
     for name in DOS_NAMES:
         path = os.path.join(mountname, name)
         if os.path.exists(path):
-            with open(path, "rb") as system_file:
-                for mark in DOS_MARKS:
-                    if mark in system_file:
-                        detected_os = mark
+            found = find_marks(path, DOS_MARKS, literal=True)
+            if found:
+                # The last (most specific) one wins
+                detected_os = found[-1]
     # Linuxes
 
     if detected_os == _("unknown"):
@@ -98,28 +148,121 @@ def get_os(mountname):
 
     return detected_os
 
+def get_partitions():
+    """ Returns the partitions listed in /proc/partitions we can look into """
+    partitions = []
+    with open("/proc/partitions", 'r') as partitions_file:
+        for line in partitions_file:
+            line_split = line.split()
+            if len(line_split) == 4 and PARTITION_RE.match(line_split[3]):
+                partitions.append("/dev/" + line_split[3])
+    return partitions
+
+def mount_read_only(device, fs_type, mount_dir):
+    """ Mounts device in mount_dir without writing anything. noload and norecovery are refused
+        if device is already mounted (read-write) somewhere else, then a plain ro mount is tried.
+        Returns False if it can't be mounted """
+    options = [RO_MOUNT_OPTIONS.get(fs_type, 'ro')]
+    if options[0] != 'ro':
+        options.append('ro')
+    for option in options:
+        try:
+            subprocess.check_call(["mount", "-o", option, device, mount_dir],
+                                  stderr=subprocess.DEVNULL, timeout=DEVICE_TIMEOUT)
+            return True
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+            logging.debug("Can't mount %s (-o %s) to look for an OS: %s", device, option, err)
+    return False
+
+def probe_partition(device, fs_type, mount_point=None):
+    """ Mounts device (read only) in its own temporary directory and looks for an OS there.
+        If it is already mounted (mount_point), we look there. Returns None if we can't look into it """
+    if mount_point is not None:
+        return get_os(mount_point)
+
+    detected_os = None
+    tmp_dir = tempfile.mkdtemp(prefix=TMP_PREFIX)
+    try:
+        if not mount_read_only(device, fs_type, tmp_dir):
+            return detected_os
+        try:
+            detected_os = get_os(tmp_dir)
+        finally:
+            if subprocess.call(["umount", tmp_dir], stderr=subprocess.DEVNULL) != 0:
+                subprocess.call(["umount", "-l", tmp_dir], stderr=subprocess.DEVNULL)
+    finally:
+        try:
+            os.rmdir(tmp_dir)
+        except OSError as err:
+            logging.warning(err)
+    return detected_os
+
+def detect(device, fs_type, uuid, mount_point=None):
+    """ Returns the OS installed in device. Results are cached by filesystem UUID,
+        partitions we could not mount are tried again next time """
+    if uuid:
+        with _cache_lock:
+            if uuid in _cache:
+                return _cache[uuid]
+    detected_os = probe_partition(device, fs_type, mount_point)
+    if detected_os is None:
+        return _("unknown")
+    if uuid:
+        with _cache_lock:
+            _cache[uuid] = detected_os
+    return detected_os
+
+def clean_up(device):
+    """ Unmounts and removes the temporary directories where device is still mounted
+        (its probe has been running for too long) """
+    tmp_prefix = os.path.join(tempfile.gettempdir(), TMP_PREFIX)
+    for mount in mount_table.MountTable().get_by_source(device):
+        if mount.mount_point.startswith(tmp_prefix):
+            logging.debug("Unmounting %s from %s", device, mount.mount_point)
+            subprocess.call(["umount", "-l", mount.mount_point], stderr=subprocess.DEVNULL)
+            try:
+                os.rmdir(mount.mount_point)
+            except OSError as err:
+                logging.warning(err)
+
 def get_os_dict():
-    """ Returns all detected OSes in a dict """
+    """ Returns all detected OSes in a dict. Partitions are probed at the same time """
     oses = {}
 
-    tmp_dir = tempfile.mkdtemp()
+    partitions = get_partitions()
+    mounts = mount_table.MountTable()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    futures = {}
+    for device in partitions:
+        info = fs.get_info(device)
+        fs_type = info.get('TYPE', '')
+        if fs_type in SKIP_FS_TYPES:
+            oses[device] = _("unknown")
+            continue
+        # Partitions that are already mounted are not mounted again
+        mounted = mounts.get_by_source(device)
+        mount_point = mounted[0].mount_point if mounted else None
+        futures[device] = executor.submit(detect, device, fs_type, info.get('UUID'), mount_point)
 
-    with open("/proc/partitions", 'r') as partitions_file:
-        for line in partitions_file:
-            line_split = line.split()
-            if len(line_split) > 0:
-                device = line_split[3]
-                if "sd" in device and re.search(r'\d+$', device):
-                    # ok, it has sd and ends with a number
-                    device = "/dev/" + device
-                    try:
-                        subprocess.call(["mount", device, tmp_dir], stderr=subprocess.DEVNULL)
-                        oses[device] = get_os(tmp_dir)
-                        subprocess.call(["umount", "-l", tmp_dir], stderr=subprocess.DEVNULL)
-                    except AttributeError:
-                        subprocess.call(["mount", device, tmp_dir])
-                        oses[device] = get_os(tmp_dir)
-                        subprocess.call(["umount", "-l", tmp_dir])
+    # One deadline for all of them, partitions wait their turn in our pool
+    timeout = DEVICE_TIMEOUT * math.ceil(len(futures) / MAX_WORKERS)
+    wait(futures.values(), timeout=timeout)
+
+    for device in futures:
+        future = futures[device]
+        if not future.done():
+            logging.warning(_("Looking for an OS in %s is taking too long, skipping it"), device)
+            # It can't be stopped, but we do not leave it mounted when it finishes
+            future.add_done_callback(lambda future, device=device: clean_up(device))
+            oses[device] = _("unknown")
+        elif future.exception() is not None:
+            logging.warning(_("Can't look for an OS in %s: %s"), device, future.exception())
+            oses[device] = _("unknown")
+        else:
+            oses[device] = future.result()
+
+    # Do not wait for partitions that are taking too long
+    executor.shutdown(wait=False)
     return oses
 
 if __name__ == '__main__':
@@ -28,7 +28,9 @@ import shutil
 import subprocess
 import syslog
 import socket
+import threading
 import canonical.osextras as osextras
+import parted3.mount_table as mount_table
 import logging
 
 def copytree(src, dst, symlinks=False, ignore=None):
@@ -59,6 +61,8 @@ def is_swap(device):
     return False
 
 _dropped_privileges = 0
+# Effective ids are shared by all our threads, so is our privileges counter
+_privileges_lock = threading.RLock()
 
 def set_groups_for_uid(uid):
     if uid == os.geteuid() or uid == os.getuid():
@@ -93,29 +97,31 @@ def drop_all_privileges():
 
 def drop_privileges():
     global _dropped_privileges
-    assert _dropped_privileges is not None
-    if _dropped_privileges == 0:
-        uid = os.environ.get('SUDO_UID')
-        gid = os.environ.get('SUDO_GID')
-        if uid is not None:
-            uid = int(uid)
-            set_groups_for_uid(uid)
-        if gid is not None:
-            gid = int(gid)
-            os.setegid(gid)
-        if uid is not None:
-            os.seteuid(uid)
-    _dropped_privileges += 1
+    with _privileges_lock:
+        assert _dropped_privileges is not None
+        if _dropped_privileges == 0:
+            uid = os.environ.get('SUDO_UID')
+            gid = os.environ.get('SUDO_GID')
+            if uid is not None:
+                uid = int(uid)
+                set_groups_for_uid(uid)
+            if gid is not None:
+                gid = int(gid)
+                os.setegid(gid)
+            if uid is not None:
+                os.seteuid(uid)
+        _dropped_privileges += 1
 
 
 def regain_privileges():
     global _dropped_privileges
-    assert _dropped_privileges is not None
-    _dropped_privileges -= 1
-    if _dropped_privileges == 0:
-        os.seteuid(0)
-        os.setegid(0)
-        os.setgroups([])
+    with _privileges_lock:
+        assert _dropped_privileges is not None
+        _dropped_privileges -= 1
+        if _dropped_privileges == 0:
+            os.seteuid(0)
+            os.setegid(0)
+            os.setgroups([])
 
 
 def drop_privileges_save():
@@ -165,6 +171,14 @@ def raise_privileges(func):
     return helper
 
 
+def run_privileged(func, *args):
+    """ Runs func(*args) with raised privileges. Effective ids are shared by all the threads
+        of a process, so this is meant to be run in a child process (i.e. by a
+        ProcessPoolExecutor), never in a worker thread of our UI """
+    with raised_privileges():
+        return func(*args)
+
+
 @raise_privileges
 def grub_options():
     """ Generates a list of suitable targets for grub-installer
@@ -243,61 +257,22 @@ def boot_device():
 
 
 def is_removable(device):
+    """ Returns the path of the disk where device is if it's removable (None otherwise) """
     if device is None:
         return None
-    device = os.path.realpath(device)
-    devpath = None
-    is_partition = False
-    removable_bus = False
-    subp = subprocess.Popen(['udevadm', 'info', '-q', 'property',
-                             '-n', device],
-                            stdout=subprocess.PIPE, universal_newlines=True)
-    for line in subp.communicate()[0].splitlines():
-        line = line.strip()
-        if line.startswith('DEVPATH='):
-            devpath = line[8:]
-        elif line == 'DEVTYPE=partition':
-            is_partition = True
-        elif line == 'ID_BUS=usb' or line == 'ID_BUS=ieee1394':
-            removable_bus = True
-
-    if devpath is not None:
-        if is_partition:
-            devpath = os.path.dirname(devpath)
-        is_removable = removable_bus
-        try:
-            with open('/sys%s/removable' % devpath) as removable:
-                if removable.readline().strip() != '0':
-                    is_removable = True
-        except IOError:
-            pass
-        if is_removable:
-            try:
-                subp = subprocess.Popen(['udevadm', 'info', '-q', 'name',
-                                         '-p', devpath],
-                                        stdout=subprocess.PIPE,
-                                        universal_newlines=True)
-                return ('/dev/%s' %
-                        subp.communicate()[0].splitlines()[0].strip())
-            except Exception:
-                pass
-
+    import parted3.device_graph as device_graph
+    disk = device_graph.get_graph().disk_of(device)
+    if disk is not None and disk.removable:
+        return disk.path
     return None
 
 
 def mount_info(path):
     """Return filesystem name, type, and ro/rw for a given mountpoint."""
-    fsname = ''
-    fstype = ''
-    writable = ''
-    with open('/proc/mounts') as fp:
-        for line in fp:
-            line = line.split()
-            if line[1] == path:
-                fsname = line[0]
-                fstype = line[2]
-                writable = line[3].split(',')[0]
-    return fsname, fstype, writable
+    mount = mount_table.MountTable().get(path)
+    if mount is None:
+        return '', '', ''
+    return mount.source, mount.fs_type, mount.options.split(',')[0]
 
 
 def udevadm_info(args):
@@ -403,11 +378,6 @@ def grub_default(boot=None):
     return target
 
 
-_os_prober_oslist = {}
-_os_prober_osvers = {}
-_os_prober_called = False
-
-
 def find_in_os_prober(device, with_version=False):
     """Look for the device name in the output of os-prober.
 
@@ -438,30 +408,24 @@ def find_in_os_prober(device, with_version=False):
     return ''
 
 
-@raise_privileges
-def os_prober():
-    global _os_prober_oslist
-    global _os_prober_osvers
-    global _os_prober_called
-
-    if not _os_prober_called:
-        _os_prober_called = True
-        subp = subprocess.Popen(
-            ['os-prober'], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True)
-        result = subp.communicate()[0].splitlines()
-        for res in result:
-            res = res.split(':')
-            if res[2] == 'Ubuntu':
-                version = [v for v in re.findall('[0-9.]*', res[1]) if v][0]
-                # Get rid of the superfluous (development version) (11.04)
-                text = re.sub('\s*\(.*\).*', '', res[1])
-                _os_prober_oslist[res[0]] = text
-                _os_prober_osvers[res[0]] = version
-            else:
-                # Get rid of the bootloader indication. It's not relevant here.
-                _os_prober_oslist[res[0]] = res[1].replace(' (loader)', '')
-    return _os_prober_oslist, _os_prober_osvers
+def os_prober(run_probe=None):
+    """ Returns os-prober results as ({device: name}, {device: version}).
+        os-prober is only run once (by run_probe), see os_prober_cache """
+    import os_prober_cache
+
+    oslist = {}
+    osvers = {}
+    for entry in os_prober_cache.get_entries(run_probe):
+        if entry.short_name == 'Ubuntu':
+            version = [v for v in re.findall('[0-9.]*', entry.long_name) if v][0]
+            # Get rid of the superfluous (development version) (11.04)
+            text = re.sub('\s*\(.*\).*', '', entry.long_name)
+            oslist[entry.device] = text
+            osvers[entry.device] = version
+        else:
+            # Get rid of the bootloader indication. It's not relevant here.
+            oslist[entry.device] = entry.long_name.replace(' (loader)', '')
+    return oslist, osvers
 
 
 @raise_privileges
@@ -27,11 +27,11 @@
 """ Check screen (detects if Manjaros prerequisites are meet) """
 
 from gi.repository import Gtk, GObject
-import subprocess
 import os
 import logging
 import canonical.gtkwidgets as gtkwidgets
 import canonical.misc as misc
+import probes
 
 from rank_mirrors import AutoRankmirrorsThread
 
@@ -54,6 +54,7 @@ class Check(Gtk.Box):
         self.forward_button = params['forward_button']
         self.backwards_button = params['backwards_button']
         self.testing = params['testing']
+        self.probes = params['probes']
 
         super().__init__()
 
@@ -142,18 +143,13 @@ class Check(Gtk.Box):
         return False
 
     def has_enough_space(self):
-        lsblk = subprocess.Popen(["lsblk", "-lnb"], stdout=subprocess.PIPE)
-        output = lsblk.communicate()[0].decode("utf-8").split("\n")
+        graph = self.probes.get(probes.GRAPH)
 
         max_size = 0
 
-        for item in output:
-            col = item.split()
-            if len(col) >= 5:
-                if col[5] == "disk" or col[5] == "part":
-                    size = int(col[3])
-                    if size > max_size:
-                        max_size = size
+        for disk in graph.disks():
+            if disk.size > max_size:
+                max_size = disk.size
         # we need 5GB
         # 5000000000
         if max_size >= MIN_ROOT_SIZE:
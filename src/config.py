@@ -26,18 +26,45 @@
 
 """ Configuration module for Thus """
 
-from multiprocessing import Queue
+import multiprocessing
+import pickle
+import struct
+
+# Size (in bytes) of the shared memory that holds our settings journal
+JOURNAL_SIZE = 1024 * 1024
+
+# Each journal record is its length followed by a pickled (key, value) tuple
+RECORD_HEADER = struct.Struct('I')
+
+# A record with this key holds all our settings (see _write_snapshot)
+SNAPSHOT_KEY = None
 
 
 class Settings(object):
-    """ Store all Thus setup options here """
+    """ Store all Thus setup options here
+
+        Settings are shared between Thus and its installation process.
+        Each process has its own copy of them, and every change is
+        appended to a journal in shared memory. Before reading, a process
+        applies the changes written by the others (if any). """
     def __init__(self):
         """ Initialize default configuration """
 
-        # Creates a one element size queue
-        self.settings = Queue(1)
+        self._lock = multiprocessing.Lock()
+        # Notified each time a setting changes (see wait_for)
+        self._changed = multiprocessing.Condition(self._lock)
+        self._journal = multiprocessing.RawArray('c', JOURNAL_SIZE)
+        # Journal length (in bytes)
+        self._journal_end = multiprocessing.RawValue('L', 0)
+        # Incremented each time the journal is rewritten from the beginning
+        self._generation = multiprocessing.RawValue('L', 0)
 
-        self.settings.put({
+        # Our local copy and how far we have read the journal
+        self._settings = {}
+        self._offset = 0
+        self._local_generation = 0
+
+        defaults = {
             'auto_device': '/dev/sda',
 
             # In BIOS stores the disk (/dev/sdX) or the partition (/dev/sdXY)
@@ -52,6 +79,7 @@ class Settings(object):
             'desktops': [],
             'efi': False,
             'encrypt_home': False,
+            'f2fs': False,
             'feature_bluetooth': False,
             'feature_cups': False,
             'feature_office': False,
@@ -87,36 +115,94 @@ class Settings(object):
             'tmp': '/tmp',
             'thus': '/usr/share/thus/',
             'ui': '/usr/share/thus/ui/',
+            'use_f2fs': False,
             'use_home': False,
             'use_luks': False,
             'use_lvm': False,
             'use_ntp': True,
             'user_info_done': False,
             'username': '',
-            'z_hidden' : False})
-
-    def _get_settings(self):
-        """ Get a copy of our settings """
-        global_settings = self.settings.get()
-        copy = global_settings.copy()
-        self.settings.put(global_settings)
-        return copy
-
-    def _update_settings(self, new_settings):
-        """ Updates global settings """
-        global_settings = self.settings.get()
-        try:
-            global_settings.update(new_settings)
-        finally:
-            self.settings.put(global_settings)
+            'z_hidden' : False}
+
+        with self._lock:
+            self._write_snapshot(defaults)
+
+    def _is_outdated(self):
+        """ Tells if other processes have changed our settings (it does not need the lock) """
+        return self._offset != self._journal_end.value or \
+            self._local_generation != self._generation.value
+
+    def _sync(self):
+        """ Apply changes written by other processes. Lock must be held """
+        if self._local_generation != self._generation.value:
+            self._local_generation = self._generation.value
+            self._offset = 0
+
+        end = self._journal_end.value
+        while self._offset < end:
+            (length,) = RECORD_HEADER.unpack_from(self._journal, self._offset)
+            start = self._offset + RECORD_HEADER.size
+            key, value = pickle.loads(self._journal[start:start + length])
+            if key is SNAPSHOT_KEY:
+                self._settings = value
+            else:
+                self._settings[key] = value
+            self._offset = start + length
+
+    def _write_record(self, offset, key, value):
+        """ Writes a record in our journal. Returns where it ends """
+        data = pickle.dumps((key, value))
+        end = offset + RECORD_HEADER.size + len(data)
+        if end > JOURNAL_SIZE:
+            return None
+        RECORD_HEADER.pack_into(self._journal, offset, len(data))
+        self._journal[offset + RECORD_HEADER.size:end] = data
+        return end
+
+    def _write_snapshot(self, settings):
+        """ Starts a new journal with all our settings in it. Lock must be held """
+        end = self._write_record(0, SNAPSHOT_KEY, settings)
+        if end is None:
+            raise MemoryError("Settings do not fit in %d bytes" % JOURNAL_SIZE)
+        self._journal_end.value = end
+        self._generation.value += 1
+        self._settings = settings
+        self._offset = end
+        self._local_generation = self._generation.value
 
     def get(self, key):
         """ Get one setting value """
-        settings = self._get_settings()
-        return settings[key]
+        if self._is_outdated():
+            with self._lock:
+                self._sync()
+        return self._settings[key]
 
     def set(self, key, value):
         """ Set one setting's value """
-        settings = self._get_settings()
-        settings[key] = value
-        self._update_settings(settings)
+        with self._lock:
+            self._sync()
+            self._settings[key] = value
+            end = self._write_record(self._journal_end.value, key, value)
+            if end is None:
+                # Journal is full, start it again
+                self._write_snapshot(self._settings)
+            else:
+                self._journal_end.value = end
+                self._offset = end
+            self._changed.notify_all()
+
+    def wait_for(self, key, value, timeout=None):
+        """ Wait until setting 'key' is 'value' (it may be set by another process).
+            Returns False if timeout (in seconds) expires before that """
+        def is_set():
+            self._sync()
+            return self._settings[key] == value
+
+        with self._changed:
+            return self._changed.wait_for(is_set, timeout)
+
+    def snapshot(self):
+        """ Get a copy of all our settings """
+        with self._lock:
+            self._sync()
+            return self._settings.copy()
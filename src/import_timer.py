@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  import_timer.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Measures how long each module takes to import (see thus.py --profile-imports) """
+
+import sys
+import time
+import logging
+
+# How many modules we show in our report
+REPORT_LINES = 25
+
+_timer = None
+
+
+class _TimedLoader(object):
+    """ Wraps a module loader to measure how long the module takes to execute """
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        create_module = getattr(self._loader, 'create_module', None)
+        if create_module is None:
+            return None
+        return create_module(spec)
+
+    def exec_module(self, module):
+        self._timer.enter()
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer.leave(module.__name__, time.perf_counter() - start)
+
+
+class ImportTimer(object):
+    """ Meta path finder that times every module imported after it is installed.
+        Stores self and cumulative (self + imported modules) times per module """
+    def __init__(self):
+        self.start = time.perf_counter()
+        # module name: (self time, cumulative time)
+        self.times = {}
+        # Time spent by nested imports of the module being executed
+        self._children = []
+
+    def find_spec(self, fullname, path, target=None):
+        """ Let the other finders look for the module and wrap its loader """
+        spec = None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+
+        if spec is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self)
+        return spec
+
+    def enter(self):
+        self._children.append(0.0)
+
+    def leave(self, name, elapsed):
+        children = self._children.pop()
+        if self._children:
+            self._children[-1] += elapsed
+        self.times[name] = (elapsed - children, elapsed)
+
+    def total(self):
+        """ Time spent importing modules (nested imports are counted once) """
+        return sum(own for own, cumulative in self.times.values())
+
+    def report(self, lines=REPORT_LINES):
+        """ Returns our slowest modules, one line each """
+        rows = sorted(self.times.items(), key=lambda item: item[1][1], reverse=True)
+        report = ["%10s %10s  %s" % ("self (ms)", "cumul (ms)", "module")]
+        for name, (own, cumulative) in rows[:lines]:
+            report.append("%10.1f %10.1f  %s" % (own * 1000, cumulative * 1000, name))
+        return report
+
+
+def install():
+    """ Start timing imports """
+    global _timer
+    if _timer is None:
+        _timer = ImportTimer()
+        sys.meta_path.insert(0, _timer)
+    return _timer
+
+
+def log_report(budget=None):
+    """ Writes our import report to the log. Complains if startup took longer than budget (in seconds) """
+    if _timer is None:
+        return
+
+    elapsed = time.perf_counter() - _timer.start
+    logging.info("Imported %d modules in %.3f seconds (startup took %.3f seconds)",
+                 len(_timer.times), _timer.total(), elapsed)
+    for line in _timer.report():
+        logging.info(line)
+
+    if budget is not None and elapsed > budget:
+        logging.error(_("Startup took %.3f seconds, which is over our budget of %.3f seconds"), elapsed, budget)
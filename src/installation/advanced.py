@@ -27,7 +27,8 @@
 """ Installation advanced module. Custom partition screen """
 import os.path
 
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 import os
 import logging
@@ -40,15 +41,24 @@ import canonical.gtkwidgets as gtkwidgets
 
 import parted3.partition_module as pm
 import parted3.fs_module as fs
+import parted3.fs_profiles as fs_profiles
 import parted3.lvm as lvm
+import parted3.mount_table as mount_table
 import parted3.used_space as used_space
+import parted3.device_wait as device_wait
 
-from installation import process as installation_process
 import show_message as show
+import probes
 
 _next_page = "user_info"
 _prev_page = "installation_ask"
 
+# How many partitions we probe at the same time
+PROBE_WORKERS = 4
+
+# Shown in the used column until we know how much space is used
+PROBE_PENDING = "…"
+
 class InstallationAdvanced(Gtk.Box):
     """ Installation advanced class. Custom partitioning. """
     def __init__(self, params):
@@ -61,6 +71,7 @@ class InstallationAdvanced(Gtk.Box):
         self.settings = params['settings']
         self.alternate_package_list = params['alternate_package_list']
         self.testing = params['testing']
+        self.probes = params['probes']
 
         self.lv_partitions = []
         self.disks_changed = []
@@ -74,11 +85,23 @@ class InstallationAdvanced(Gtk.Box):
         # format is tuple (label, mountpoint, fs(text), Format)
         # see its usage in listing, creating, and deleting partitions
         self.stage_opts = {}
-        self.used_dic = {}
+
+        # Partitions' filesystem type, label and used space are probed in
+        # worker threads. Results are cached by (partition path, start sector, generation).
+        # Generation changes when we reload our devices, so old results are not used again
+        self.probe_executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS)
+        self.probe_futures = {}
+        self.probe_generation = 0
+        # Probes whose results have not been shown in our treeview yet
+        self.pending_probes = {}
 
         # hold deleted partitions that exist now
         self.to_be_deleted = []
 
+        # (partition, filesystem, mount point, label, mkfs options) of the filesystems
+        # that the installation process will create while it copies our system
+        self.deferred_mkfs = []
+
         # Call base class
         super().__init__()
 
@@ -218,7 +241,7 @@ class InstallationAdvanced(Gtk.Box):
             if path == _("free space"):
                 button_new.set_sensitive(True)
             else:
-                disks = pm.get_devices()
+                disks = self.disks
                 if (path not in disks and 'dev/mapper' not in path) or ('dev/mapper' in path and '-' in path):
                     # A partition is selected
                     for i in self.all_partitions:
@@ -245,7 +268,7 @@ class InstallationAdvanced(Gtk.Box):
 
         # Just call get_devices once
         if self.disks is None:
-            self.disks = pm.get_devices()
+            self.disks = self.probes.get(probes.DEVICES)
 
         for path in sorted(self.disks):
             (disk, result) = self.disks[path]
@@ -345,6 +368,8 @@ class InstallationAdvanced(Gtk.Box):
         """ Fill the partition list with all the data. """
         self.diskdic = {}
         self.all_partitions = []
+        # Results for the rows we are about to remove are not needed anymore
+        self.pending_probes = {}
         # We will store our data model in 'partition_list_store'
         if self.partition_list_store is not None:
             self.partition_list_store.clear()
@@ -371,14 +396,14 @@ class InstallationAdvanced(Gtk.Box):
 
         # Be sure to call get_devices once
         if self.disks is None:
-            self.disks = pm.get_devices()
+            self.disks = self.probes.get(probes.DEVICES)
         self.lv_partitions = []
         self.diskdic['mounts'] = []
-        vgs = lvm.get_volume_groups()
-        if vgs:
-            for vg in vgs:
+        volumes = self.probes.get(probes.LVM)
+        if volumes:
+            for vg in sorted(volumes):
                 is_ssd = False
-                lvs = lvm.get_logical_volumes(vg)
+                lvs = volumes[vg]
                 if not lvs:
                     continue
                 row = [vg, "", "", "", False, False, "", "", "", "", 0, False, False, False, False]
@@ -396,22 +421,10 @@ class InstallationAdvanced(Gtk.Box):
                     self.all_partitions.append(partition_path)
                     self.lv_partitions.append(partition_path)
                     uid = self.gen_partition_uid(path=partition_path)
-                    if fs.get_type(partition_path):
-                        fs_type = fs.get_type(partition_path)
-                    elif used_space.is_btrfs(partition_path):
-                        # kludge, btrfs not being detected...
-                        fs_type = 'btrfs'
-                    else:
-                        # Say unknown if we can't detect fs type instead of assumming btrfs
-                        fs_type = 'unknown'
 
                     if uid in self.stage_opts:
                         (is_new, label, mount_point, fs_type, fmt_active) = self.stage_opts[uid]
 
-                    info = fs.get_info(partition_path)
-                    if 'LABEL' in info:
-                        label = info['LABEL']
-
                     if mount_point:
                         self.diskdic['mounts'].append(mount_point)
 
@@ -422,10 +435,11 @@ class InstallationAdvanced(Gtk.Box):
                     row = [partition_path, fs_type, mount_point, label, fmt_active,
                            formatable, '', '', partition_path,
                            "", 0, fmt_enable, False, False, False]
-                    self.partition_list_store.append(lvparent, row)
+                    tree_iter = self.partition_list_store.append(lvparent, row)
+                    # Say unknown if we can't detect fs type instead of assumming btrfs
+                    self.submit_probe(tree_iter, partition_path, "", 0, unknown_type='unknown', is_lvm=True)
                     if self.my_first_time:
                         self.orig_part_dic[partition_path] = self.gen_partition_uid(path=partition_path)
-                        self.orig_label_dic[partition_path] = label
 
         # Here we fill our model
         for disk_path in sorted(self.disks):
@@ -437,7 +451,11 @@ class InstallationAdvanced(Gtk.Box):
             self.diskdic[disk_path]['has_extended'] = False
 
             if disk_path not in self.ssd:
-                self.ssd[disk_path] = fs.is_ssd(disk_path)
+                ssd = self.probes.get(probes.SSD)
+                if disk_path in ssd:
+                    self.ssd[disk_path] = ssd[disk_path]
+                else:
+                    self.ssd[disk_path] = fs.is_ssd(disk_path)
 
             is_ssd = self.ssd[disk_path]
 
@@ -485,17 +503,11 @@ class InstallationAdvanced(Gtk.Box):
                     if '/dev/mapper' in path:
                         continue
 
-                    # Get filesystem
+                    # Get filesystem (blkid will be asked later if parted does not know it)
                     if p.fileSystem and p.fileSystem.type:
                         fs_type = p.fileSystem.type
-                    # Check if its free space before trying to get the filesystem with blkid.
                     elif 'free' in partition_path:
                         fs_type = _("none")
-                    elif fs.get_type(path):
-                        fs_type = fs.get_type(path)
-                    else:
-                        # Unknown filesystem
-                        fs_type = '?'
 
                     # Nothing should be mounted at this point
 
@@ -515,30 +527,21 @@ class InstallationAdvanced(Gtk.Box):
                         # Get partition flags
                         flags = pm.get_flags(p)
 
+                    # Existing partitions are probed in the background
+                    must_probe = _("free space") not in path and p.type != pm.PARTITION_EXTENDED
+
                     uid = self.gen_partition_uid(p=p)
                     if uid in self.stage_opts:
                         (is_new, label, mount_point, fs_type, fmt_active) = self.stage_opts[uid]
                         fmt_enable = not is_new
                         if mount_point == "/":
                             fmt_enable = False
+                        if is_new:
+                            must_probe = False
                     else:
                         fmt_enable = True
-                        if _("free space") not in path:
-                            if self.my_first_time:
-                                if mount_point:
-                                    used = pm.get_used_space(p)
-                                else:
-                                    used = used_space.get_used_space(partition_path, fs_type) * p.geometry.length
-                                    used = self.get_size(used, dev.sectorSize)
-                                self.used_dic[(disk_path, p.geometry.start)] = used
-                            else:
-                                if (disk_path, p.geometry.start) in self.used_dic:
-                                    used = self.used_dic[(disk_path, p.geometry.start)]
-                                else:
-                                    used = '0b'
-                            info = fs.get_info(partition_path)
-                            if 'LABEL' in info:
-                                label = info['LABEL']
+                        if must_probe:
+                            used = PROBE_PENDING
 
                     if mount_point:
                         self.diskdic['mounts'].append(mount_point)
@@ -563,6 +566,12 @@ class InstallationAdvanced(Gtk.Box):
 
                     tree_iter = self.partition_list_store.append(parent, row)
 
+                    if must_probe:
+                        # Unknown filesystem
+                        self.submit_probe(tree_iter, partition_path, fs_type, p.geometry.start,
+                                          length=p.geometry.length, sector_size=dev.sectorSize,
+                                          unknown_type='?')
+
                     # If we're an extended partition, all the logical
                     # partitions that follow will be shown as children
                     # of this one
@@ -571,7 +580,8 @@ class InstallationAdvanced(Gtk.Box):
 
                     if self.my_first_time:
                         self.orig_part_dic[p.path] = self.gen_partition_uid(p)
-                        self.orig_label_dic[p.path] = label
+                        if not must_probe:
+                            self.orig_label_dic[p.path] = label
 
         self.my_first_time = False
 
@@ -583,6 +593,124 @@ class InstallationAdvanced(Gtk.Box):
         # so we can proceed with installation
         self.check_mount_points()
 
+        self.update_probe_spinner()
+
+    def probe_partition(self, partition_path, fs_type, length=None, is_lvm=False):
+        """ Gets partition's filesystem type, label and used sectors.
+            This runs in a worker thread, do not touch any widget here! """
+        info = fs.get_info(partition_path)
+        if not fs_type:
+            fs_type = info.get('TYPE', '')
+        if not fs_type and is_lvm and used_space.is_btrfs(partition_path):
+            # kludge, btrfs not being detected...
+            fs_type = 'btrfs'
+
+        result = {'fs_type': fs_type, 'label': info.get('LABEL', ''), 'used': None}
+        if length is not None:
+            result['used'] = used_space.get_used_space(partition_path, fs_type) * length
+        return result
+
+    def submit_probe(self, tree_iter, partition_path, fs_type, start, length=None,
+                     sector_size=None, unknown_type='?', is_lvm=False):
+        """ Probes a partition (if it's not in our cache) and shows its data in tree_iter's row
+            when it's ready """
+        key = (partition_path, start, self.probe_generation)
+        if key not in self.probe_futures:
+            future = self.probe_executor.submit(self.probe_partition, partition_path,
+                                                fs_type, length, is_lvm)
+            future.add_done_callback(lambda f: GLib.idle_add(self.on_probe_done, key))
+            self.probe_futures[key] = future
+
+        store = self.partition_list_store
+        row_ref = Gtk.TreeRowReference.new(store, store.get_path(tree_iter))
+        job = (row_ref, sector_size, unknown_type)
+
+        if self.probe_futures[key].done():
+            # Cached result, show it right away
+            self.apply_probe(job, self.probe_futures[key])
+        else:
+            self.pending_probes[key] = job
+
+    def on_probe_done(self, key):
+        """ A probe has finished (called from GTK main loop) """
+        job = self.pending_probes.pop(key, None)
+        if job is not None:
+            self.apply_probe(job, self.probe_futures[key])
+            self.update_probe_spinner()
+        return False
+
+    def wait_for_probes(self):
+        """ Shows all probe results, waiting for the ones still running """
+        for key in list(self.pending_probes):
+            self.apply_probe(self.pending_probes.pop(key), self.probe_futures[key])
+        self.update_probe_spinner()
+
+    def apply_probe(self, job, future):
+        """ Updates a partition row with its probe result """
+        (row_ref, sector_size, unknown_type) = job
+        if not row_ref.valid():
+            return
+
+        try:
+            result = future.result()
+        except Exception as err:
+            logging.warning(_("Can't probe partition: %s"), err)
+            result = {'fs_type': '', 'label': '', 'used': None}
+
+        row = self.partition_list_store[row_ref.get_path()]
+        partition_path = row[8]
+
+        if partition_path not in self.orig_label_dic:
+            self.orig_label_dic[partition_path] = result['label']
+
+        # Do not overwrite what the user has chosen
+        if self.gen_partition_uid(path=partition_path) in self.stage_opts:
+            return
+
+        fs_type = row[1] or result['fs_type'] or unknown_type
+        # Do not show swap version, only the 'swap' word
+        if 'swap' in fs_type:
+            fs_type = 'swap'
+        row[1] = fs_type
+        row[3] = result['label']
+        if sector_size is not None:
+            if result['used'] is None:
+                # The probe has failed, we do not know
+                row[7] = ""
+            else:
+                row[7] = self.get_size(result['used'], sector_size)
+
+    def update_probe_spinner(self):
+        """ Shows our spinner while there are partitions being probed """
+        spinner = self.ui.get_object('partition_recalculating_spinner')
+        if self.pending_probes:
+            spinner.show()
+            spinner.start()
+        else:
+            spinner.stop()
+            spinner.hide()
+
+    def update_row_from_stage_opts(self, tree_iter, uid):
+        """ Shows a partition's staged options in its row without reloading our partition list """
+        (is_new, label, mount_point, fs_type, fmt_active) = self.stage_opts[uid]
+        row = self.partition_list_store[tree_iter]
+
+        # Do not show swap version, only the 'swap' word
+        if 'swap' in fs_type:
+            fs_type = 'swap'
+
+        row[1] = fs_type
+        row[2] = mount_point
+        row[3] = label
+        row[4] = fmt_active
+        row[11] = not is_new and mount_point != "/"
+
+        if mount_point:
+            self.diskdic['mounts'].append(mount_point)
+
+        self.check_mount_points()
+        self.check_buttons(self.partition_list.get_selection())
+
     def on_format_cell_toggled(self, widget, path):
         """ Mark a partition to be formatted """
         # selected_path = Gtk.TreePath(path)
@@ -697,11 +825,10 @@ class InstallationAdvanced(Gtk.Box):
 
                 self.stage_opts[uid] = (is_new, mylabel, mymount, myfmt, fmtop)
 
-        self.edit_partition_dialog.hide()
+                # Only staged options have changed, there's no need to probe our disks again
+                self.update_row_from_stage_opts(tree_iter, uid)
 
-        # Update the partition list treeview
-        self.fill_partition_list()
-        self.fill_grub_device_entry()
+        self.edit_partition_dialog.hide()
 
     def get_disk_path_from_selection(self, model, tree_iter):
         """ This returns the disk path where the selected partition is in """
@@ -763,8 +890,6 @@ class InstallationAdvanced(Gtk.Box):
         partitions = pm.get_partitions(disk)
 
         part = partitions[partition_path]
-        if (disk.device.path, part.geometry.start) in self.used_dic:
-            del self.used_dic[(disk.device.path, part.geometry.start)]
 
         # Before delete the partition, check if it's already mounted
         if pm.check_mounted(part):
@@ -782,17 +907,11 @@ class InstallationAdvanced(Gtk.Box):
 
     def get_mount_point(self, partition_path):
         """ Get device mount point """
-        fsname = ''
-        fstype = ''
-        writable = ''
-        with open('/proc/mounts') as fp:
-            for line in fp:
-                line = line.split()
-                if line[0] == partition_path:
-                    fsname = line[1]
-                    fstype = line[2]
-                    writable = line[3].split(',')[0]
-        return fsname, fstype, writable
+        mounts = mount_table.MountTable().get_by_source(partition_path)
+        if not mounts:
+            return '', '', ''
+        mount = mounts[-1]
+        return mount.mount_point, mount.fs_type, mount.options.split(',')[0]
 
     def get_swap_partition(self, partition_path):
         """ Get active swap partition """
@@ -1057,6 +1176,12 @@ class InstallationAdvanced(Gtk.Box):
         self.disks = pm.get_devices()
         self.disks_changed = []
 
+        # Probe our partitions (and volume groups) again too
+        fs.refresh_info()
+        self.probes.refresh(probes.LVM)
+        self.probe_futures = {}
+        self.probe_generation += 1
+
         # Empty stage partitions' options
         self.stage_opts = {}
 
@@ -1243,8 +1368,7 @@ class InstallationAdvanced(Gtk.Box):
 
         #label = self.ui.get_object('part_advanced_recalculating_label')
         #label.hide()
-        spinner = self.ui.get_object('partition_recalculating_spinner')
-        spinner.hide()
+        self.update_probe_spinner()
 
         button = self.ui.get_object('partition_button_lvm')
         button.hide()
@@ -1419,6 +1543,13 @@ class InstallationAdvanced(Gtk.Box):
         # TODO: Check total system RAM in hardware module so we can require swap for low memory systems
         need_swap = False
 
+        # GRUB can't read compressed F2FS files, our kernels need their own /boot partition
+        root_f2fs = False
+        for (is_new, lbl, mnt, fs_name, fmt) in self.stage_opts.values():
+            if mnt == "/" and "f2fs" in fs_name:
+                root_f2fs = True
+        need_boot = self.lv_partitions or root_f2fs
+
         part = {}
         for check_part in check_parts:
             part[check_part] = self.ui.get_object(check_part + "_part")
@@ -1431,7 +1562,9 @@ class InstallationAdvanced(Gtk.Box):
 
         if is_uefi:
             part["boot_efi"].show()
-        elif self.lv_partitions and not is_uefi:
+            if root_f2fs:
+                part["boot"].show()
+        elif need_boot and not is_uefi:
             part["boot"].show()
         elif need_swap:
             part["swap"].show()
@@ -1454,7 +1587,7 @@ class InstallationAdvanced(Gtk.Box):
                 # Only fat partitions
                 has_part["boot_efi"] = True
                 part["boot_efi"].set_state(True)
-            if mnt == "/boot" and "f2fs" not in fs and "btrfs" not in fs and self.lv_partitions:
+            if mnt == "/boot" and "f2fs" not in fs and "btrfs" not in fs and need_boot:
                 has_part["boot"] = True
                 part["boot"].set_state(True)
             if mnt == "swap":
@@ -1463,7 +1596,9 @@ class InstallationAdvanced(Gtk.Box):
 
         if is_uefi:
             check_ok = has_part["root"] and has_part["boot_efi"]
-        elif self.lv_partitions and not is_uefi:
+            if root_f2fs:
+                check_ok = check_ok and has_part["boot"]
+        elif need_boot and not is_uefi:
             check_ok = has_part["root"] and has_part["boot"]
         else:
             check_ok = has_part["root"]
@@ -1475,6 +1610,8 @@ class InstallationAdvanced(Gtk.Box):
 
     def get_changes(self):
         """ Grab all changes for confirmation """
+        # We need all original labels
+        self.wait_for_probes()
         changelist = []
         # Store values as (path, create?, label?, format?)
         if self.lv_partitions:
@@ -1706,6 +1843,19 @@ class InstallationAdvanced(Gtk.Box):
         """ Tell which one is our next page """
         return _next_page
 
+    def wait_for_partitions(self, partitions):
+        """ Committing a partition table makes the kernel recreate the device nodes of its partitions.
+            Wait for the ones we have staged options for """
+        paths = []
+        for partition_path in partitions:
+            p = partitions[partition_path]
+            if p.type in (pm.PARTITION_FREESPACE, pm.PARTITION_FREESPACE_EXTENDED):
+                continue
+            if self.gen_partition_uid(p=p) in self.stage_opts:
+                paths.append(p.path)
+        if paths and not self.testing:
+            device_wait.wait_for_devices(paths)
+
     def create_staged_partitions(self):
         """ Create staged partitions """
         # Sometimes a swap partition can still be active at this point
@@ -1724,7 +1874,13 @@ class InstallationAdvanced(Gtk.Box):
                     logging.info(_("Saving changes done in %s") % disk_path)
                 # Now that partitions are created, set fs and label
                 partitions.update(pm.get_partitions(disk))
+
+            # Wait for the device nodes of the partitions we are going to format
+            self.wait_for_partitions(partitions)
             apartitions = list(partitions) + self.lv_partitions
+            # (partition, filesystem, label, mkfs options) of the partitions we must format
+            self.mkfs_jobs = []
+            self.deferred_mkfs = []
             if True:
                 boot = False
                 efiboot = False
@@ -1755,6 +1911,7 @@ class InstallationAdvanced(Gtk.Box):
                                 (res, err) = pm.set_flag(pm.PED_PARTITION_BOOT, partitions[partition_path])
                             if not self.testing:
                                 pm.finalize_changes(partitions[partition_path].disk)
+                                self.wait_for_partitions(partitions)
 
                         # EFI and /boot is NOT the EFI partition mount point -> Flag /boot as legacy_boot
                         if (mnt == '/boot' and efiboot):
@@ -1763,6 +1920,7 @@ class InstallationAdvanced(Gtk.Box):
                                 (res, err) = pm.set_flag(pm.PED_PARTITION_LEGACY_BOOT, partitions[partition_path])
                             if not self.testing:
                                 pm.finalize_changes(partitions[partition_path].disk)
+                                self.wait_for_partitions(partitions)
 
                         # No LVM and
                         # BIOS and / is the boot partition (no /boot or /boot/efi partition) -> Flag / as boot
@@ -1774,6 +1932,7 @@ class InstallationAdvanced(Gtk.Box):
                                 (res, err) = pm.set_flag(pm.PED_PARTITION_BOOT, partitions[partition_path])
                             if not self.testing:
                                 pm.finalize_changes(partitions[partition_path].disk)
+                                self.wait_for_partitions(partitions)
 
                         # LVM
                         if "/dev/mapper" in partition_path:
@@ -1791,6 +1950,7 @@ class InstallationAdvanced(Gtk.Box):
                                         (res, err) = pm.set_flag(pm.PED_PARTITION_BOOT, partitions[ee])
                                 if not self.testing:
                                     pm.finalize_changes(partitions[ee].disk)
+                                    self.wait_for_partitions(partitions)
 
                         # the swap flag is for mac partitions
                         #if "swap" in fisy:
@@ -1801,20 +1961,34 @@ class InstallationAdvanced(Gtk.Box):
                         if fmt:
                             # All of fs module takes paths, not partition objs
                             if not self.testing:
-                                # Create filesystem using mkfs
-                                (error, msg) = fs.create_fs(partition_path, fisy, lbl)
-                                if error == 0:
-                                    logging.info(msg)
+                                # Filesystems are created later, all at the same time
+                                opts = fs_profiles.get_mkfs_options(fisy, partition_path, mnt)
+                                if fs.is_deferrable(mnt):
+                                    # This one will be created while our system is being copied
+                                    self.deferred_mkfs.append((partition_path, fisy, mnt, lbl, opts))
                                 else:
-                                    txt = _("Couldn't format partition '%s' with label '%s' as '%s'") % (partition_path, lbl, fisy)
-                                    logging.error(txt)
-                                    logging.error(msg)
-                                    show.error(txt)
+                                    self.mkfs_jobs.append((partition_path, fisy, lbl, opts))
                         elif partition_path in self.orig_label_dic:
                             if self.orig_label_dic[partition_path] != lbl:
                                 if not self.testing:
                                     fs.label_fs(fisy, partition_path, lbl)
 
+                # Create our filesystems using mkfs
+                fs.create_filesystems(self.mkfs_jobs, self.on_filesystem_created)
+
+    def on_filesystem_created(self, partition_path, ret):
+        """ A filesystem has been created (or it has failed) """
+        (error, msg) = ret
+        if error == 0:
+            logging.info(msg)
+        else:
+            for (part, fisy, lbl, other_opts) in self.mkfs_jobs:
+                if part == partition_path:
+                    txt = _("Couldn't format partition '%s' with label '%s' as '%s'") % (partition_path, lbl, fisy)
+                    logging.error(txt)
+                    logging.error(msg)
+                    show.error(txt)
+
     def start_installation(self):
         """ Start installation process """
         fs_devices = {}
@@ -1862,6 +2036,7 @@ class InstallationAdvanced(Gtk.Box):
                          self.settings.get('bootloader_location'))
 
         if not self.testing:
+            from installation import process as installation_process
             self.process = installation_process.InstallationProcess(
                         self.settings,
                         self.callback_queue,
@@ -1869,7 +2044,8 @@ class InstallationAdvanced(Gtk.Box):
                         fs_devices,
                         self.ssd,
                         self.alternate_package_list,
-                        self.blvm)
+                        self.blvm,
+                        self.deferred_mkfs)
 
             self.process.start()
         else:
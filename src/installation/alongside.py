@@ -26,22 +26,17 @@
 
 import xml.etree.ElementTree as etree
 
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 
 import sys
 import os
 import canonical.misc as misc
 import logging
 import show_message as show
-import bootinfo
+import probes
+import queue
 import subprocess
-
-# To be able to test this installer in other systems
-# that do not have pyparted3 installed
-try:
-    import parted
-except:
-    print("Can't import parted module! This installer won't work.")
+import threading
 
 # Insert the src/parted directory at the front of the path.
 base_dir = os.path.dirname(__file__) or '.'
@@ -50,8 +45,9 @@ sys.path.insert(0, parted_dir)
 
 import parted3.partition_module as pm
 import parted3.fs_module as fs
+import parted3.device_graph as device_graph
+import parted3.resize_limits as resize_limits
 
-from installation import process as installation_process
 
 _next_page = "user_info"
 _prev_page = "installation_ask"
@@ -59,6 +55,12 @@ _prev_page = "installation_ask"
 # leave at least 6.5GB for Manjaro when shrinking, same as MIN_ROOT_SIZE in auto_partition
 MIN_ROOT_SIZE = 6500
 
+# Sizes in this page are in MB (as parted and ntfsresize count them)
+MB = 1000 * 1000
+
+# Shown while we find out how much a partition can be shrunk
+LIMITS_PENDING = "…"
+
 
 class InstallationAlongside(Gtk.Box):
     def __init__(self, params):
@@ -69,6 +71,7 @@ class InstallationAlongside(Gtk.Box):
         self.settings = params['settings']
         self.alternate_package_list = params['alternate_package_list']
         self.testing = params['testing']
+        self.probes = params['probes']
 
         super().__init__()
         self.ui = Gtk.Builder()
@@ -81,6 +84,11 @@ class InstallationAlongside(Gtk.Box):
 
         self.treeview = self.ui.get_object("treeview1")
         self.treeview_store = None
+
+        # Resize limits are computed in the background (see populate_treeview)
+        self.resize_limits = resize_limits.ResizeLimitService()
+        # Partition the user has selected whose limits are not ready yet
+        self.pending_partition = None
         self.prepare_treeview()
         self.populate_treeview()
 
@@ -178,57 +186,71 @@ class InstallationAlongside(Gtk.Box):
         col = Gtk.TreeViewColumn(_("Filesystem"), render_text, text=2)
         self.treeview.append_column(col)
 
-    @misc.raise_privileges
+        col = Gtk.TreeViewColumn(_("Available for Manjaro"), render_text, text=3)
+        self.treeview.append_column(col)
+
     def populate_treeview(self):
         if self.treeview_store is not None:
             self.treeview_store.clear()
 
-        self.treeview_store = Gtk.TreeStore(str, str, str)
+        self.treeview_store = Gtk.TreeStore(str, str, str, str)
 
-        oses = {}
-        oses = bootinfo.get_os_dict()
+        oses = self.probes.get_os_names()
+        graph = self.probes.get(probes.GRAPH)
 
         self.partitions = {}
 
-        try:
-            device_list = parted.getAllDevices()
-        except:
-            txt = _("pyparted3 not found!")
-            logging.error(txt)
-            show.fatal_error(txt)
-            device_list = []
-
-        for dev in device_list:
-            ## avoid cdrom and any raid, lvm volumes or encryptfs
-            if not dev.path.startswith("/dev/sr") and \
-               not dev.path.startswith("/dev/mapper"):
-                try:
-                    disk = parted.Disk(dev)
-                    # create list of partitions for this device (p.e. /dev/sda)
-                    partition_list = disk.partitions
-
-                    for p in partition_list:
-                        if p.type != pm.PARTITION_EXTENDED:
-                            ## Get filesystem
-                            fs_type = ""
-                            if p.fileSystem and p.fileSystem.type:
-                                fs_type = p.fileSystem.type
-                            if "swap" not in fs_type:
-                                if p.path in oses:
-                                    row = [p.path, oses[p.path], fs_type]
-                                else:
-                                    row = [p.path, _("unknown"), fs_type]
-                                self.treeview_store.append(None, row)
-                        self.partitions[p.path] = p
-                except Exception as e:
-                    txt = _("Unable to create list of partitions for alongside installation.")
-                    logging.warning(txt)
-                    #show.warning(txt)
+        # Our graph does not list cdroms, raid, lvm volumes or encryptfs as disks
+        for disk in graph.disks():
+            for p in graph.partitions(disk.path):
+                if p.part_type != device_graph.EXTENDED:
+                    fs_type = p.fs_type
+                    if "swap" not in fs_type:
+                        if p.path in oses:
+                            row = [p.path, oses[p.path], fs_type, LIMITS_PENDING]
+                        else:
+                            row = [p.path, _("unknown"), fs_type, LIMITS_PENDING]
+                        tree_iter = self.treeview_store.append(None, row)
+                        self.submit_resize_limits(tree_iter, p)
+                self.partitions[p.path] = p
 
         # assign our new model to our treeview
         self.treeview.set_model(self.treeview_store)
         self.treeview.expand_all()
 
+    def submit_resize_limits(self, tree_iter, partition):
+        """ Find out how much partition can be shrunk, in the background """
+        store = self.treeview_store
+        row_ref = Gtk.TreeRowReference.new(store, store.get_path(tree_iter))
+
+        def on_done(partition_path, limits):
+            # Called from a worker thread
+            GLib.idle_add(self.on_resize_limits_ready, row_ref, partition_path, limits)
+
+        self.resize_limits.submit(partition.path, partition.fs_type, partition.size, on_done)
+
+    def on_resize_limits_ready(self, row_ref, partition_path, limits):
+        """ Show how much space Manjaro can have in this partition """
+        if row_ref.valid():
+            store = row_ref.get_model()
+            tree_iter = store.get_iter(row_ref.get_path())
+            if not limits.can_shrink:
+                store.set_value(tree_iter, 3, limits.reason)
+            else:
+                available = (limits.max_size - limits.min_size) / MB
+                store.set_value(tree_iter, 3, str(int(available)) + " MB")
+
+        # The user was waiting for this one
+        if self.pending_partition == partition_path:
+            self.pending_partition = None
+            self.on_treeview_cursor_changed(self.treeview)
+        return False
+
+    def get_resize_limits(self, partition_path):
+        """ Returns partition's resize limits (None if they're not ready yet) """
+        partition = self.partitions[partition_path]
+        return self.resize_limits.get(partition.path, partition.fs_type, partition.size)
+
     def on_treeview_cursor_changed(self, widget):
         selection = self.treeview.get_selection()
 
@@ -249,18 +271,23 @@ class InstallationAlongside(Gtk.Box):
         self.max_size = 0
         self.new_size = 0
 
-        try:
-            subprocess.call(["mount", partition_path, "/mnt"], stderr=subprocess.DEVNULL)
-            x = subprocess.check_output(['df', partition_path]).decode()
-            subprocess.call(["umount", "-l", "/mnt"], stderr=subprocess.DEVNULL)
-            x = x.split('\n')
-            x = x[1].split()
-            self.max_size = int(x[1]) / 1000
-            self.min_size = int(x[2]) / 1000
-        except subprocess.CalledProcessError as e:
-            txt = "CalledProcessError.output = %s" % e.output
+        limits = self.get_resize_limits(partition_path)
+        if limits is None:
+            # We will be back when they're ready (see on_resize_limits_ready)
+            self.pending_partition = partition_path
+            self.forward_button.set_sensitive(False)
+            return
+        self.pending_partition = None
+
+        if not limits.can_shrink:
+            txt = _("Can't shrink %s: %s") % (partition_path, limits.reason)
             logging.error(txt)
-            show.fatal_error(txt)
+            show.error(txt)
+            self.forward_button.set_sensitive(False)
+            return
+
+        self.max_size = limits.max_size / MB
+        self.min_size = limits.min_size / MB
 
         if self.min_size + MIN_ROOT_SIZE < self.max_size:
             self.new_size = self.ask_shrink_size(other_os_name)
@@ -318,13 +345,17 @@ class InstallationAlongside(Gtk.Box):
 
         return value
 
+    def get_device_path(self, partition_path):
+        """ Returns the path of the disk where partition_path is """
+        graph = self.probes.get(probes.GRAPH)
+        return graph.disk_of(partition_path).path
+
     def is_room_available(self):
         partition_path = self.row[0]
         otherOS = self.row[1]
         fs_type = self.row[2]
 
-        # what if path is sda10 (two digits) ? this is wrong
-        device_path = self.row[0][:-1]
+        device_path = self.get_device_path(partition_path)
 
         new_size = self.new_size
 
@@ -339,11 +370,11 @@ class InstallationAlongside(Gtk.Box):
         primary_partitions = []
 
         for path in self.partitions:
-            if device_path in path:
+            if self.get_device_path(path) == device_path:
                 p = self.partitions[path]
-                if p.type == pm.PARTITION_EXTENDED:
+                if p.part_type == device_graph.EXTENDED:
                     extended_path = path
-                elif p.type == pm.PARTITION_PRIMARY:
+                elif p.part_type == device_graph.PRIMARY:
                     primary_partitions.append(path)
 
         primary_partitions.sort()
@@ -362,6 +393,70 @@ class InstallationAlongside(Gtk.Box):
 
         return True
 
+    def queue_event(self, event_type, event_text=""):
+        try:
+            self.callback_queue.put_nowait((event_type, event_text))
+        except queue.Full:
+            pass
+
+    def shrink_filesystem(self, partition_path, fs_type, new_size):
+        """ Shrinks partition_path's filesystem (in a thread) while a dialog shows its progress.
+            The user can cancel it until the tools start modifying the filesystem.
+            Returns (shrunk, cancelled) """
+        cancel = threading.Event()
+        result = []
+
+        dialog = Gtk.Dialog(_("Shrinking %s") % partition_path, self.get_toplevel(), Gtk.DialogFlags.MODAL)
+        dialog.set_deletable(False)
+        cancel_button = dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        label = Gtk.Label(_("Checking %s...") % partition_path)
+        progress_bar = Gtk.ProgressBar()
+        progress_bar.set_show_text(True)
+        content = dialog.get_content_area()
+        content.set_spacing(6)
+        content.set_border_width(12)
+        content.pack_start(label, False, False, 0)
+        content.pack_start(progress_bar, False, False, 0)
+        dialog.set_default_size(400, -1)
+        dialog.show_all()
+
+        def update_dialog(fraction, text, cancelable):
+            progress_bar.set_fraction(fraction)
+            label.set_text(text)
+            cancel_button.set_sensitive(cancelable and not cancel.is_set())
+            return False
+
+        def on_progress(fraction, text, cancelable):
+            # Called from our worker thread
+            self.queue_event('percent', fraction)
+            self.queue_event('info', text)
+            GLib.idle_add(update_dialog, fraction, text, cancelable)
+
+        def on_finished():
+            dialog.response(Gtk.ResponseType.ACCEPT)
+            return False
+
+        def shrink():
+            try:
+                result.append(fs.resize(partition_path, fs_type, new_size, on_progress, cancel))
+            finally:
+                GLib.idle_add(on_finished)
+
+        thread = threading.Thread(target=shrink)
+        thread.start()
+
+        while dialog.run() != Gtk.ResponseType.ACCEPT:
+            if cancel_button.get_sensitive():
+                cancel.set()
+                cancel_button.set_sensitive(False)
+                label.set_text(_("Cancelling..."))
+
+        thread.join()
+        dialog.destroy()
+
+        shrunk = bool(result) and result[0]
+        return (shrunk, cancel.is_set() and not shrunk)
+
     def start_installation(self):
         # Alongside method shrinks selected partition
         # and creates root and swap partition in the available space
@@ -373,19 +468,23 @@ class InstallationAlongside(Gtk.Box):
         otherOS = self.row[1]
         fs_type = self.row[2]
 
-        # what if path is sda10 (two digits) ? this is wrong
-        device_path = self.row[0][:-1]
-
-        #re.search(r'\d+$', self.row[0])
+        device_path = self.get_device_path(partition_path)
 
         new_size = self.new_size
 
         # first, shrink filesystem
-        res = fs.resize(partition_path, fs_type, new_size)
+        (res, cancelled) = self.shrink_filesystem(partition_path, fs_type, new_size)
+        # Its limits are not the same anymore
+        self.resize_limits.forget(partition_path)
         if res:
             print("Filesystem on " + partition_path + " shrunk.\nWill recreate partition now on device " + device_path + " partition " + partition_path)
             # destroy original partition and create a new resized one
             res = pm.split_partition(device_path, partition_path, new_size)
+        elif cancelled:
+            txt = _("Shrinking %s(%s) has been cancelled, it has not been modified") % (otherOS, fs_type)
+            logging.warning(txt)
+            show.warning(txt)
+            return
         else:
             txt = _("Can't shrink %s(%s) filesystem") % (otherOS, fs_type)
             logging.error(txt)
@@ -499,6 +598,7 @@ class InstallationAlongside(Gtk.Box):
             logging.warning(_("Thus will not install any boot loader"))
 
         if not self.testing:
+            from installation import process as installation_process
             self.process = installation_process.InstallationProcess( \
                             self.settings, \
                             self.callback_queue, \
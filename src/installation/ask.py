@@ -28,10 +28,11 @@
 
 from gi.repository import Gtk
 
-import bootinfo
 import logging
 import os
 
+import probes
+
 _prev_page = "keymap"
 
 class InstallationAsk(Gtk.Box):
@@ -41,6 +42,7 @@ class InstallationAsk(Gtk.Box):
         self.forward_button = params['forward_button']
         self.backwards_button = params['backwards_button']
         self.settings = params['settings']
+        self.probes = params['probes']
 
         super().__init__()
         self.ui = Gtk.Builder()
@@ -62,12 +64,12 @@ class InstallationAsk(Gtk.Box):
 
         super().add(self.ui.get_object("installation_ask"))
 
-        oses = {}
-        oses = bootinfo.get_os_dict()
+        oses = self.probes.get_os_names()
 
         self.other_os = ""
-        for k in oses:
-            if "sda" in k and oses[k] != "unknown":
+        # Any disk will do (it may be a nvme or mmc one)
+        for k in sorted(oses):
+            if oses[k] != _("unknown"):
                 self.other_os = oses[k]
 
         # by default, select automatic installation
@@ -25,12 +25,19 @@
 #  MA 02110-1301, USA.
 
 import os
+import queue
 import subprocess
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import show_message as show
 import parted3.partition_module as pm
 import parted3.fs_module as fs
+import parted3.fs_profiles as fs_profiles
+import parted3.block_info as block_info
+import parted3.device_wait as device_wait
 import parted3.lvm as lvm
+import parted3.mount_table as mount_table
 import parted3.used_space as used_space
 
 """ AutoPartition class """
@@ -42,11 +49,74 @@ MAX_ROOT_SIZE = 30000
 # KDE needs 4.5 GB for its files. Need to leave extra space also.
 MIN_ROOT_SIZE = 6500
 
+# Partition type ids used in our sfdisk scripts
+GPT_BIOS_GRUB = "21686148-6449-6E6F-744E-656564454649"
+GPT_EFI_SYSTEM = "C12A7328-F81F-11D2-BA4B-00A0C93EC93B"
+GPT_LINUX = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
+GPT_LINUX_LVM = "E6D6D379-F507-44C2-A23C-238F2A3DF928"
+GPT_LINUX_SWAP = "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F"
+MBR_LINUX = "83"
+MBR_LINUX_LVM = "8e"
+MBR_LINUX_SWAP = "82"
+
+# A partition of our layout. Its size is in MiB (None means all remaining space)
+PlannedPartition = namedtuple('PlannedPartition', 'size type name bootable')
+
 def check_output(command):
     """ Calls subprocess.check_output, decodes its exit and removes trailing \n """
     return subprocess.check_output(command.split()).decode().strip("\n")
 
 
+def get_partition_path(device, number):
+    """ Returns the device node of a partition (/dev/sda1, /dev/nvme0n1p1, /dev/mmcblk0p1) """
+    if device[-1].isdigit():
+        return "%sp%d" % (device, number)
+    return "%s%d" % (device, number)
+
+
+def render_sfdisk_script(label, partitions, first_start, align=1):
+    """ Returns a sfdisk script that creates a whole partition table at once.
+        first_start is where our first partition begins (in MiB).
+        All partitions start and end at multiples of align MiB. Partition ends (not sizes)
+        are rounded up, so rounding never takes more than align MiB from the last partition """
+    lines = ["label: %s" % label, ""]
+    start = -(-first_start // align) * align
+    # Where our partitions would end without any rounding
+    planned_end = start
+    for number, part in enumerate(partitions, 1):
+        fields = []
+        if number == 1:
+            fields.append("start=%dMiB" % start)
+        # Without a size, sfdisk uses all remaining space. Our sizes add up to the whole disk,
+        # the last partition gets what is left
+        if part.size is not None and number < len(partitions):
+            planned_end += part.size
+            end = max(start + align, -(-int(planned_end) // align) * align)
+            fields.append("size=%dMiB" % (end - start))
+            start = end
+        fields.append("type=%s" % part.type)
+        if label == "gpt":
+            if part.name:
+                fields.append('name="%s"' % part.name)
+            if part.bootable:
+                fields.append('attrs="LegacyBIOSBootable"')
+        elif part.bootable:
+            fields.append("bootable")
+        lines.append(", ".join(fields))
+    return "\n".join(lines) + "\n"
+
+
+def write_partition_table(device, script):
+    """ Writes a whole partition table with just one sfdisk run """
+    logging.debug("sfdisk script for %s:\n%s", device, script)
+    cmd = ["sfdisk", "--wipe", "always", "--wipe-partitions", "always", device]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate(input=script.encode())[0].decode()
+    logging.debug(output)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+
+
 def printk(enable):
     """ Enables / disables printing kernel messages to console """
     with open("/proc/sys/kernel/printk", "w") as fpk:
@@ -62,63 +132,36 @@ def unmount_all(dest_dir):
         if "/dev/zram" not in name:
             subprocess.check_call(["swapoff", name])
 
-    mount_result = subprocess.check_output("mount").decode().split("\n")
-
-    # Umount all devices mounted inside dest_dir (if any)
-    dirs = []
-    for mount in mount_result:
-        if dest_dir in mount:
-            directory = mount.split()[0]
-            # Do not unmount dest_dir now (we will do it later)
-            if directory is not dest_dir:
-                dirs.append(directory)
-
-    for directory in dirs:
-        logging.warning(_("Unmounting %s"), directory)
-        try:
-            subprocess.call(["umount", directory])
-        except Exception:
-            logging.warning(_("Unmounting %s failed. Trying lazy arg."), directory)
-            subprocess.call(["umount", "-l", directory])
-
-    # Now is the time to unmount the device that is mounted in dest_dir (if any)
-    if dest_dir in mount_result:
-        logging.warning(_("Unmounting %s"), dest_dir)
-        try:
-            subprocess.call(["umount", dest_dir])
-        except Exception:
-            logging.warning(_("Unmounting %s failed. Trying lazy arg."), dest_dir)
-            subprocess.call(["umount", "-l", dest_dir])
+    # Umount all devices mounted inside dest_dir (if any) and dest_dir itself.
+    # They may be left from a previous failed installation, detach them if they are busy
+    mount_table.unmount_tree(dest_dir, lazy=True)
 
     # Remove all previous LVM volumes
     # (it may have been left created due to a previous failed installation)
+    lvm.refresh_inventory()
+    inventory = lvm.get_inventory()
+    vgnames = [vgname for vgname in sorted(inventory) if vgname]
+    lvolumes = []
+    for vgname in vgnames:
+        for lvolume in inventory[vgname]['lvs']:
+            lvolumes.append("/dev/" + vgname + "/" + lvolume)
+    pvolumes = lvm.get_physical_volumes()
+
+    # Each command gets all volumes at once, so lvm only scans our devices once per command
     try:
-        lvolumes = check_output("lvs -o lv_name,vg_name --noheading").split("\n")
-        if len(lvolumes[0]) > 0:
-            for lvolume in lvolumes:
-                if len(lvolume) > 0:
-                    (lvolume, vgroup) = lvolume.split()
-                    lvdev = "/dev/" + vgroup + "/" + lvolume
-                    subprocess.check_call(["wipefs", "-af", lvdev])
-                    subprocess.check_call(["lvremove", "-f", lvdev])
-
-        vgnames = check_output("vgs -o vg_name --noheading").split("\n")
-        if len(vgnames[0]) > 0:
-            for vgname in vgnames:
-                vgname = vgname.strip()
-                if len(vgname) > 0:
-                    subprocess.check_call(["vgremove", "-f", vgname])
-
-        pvolumes = check_output("pvs -o pv_name --noheading").split("\n")
-        if len(pvolumes[0]) > 0:
-            for pvolume in pvolumes:
-                pvolume = pvolume.strip(" ")
-                subprocess.check_call(["pvremove", "-f", pvolume])
-
+        if lvolumes:
+            subprocess.check_call(["wipefs", "-af"] + lvolumes)
+            subprocess.check_call(["lvremove", "-f"] + lvolumes)
+        if vgnames:
+            subprocess.check_call(["vgremove", "-f"] + vgnames)
+        if pvolumes:
+            subprocess.check_call(["pvremove", "-f"] + pvolumes)
     except subprocess.CalledProcessError as err:
         logging.warning(_("Can't delete existent LVM volumes (see below)"))
         logging.warning(err)
 
+    lvm.refresh_inventory()
+
     # Close LUKS devices (they may have been left open because of a previous failed installation)
     try:
         if os.path.exists("/dev/mapper/cryptManjaro"):
@@ -131,7 +174,8 @@ def unmount_all(dest_dir):
 
 class AutoPartition(object):
     """ Class used by the automatic installation method """
-    def __init__(self, dest_dir, auto_device, use_luks, use_lvm, luks_key_pass, use_home, callback_queue):
+    def __init__(self, dest_dir, auto_device, use_luks, use_lvm, luks_key_pass, use_home, callback_queue,
+                 defer_home=False, root_fs="ext4"):
         """ Class initialization """
         self.dest_dir = dest_dir
         self.auto_device = auto_device
@@ -146,17 +190,35 @@ class AutoPartition(object):
         # Will use these queue to show progress info to the user
         self.callback_queue = callback_queue
 
+        # If True, run() does not create /home. Its job is left in deferred_jobs
+        # so it can be formatted while the system is being copied
+        self.defer_home = defer_home
+        self.deferred_jobs = []
+
+        # Filesystem used for root (and home). F2FS is offered for SD cards and eMMC
+        self.root_fs = root_fs
+
         self.efi = False
         if os.path.exists("/sys/firmware/efi"):
             self.efi = True
 
-        self.separate_boot = use_luks or use_lvm or self.efi
+        # GRUB can't read compressed F2FS files, our kernels need their own /boot partition
+        self.separate_boot = use_luks or use_lvm or self.efi or root_fs == "f2fs"
         logging.debug( "luks is " + str(use_luks) + ", lvm is " + str(use_lvm) \
-                       + " and efi is " + str(self.efi) \
+                       + ", efi is " + str(self.efi) + " and root is " + root_fs \
                        + "\ntherefore separate_boot is " + str(self.separate_boot))
 
-    def mkfs(self, device, fs_type, mount_point, label_name, fs_options="", btrfs_devices=""):
-        """ We have two main cases: "swap" and everything else. """
+    def queue_event(self, event_type, event_text=""):
+        try:
+            self.callback_queue.put_nowait((event_type, event_text))
+        except queue.Full:
+            pass
+
+    def format(self, device, fs_type, label_name, fs_options="", btrfs_devices="", mount_point=None):
+        """ Creates a filesystem (or a swap space) in device.
+            Without fs_options, our filesystem profiles choose them (see fs_profiles).
+            Returns None if everything went fine, an error message otherwise.
+            Several format calls may run at the same time, see create_filesystems """
         logging.debug("Will mkfs " + device + " as " + fs_type)
         if fs_type == "swap":
             try:
@@ -164,17 +226,23 @@ class AutoPartition(object):
                 if device in swap_devices:
                     subprocess.check_call(["swapoff", device])
                 subprocess.check_call(["mkswap", "-L", label_name, device])
-                subprocess.check_call(["swapon", device])
             except subprocess.CalledProcessError as err:
                 logging.warning(err.output)
         else:
+            if not fs_options:
+                fs_options = fs_profiles.get_mkfs_options(fs_type, device, mount_point)
+
+            # Tell the filesystem about our RAID geometry
+            fs_options = fs.add_stripe_options(fs_type, device, fs_options)
+
             mkfs = {"xfs": "mkfs.xfs %s -L %s -f %s" % (fs_options, label_name, device),
                     "jfs": "yes | mkfs.jfs %s -L %s %s" % (fs_options, label_name, device),
                     "reiserfs": "yes | mkreiserfs %s -l %s %s" % (fs_options, label_name, device),
-                    "ext2": "mkfs.ext2 -q -L %s %s %s" % (fs_options, label_name, device),
+                    "ext2": "mkfs.ext2 -q %s -L %s %s" % (fs_options, label_name, device),
                     "ext3": "mke2fs -q %s -L %s -t ext3 %s" % (fs_options, label_name, device),
                     "ext4": "mke2fs -q %s -L %s -t ext4 %s" % (fs_options, label_name, device),
-                    "btrfs": "mkfs.btrfs %s -L %s %s" % (fs_options, label_name, btrfs_devices),
+                    "btrfs": "mkfs.btrfs -f %s -L %s %s" % (fs_options, label_name, btrfs_devices or device),
+                    "f2fs": "mkfs.f2fs -f %s -l %s %s" % (fs_options, label_name, device),
                     "nilfs2": "mkfs.nilfs2 %s -L %s %s" % (fs_options, label_name, device),
                     "ntfs-3g": "mkfs.ntfs %s -L %s %s" % (fs_options, label_name, device),
                     "vfat": "mkfs.vfat %s -n %s %s" % (fs_options, label_name, device)}
@@ -183,8 +251,7 @@ class AutoPartition(object):
             if fs_type not in mkfs.keys():
                 txt = _("Unknown filesystem type %s") % fs_type
                 logging.error(txt)
-                show.error(txt)
-                return
+                return txt
 
             command = mkfs[fs_type]
 
@@ -195,40 +262,95 @@ class AutoPartition(object):
                 logging.error(txt)
                 logging.error(err.cmd)
                 logging.error(err.output)
-                show.error(txt)
-                return
+                return txt
+
+        # Our new filesystem has a new UUID
+        info = fs.refresh_info(device)
+        fs_uuid = info.get('UUID', '')
+        fs_label = info.get('LABEL', '')
+        logging.debug("Device details: %s UUID=%s LABEL=%s", device, fs_uuid, fs_label)
+
+        # grub and our crypttab refer to our filesystems by their by-uuid links
+        if fs_uuid:
+            device_wait.wait_for_uuid(fs_uuid)
 
-            # Flush filesystem buffers
-            subprocess.check_call(["sync"])
+        return None
+
+    def mount(self, device, fs_type, mount_point):
+        """ Mounts a filesystem created by format (or enables a swap space) """
+        if fs_type == "swap":
+            try:
+                subprocess.check_call(["swapon", device])
+            except subprocess.CalledProcessError as err:
+                logging.warning(err.output)
+            return
 
-            # Create our mount directory
-            path = self.dest_dir + mount_point
-            subprocess.check_call(["mkdir", "-p", path])
+        # Create our mount directory
+        path = self.dest_dir + mount_point
+        subprocess.check_call(["mkdir", "-p", path])
 
-            # Mount our new filesystem
+        # Mount our new filesystem (with the options it will have in fstab)
+        mopts = fs_profiles.get_mount_options(fs_type, device, mount_point)
+        subprocess.check_call(["mount", "-t", fs_type, "-o", mopts, device, path])
 
-            mopts = "rw,relatime"
-            if fs_type == "ext4":
-                mopts = "rw,relatime,data=ordered"
-            elif fs_type == "btrfs":
-                mopts = 'rw,relatime,space_cache,autodefrag,inode_cache'
-            subprocess.check_call(["mount", "-t", fs_type, "-o", mopts, device, path])
+        mounts = mount_table.MountTable().get_tree(self.dest_dir)
+        logging.debug("AutoPartition done, filesystems mounted:\n" +
+                      "\n".join("%s on %s" % (mount.source, mount.mount_point) for mount in reversed(mounts)))
 
-            logging.debug("AutoPartition done, filesystems mounted:\n" + subprocess.check_output(["mount"]).decode())
+        # Change permission of base directories to avoid btrfs issues
+        mode = "755"
 
-            # Change permission of base directories to avoid btrfs issues
-            mode = "755"
+        if mount_point == "/tmp":
+            mode = "1777"
+        elif mount_point == "/root":
+            mode = "750"
 
-            if mount_point == "/tmp":
-                mode = "1777"
-            elif mount_point == "/root":
-                mode = "750"
+        subprocess.check_call(["chmod", mode, path])
 
-            subprocess.check_call(["chmod", mode, path])
+    def mkfs(self, device, fs_type, mount_point, label_name, fs_options="", btrfs_devices=""):
+        """ We have two main cases: "swap" and everything else. """
+        txt = self.format(device, fs_type, label_name, fs_options, btrfs_devices, mount_point)
+        if txt is not None:
+            show.error(txt)
+            return
+        self.mount(device, fs_type, mount_point)
+
+    def create_filesystems(self, jobs):
+        """ Formats all our devices at the same time and then mounts them, one after another
+            (in jobs' order, so "/" must be first).
+            jobs is a list of (device, fs_type, mount_point, label_name, fs_options) tuples """
+        failed = self.format_filesystems(jobs)
+
+        for (device, fs_type, mount_point, label_name, fs_options) in jobs:
+            if device not in failed:
+                self.mount(device, fs_type, mount_point)
+
+    def format_filesystems(self, jobs):
+        """ Formats all jobs' devices at the same time. Returns the devices that could not be formatted """
+        total = len(jobs)
+        failed = set()
+        if not jobs:
+            return failed
+
+        def format_job(job):
+            (device, fs_type, mount_point, label_name, fs_options) = job
+            self.queue_event('info', _("Creating %s filesystem in %s...") % (fs_type, device))
+            return self.format(device, fs_type, label_name, fs_options, mount_point=mount_point)
+
+        with ThreadPoolExecutor(max_workers=min(total, fs.MAX_MKFS_JOBS)) as executor:
+            futures = dict((executor.submit(format_job, job), job) for job in jobs)
+            done = 0
+            for future in as_completed(futures):
+                (device, fs_type, mount_point, label_name, fs_options) = futures[future]
+                done += 1
+                txt = future.result()
+                if txt is None:
+                    self.queue_event('debug', _("%s filesystem created in %s (%d of %d)") % (fs_type, device, done, total))
+                else:
+                    failed.add(device)
+                    show.error(txt)
 
-        fs_uuid = fs.get_info(device)['UUID']
-        fs_label = fs.get_info(device)['LABEL']
-        logging.debug("Device details: %s UUID=%s LABEL=%s", device, fs_uuid, fs_label)
+        return failed
 
     def get_devices(self):
         """ Set (and return) all partitions on the device """
@@ -244,28 +366,28 @@ class AutoPartition(object):
         # self.auto_device is of type /dev/sdX or /dev/hdX
 
         if self.efi:
-            efi = self.auto_device + "2"
-            boot = self.auto_device + "3"
-            root = self.auto_device + "4"
-            swap = self.auto_device + "5"
+            efi = get_partition_path(self.auto_device, 2)
+            boot = get_partition_path(self.auto_device, 3)
+            root = get_partition_path(self.auto_device, 4)
+            swap = get_partition_path(self.auto_device, 5)
             if self.home:
-                home = self.auto_device + "5"
-                swap = self.auto_device + "6"
-        elif self.luks or self.lvm:
-            boot = self.auto_device + "1"
-            root = self.auto_device + "2"
-            swap = self.auto_device + "3"
+                home = get_partition_path(self.auto_device, 5)
+                swap = get_partition_path(self.auto_device, 6)
+        elif self.separate_boot:
+            # LUKS, LVM or F2FS root (see plan_layout)
+            boot = get_partition_path(self.auto_device, 1)
+            root = get_partition_path(self.auto_device, 2)
+            swap = get_partition_path(self.auto_device, 3)
             if self.home:
-                home = self.auto_device + "3"
-                swap = self.auto_device + "4"
+                home = get_partition_path(self.auto_device, 3)
+                swap = get_partition_path(self.auto_device, 4)
         else:
-            # self.separate_boot must be false
             boot = ""
-            root = self.auto_device + "1"
-            swap = self.auto_device + "2"
+            root = get_partition_path(self.auto_device, 1)
+            swap = get_partition_path(self.auto_device, 2)
             if self.home:
-                home = self.auto_device + "2"
-                swap = self.auto_device + "3"
+                home = get_partition_path(self.auto_device, 2)
+                swap = get_partition_path(self.auto_device, 3)
 
         if self.luks:
             # Set luks and root
@@ -327,18 +449,18 @@ class AutoPartition(object):
             fs_devices[efi_device] = "vfat"
 
         if self.luks:
-            fs_devices[luks_devices[0]] = "ext4"
+            fs_devices[luks_devices[0]] = self.root_fs
             if self.home:
                 if self.lvm:
                     # luks, lvm, home
-                    fs_devices[home_device] = "ext4"
+                    fs_devices[home_device] = self.root_fs
                 else:
                     # luks, home
-                    fs_devices[luks_devices[1]] = "ext4"
+                    fs_devices[luks_devices[1]] = self.root_fs
         else:
-            fs_devices[root_device] = "ext4"
+            fs_devices[root_device] = self.root_fs
             if self.home:
-                fs_devices[home_device] = "ext4"
+                fs_devices[home_device] = self.root_fs
 
         for f in fs_devices:
             logging.debug("fs_devices[%s] = %s", f, fs_devices[f])
@@ -378,6 +500,36 @@ class AutoPartition(object):
                 stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
             (stdout_data, stderr_data) = proc.communicate(input=luks_key_pass_bytes)
 
+        device_wait.wait_for_devices(["/dev/mapper/%s" % luks_name])
+
+    def plan_layout(self, part_sizes, gpt_bios_grub_part_size, uefisys_part_size):
+        """ Returns the list of partitions we will create (see get_devices, they must agree) """
+        layout = []
+        if self.efi:
+            layout.append(PlannedPartition(gpt_bios_grub_part_size, GPT_BIOS_GRUB, "BIOS_GRUB", False))
+            layout.append(PlannedPartition(uefisys_part_size, GPT_EFI_SYSTEM, "UEFI_SYSTEM", False))
+            layout.append(PlannedPartition(part_sizes['boot'], GPT_LINUX, "MANJARO_BOOT", True))
+            if self.lvm:
+                layout.append(PlannedPartition(part_sizes['lvm_pv'], GPT_LINUX_LVM, "MANJARO_LVM", False))
+            else:
+                layout.append(PlannedPartition(part_sizes['root'], GPT_LINUX, "MANJARO_ROOT", False))
+                if self.home:
+                    layout.append(PlannedPartition(part_sizes['home'], GPT_LINUX, "MANJARO_HOME", False))
+                layout.append(PlannedPartition(part_sizes['swap'], GPT_LINUX_SWAP, "MANJARO_SWAP", False))
+        else:
+            if self.separate_boot:
+                # Our boot partition ends at part_sizes['boot'] MiB
+                layout.append(PlannedPartition(part_sizes['boot'] - 1, MBR_LINUX, "", True))
+            if self.lvm:
+                # Partition for lvm (will store root, swap and home (if desired) logical volumes)
+                layout.append(PlannedPartition(None, MBR_LINUX_LVM, "", False))
+            else:
+                layout.append(PlannedPartition(part_sizes['root'], MBR_LINUX, "", not self.separate_boot))
+                if self.home:
+                    layout.append(PlannedPartition(part_sizes['home'], MBR_LINUX, "", False))
+                layout.append(PlannedPartition(None, MBR_LINUX_SWAP, "", False))
+        return layout
+
     def get_part_sizes(self, disk_size, start_part_sizes=0):
         part_sizes = {}
         
@@ -454,16 +606,9 @@ class AutoPartition(object):
 
         # Get just the disk size in MiB
         device = self.auto_device
-        device_name = check_output("basename %s" % device)
-        base_path = "/sys/block/%s" % device_name
-        disk_size = 0
-        if os.path.exists("%s/size" % base_path):
-            with open("%s/queue/logical_block_size" % base_path, 'r') as f:
-                logical_block_size = int(f.read())
-            with open("%s/size" % base_path, 'r') as f:
-                size = int(f.read())
-
-            disk_size = ((logical_block_size * size) / 1024) / 1024
+        info = block_info.read(device)
+        if info is not None and info.size > 0:
+            disk_size = (info.size / 1024) / 1024
         else:
             txt = _("Setup cannot detect size of your device, please use advanced "
                 "installation routine for partitioning and mounting devices.")
@@ -481,105 +626,32 @@ class AutoPartition(object):
         printk(False)
 
         #WARNING: Our computed sizes are all in mebibytes (MiB) i.e. powers of 1024, not metric megabytes.
-        #         These are 'M' in sgdisk and 'MiB' in parted. If you use 'M' in parted you'll get MB instead of MiB,
+        #         These are 'MiB' in sfdisk. If you use 'M' you'll get MB instead of MiB,
         #         and you're gonna have a bad time.
 
-        # We assume a /dev/hdX format (or /dev/sdX)
-        if self.efi:
-            # GPT (GUID) is supported only by 'parted' or 'sgdisk'
-            # clean partition table to avoid issues!
-            subprocess.check_call(["sgdisk", "--zap", device])
-
-            # Clear all magic strings/signatures - mdadm, lvm, partition tables etc.
-            subprocess.check_call(["dd", "if=/dev/zero", "of=%s" % device, "bs=512", "count=2048", "status=noxfer"])
-            subprocess.check_call(["wipefs", "-a", device])
-            # Create fresh GPT
-            subprocess.check_call(["sgdisk", "--clear", device])
-            # Inform the kernel of the partition change. Needed if the hard disk had a MBR partition table.
-            subprocess.check_call(["partprobe", device])
-            # Create actual partitions
-            subprocess.check_call(['sgdisk --set-alignment="2048" --new=1:1M:+%dM --typecode=1:EF02 --change-name=1:BIOS_GRUB %s'
-                % (gpt_bios_grub_part_size, device)], shell=True)
-            subprocess.check_call(['sgdisk --set-alignment="2048" --new=2:0:+%dM --typecode=2:EF00 --change-name=2:UEFI_SYSTEM %s'
-                % (uefisys_part_size, device)], shell=True)
-            subprocess.check_call(['sgdisk --set-alignment="2048" --new=3:0:+%dM --typecode=3:8300 --attributes=3:set:2 --change-name=3:MANJARO_BOOT %s'
-                % (part_sizes['boot'], device)], shell=True)
-
-            if self.lvm:
-                subprocess.check_call(['sgdisk --set-alignment="2048" --new=4:0:+%dM --typecode=4:8E00 --change-name=4:MANJARO_LVM %s'
-                    % (part_sizes['lvm_pv'], device)], shell=True)
-            else:
-                subprocess.check_call(['sgdisk --set-alignment="2048" --new=4:0:+%dM --typecode=4:8300 --change-name=4:MANJARO_ROOT %s'
-                    % (part_sizes['root'], device)], shell=True)
-
-                if self.home:
-                    subprocess.check_call(['sgdisk --set-alignment="2048" --new=5:0:+%dM --typecode=5:8300 --change-name=5:MANJARO_HOME %s'
-                        % (part_sizes['home'], device)], shell=True)
+        # Partitions are aligned to what the device topology asks (1MiB at least)
+        align = info.alignment() // (1024 * 1024)
+        logging.debug("Partitions in %s will be aligned to %dMiB", device, align)
 
-                    subprocess.check_call(['sgdisk --set-alignment="2048" --new=6:0:+%dM --typecode=6:8200 --change-name=6:MANJARO_SWAP %s'
-                    % (part_sizes['swap'], device)], shell=True)
-                else:
-                    subprocess.check_call(['sgdisk --set-alignment="2048" --new=5:0:+%dM --typecode=5:8200 --change-name=5:MANJARO_SWAP %s'
-                    % (part_sizes['swap'], device)], shell=True)
-
-            logging.debug(check_output("sgdisk --print %s" % device))
+        # The whole table is written at once, so the kernel and udev only see one change
+        layout = self.plan_layout(part_sizes, gpt_bios_grub_part_size, uefisys_part_size)
+        if self.efi:
+            # GPT (GUID)
+            script = render_sfdisk_script("gpt", layout, 1, align)
         else:
             # DOS MBR partition table
-            # Start at sector 1 for 4k drive compatibility and correct alignment
-            # Clean partitiontable to avoid issues!
-            subprocess.check_call(["dd", "if=/dev/zero", "of=%s" % device, "bs=512", "count=2048", "status=noxfer"])
-            subprocess.check_call(["wipefs", "-a", device])
-
-            # Create DOS MBR with parted
-            subprocess.check_call(["parted", "-a", "optimal", "-s", device, "mktable", "msdos"])
-
-            if self.separate_boot:
-                # Create boot partition (all sizes are in MiB)
-                subprocess.check_call(["parted", "-a", "optimal", "-s", device, "mkpart", "primary", "1", "%dMiB" % part_sizes['boot']])
-                # Set boot partition as bootable
-                subprocess.check_call(["parted", "-a", "optimal", "-s", device, "set", "1", "boot", "on"])
-
-            if self.lvm:
-                start = part_sizes['boot']
-                if part_sizes['boot'] is 0:
-                    start = 1
-
-                end = start + part_sizes['lvm_pv']
-                # Create partition for lvm (will store root, swap and home (if desired) logical volumes)
-                subprocess.check_call(["parted", "-a", "optimal", "-s", device, "mkpart", "primary", "%dMiB" % start, "100%"])
-                # Set lvm flag
-                subprocess.check_call(["parted", "-a", "optimal", "-s", device, "set", "2", "lvm", "on"])
-            else:
-                start = part_sizes['boot']
-                if part_sizes['boot'] is 0:
-                    start = 1
-
-                # Create root partition
-                end = start + part_sizes['root']
-                subprocess.check_call(["parted", "-a", "optimal", "-s", device, "mkpart", "primary",
-                    "%dMiB" % start, "%dMiB" % end])
-
-                if not self.separate_boot:
-                    # Set this partition as bootable
-                    subprocess.check_call(["parted", "-a", "optimal", "-s", device, "set", "1", "boot", "on"])
-
+            # Start at 1MiB for 4k drive compatibility and correct alignment
+            script = render_sfdisk_script("dos", layout, 1, align)
 
-                if self.home:
-                    # Create home partition
-                    start = end
-                    end = start + part_sizes['home']
-                    subprocess.check_call(["parted", "-a", "optimal", "-s", device, "mkpart", "primary",
-                        "%dMiB" % start, "%dMiB" % end])
-
-                # Create swap partition
-                start = end
-                subprocess.check_call(["parted", "-a", "optimal", "-s", device, "mkpart", "primary", "linux-swap",
-                    "%dMiB" % start, "100%"])
+        # Clear all magic strings/signatures - mdadm, lvm, partition tables etc.
+        subprocess.check_call(["wipefs", "-a", device])
+        write_partition_table(device, script)
 
         printk(True)
 
-        # Wait until /dev initialized correct devices
-        subprocess.check_call(["udevadm", "settle", "--quiet"])
+        # Wait until /dev has our new partitions (and only them)
+        new_partitions = [get_partition_path(device, number) for number in range(1, len(layout) + 1)]
+        device_wait.wait_for_devices(new_partitions)
 
         (efi_device, boot_device, swap_device, root_device, luks_devices, lvm_device, home_device) = self.get_devices()
 
@@ -629,20 +701,28 @@ class AutoPartition(object):
                 # Use the remaining space for our swap volume
                 subprocess.check_call(["lvcreate", "--name", "ManjaroSwap", "--extents", "100%FREE", "ManjaroVG"])
 
+            # Wait for our logical volumes' device nodes
+            device_wait.wait_for_devices([dev for dev in (root_device, home_device, swap_device) if dev])
 
         # Make sure the "root" partition is defined first!
-        self.mkfs(root_device, "ext4", "/", "ManjaroRoot")
-        self.mkfs(swap_device, "swap", "", "ManjaroSwap")
+        jobs = [(root_device, self.root_fs, "/", "ManjaroRoot", ""),
+                (swap_device, "swap", "", "ManjaroSwap", "")]
         if self.separate_boot:
             logging.debug("Boot device is " + boot_device + ", about to mkfs")
-            self.mkfs(boot_device, "ext2", "/boot", "ManjaroBoot")
+            jobs.append((boot_device, "ext2", "/boot", "ManjaroBoot", ""))
 
         # Format the EFI partition
         if self.efi:
-            self.mkfs(efi_device, "vfat", "/boot/efi", "UEFI_SYSTEM", "-F 32")
+            jobs.append((efi_device, "vfat", "/boot/efi", "UEFI_SYSTEM", "-F 32"))
 
         if self.home:
-            self.mkfs(home_device, "ext4", "/home", "ManjaroHome")
+            home_job = (home_device, self.root_fs, "/home", "ManjaroHome", "")
+            if self.defer_home:
+                self.deferred_jobs.append(home_job)
+            else:
+                jobs.append(home_job)
+
+        self.create_filesystems(jobs)
 
         # NOTE: encrypted and/or lvm2 hooks will be added to mkinitcpio.conf in installation_process.py if necessary
         # NOTE: /etc/default/grub, /etc/stab and /etc/crypttab will be modified in installation_process.py, too.
@@ -28,13 +28,8 @@ from gi.repository import Gtk
 import os
 import canonical.misc as misc
 import logging
-from installation import process as installation_process
 
-# To be able to test this installer in other systems that do not have pyparted3 installed
-try:
-    import parted
-except:
-    print("Can't import parted module! This installer won't work.")
+import probes
 
 _next_page = "user_info"
 _prev_page = "installation_ask"
@@ -49,6 +44,7 @@ class InstallationAutomatic(Gtk.Box):
         self.settings = params['settings']
         self.alternate_package_list = params['alternate_package_list']
         self.testing = params['testing']
+        self.probes = params['probes']
 
         super().__init__()
         self.ui = Gtk.Builder()
@@ -66,6 +62,9 @@ class InstallationAutomatic(Gtk.Box):
 
         self.image_password_ok = self.ui.get_object('image_password_ok')
 
+        # Only shown for SD cards and eMMC
+        self.check_f2fs = self.ui.get_object('checkbutton_f2fs')
+
         super().add(self.ui.get_object("installation_automatic"))
 
         self.devices = dict()
@@ -100,6 +99,8 @@ class InstallationAutomatic(Gtk.Box):
         btn = self.ui.get_object('checkbutton_show_password')
         btn.set_label(_("Show password"))
 
+        self.check_f2fs.set_label(_("Use F2FS (recommended for SD cards and eMMC)"))
+
         txt = _("Install now!")
         self.forward_button.set_label(txt)
 
@@ -110,23 +111,20 @@ class InstallationAutomatic(Gtk.Box):
         self.entry['luks_password'].set_visibility(show)
         self.entry['luks_password_confirm'].set_visibility(show)
 
-    @misc.raise_privileges
     def populate_devices(self):
-        device_list = parted.getAllDevices()
+        graph = self.probes.get(probes.GRAPH)
 
         self.device_store.remove_all()
         self.devices = {}
 
-        for dev in device_list:
-            ## avoid cdrom and any raid, lvm volumes or encryptfs
-            if not dev.path.startswith("/dev/sr") and \
-               not dev.path.startswith("/dev/mapper"):
-                # hard drives measure themselves assuming kilo=1000, mega=1mil, etc
-                size_in_gigabytes = int((dev.length * dev.sectorSize) / 1000000000)
-                line = '{0} [{1} GB] ({2})'.format(dev.model, size_in_gigabytes, dev.path)
-                self.device_store.append_text(line)
-                self.devices[line] = dev.path
-                logging.debug(line)
+        # Our graph does not list cdroms, raid, lvm volumes or encryptfs as disks
+        for dev in graph.disks():
+            # hard drives measure themselves assuming kilo=1000, mega=1mil, etc
+            size_in_gigabytes = int(dev.size / 1000000000)
+            line = '{0} [{1} GB] ({2})'.format(dev.model, size_in_gigabytes, dev.path)
+            self.device_store.append_text(line)
+            self.devices[line] = dev.path
+            logging.debug(line)
 
         self.select_first_combobox_item(self.device_store)
 
@@ -139,8 +137,17 @@ class InstallationAutomatic(Gtk.Box):
         line = self.device_store.get_active_text()
         if line is not None:
             self.auto_device = self.devices[line]
+            self.update_f2fs_check()
         self.forward_button.set_sensitive(True)
 
+    def update_f2fs_check(self):
+        """ Offer F2FS if our drive is a SD card or an eMMC """
+        dev = self.probes.get(probes.GRAPH).get(self.auto_device)
+        if dev is not None and dev.is_flash():
+            self.check_f2fs.show()
+        else:
+            self.check_f2fs.hide()
+
     def prepare(self, direction):
         self.translate_ui()
         self.populate_devices()
@@ -158,6 +165,9 @@ class InstallationAutomatic(Gtk.Box):
         if response == Gtk.ResponseType.NO:
             return False
 
+        use_f2fs = self.check_f2fs.get_visible() and self.check_f2fs.get_active()
+        self.settings.set('use_f2fs', use_f2fs)
+
         luks_password = self.entry['luks_password'].get_text()
         self.settings.set('luks_key_pass', luks_password)
         if luks_password != "":
@@ -234,6 +244,7 @@ class InstallationAutomatic(Gtk.Box):
         self.settings.set('auto_device', self.auto_device)
 
         if not self.testing:
+            from installation import process as installation_process
             self.process = installation_process.InstallationProcess(
                             self.settings,
                             self.callback_queue,
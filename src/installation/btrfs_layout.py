@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  btrfs_layout.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Creates (and mounts) our subvolume layout when the root filesystem is btrfs.
+    It only needs a device, so it can be tried on a loop device """
+
+import logging
+import os
+import subprocess
+import tempfile
+
+# (subvolume, mount point). Root must be first
+SUBVOLUMES = [('@', '/'),
+              ('@home', '/home'),
+              ('@cache', '/var/cache'),
+              ('@log', '/var/log')]
+
+ROOT_SUBVOLUME = '@'
+
+# btrfs top level subvolume
+TOP_LEVEL_SUBVOLID = 5
+
+
+def get_subvolumes(mount_points):
+    """ Returns the subvolumes we need. Mount points that have their own partition
+        (or are inside one) do not get a subvolume """
+    subvolumes = []
+    for (name, mount_point) in SUBVOLUMES:
+        covered = False
+        for other in mount_points:
+            if other in ('', '/', 'swap'):
+                continue
+            if mount_point == other or mount_point.startswith(other.rstrip('/') + '/'):
+                covered = True
+                break
+        if not covered:
+            subvolumes.append((name, mount_point))
+    return subvolumes
+
+
+def is_ours(top_dir, subvolumes):
+    """ We only create our layout in a new filesystem (or in one that only has our subvolumes,
+        if we are trying again) """
+    names = set(name for (name, mount_point) in subvolumes)
+    return set(os.listdir(top_dir)) <= names
+
+
+def create(device, subvolumes):
+    """ Creates subvolumes in the (new) btrfs filesystem in device.
+        Returns False if the filesystem has other things (we leave it as it is) """
+    top_dir = tempfile.mkdtemp(prefix="thus-btrfs-")
+    try:
+        subprocess.check_call(['mount', '-t', 'btrfs', '-o', 'subvolid=%d' % TOP_LEVEL_SUBVOLID, device, top_dir])
+        try:
+            if not is_ours(top_dir, subvolumes):
+                logging.debug("%s is not empty, its btrfs subvolumes will not be created", device)
+                return False
+            for (name, mount_point) in subvolumes:
+                if os.path.exists(os.path.join(top_dir, name)):
+                    continue
+                subprocess.check_call(['btrfs', 'subvolume', 'create', os.path.join(top_dir, name)])
+                logging.debug("Created btrfs subvolume %s (for %s) in %s", name, mount_point, device)
+            return True
+        finally:
+            subprocess.check_call(['umount', top_dir])
+    finally:
+        os.rmdir(top_dir)
+
+
+def get_mount_options(options, name):
+    """ Adds the subvolume to mount options """
+    return "%s,subvol=%s" % (options, name)
+
+
+def mount(device, dest_dir, subvolumes, options):
+    """ Mounts subvolumes in dest_dir (root first) with options (compression should be there,
+        so our files are compressed while they are copied) """
+    for (name, mount_point) in subvolumes:
+        mount_dir = os.path.join(dest_dir, mount_point.lstrip('/'))
+        os.makedirs(mount_dir, exist_ok=True)
+        subprocess.check_call(['mount', '-t', 'btrfs', '-o', get_mount_options(options, name), device, mount_dir])
+
+
+def get_fstab_lines(uuid, subvolumes, options):
+    """ Returns the fstab lines of our subvolumes (but root's) """
+    lines = []
+    for (name, mount_point) in subvolumes:
+        if mount_point != '/':
+            lines.append("UUID=%s %s btrfs %s 0 0" % (uuid, mount_point, get_mount_options(options, name)))
+    return lines
+
+
+def add_grub_rootflags(default_grub):
+    """ Tells the kernel (through /etc/default/grub) that our root is the @ subvolume """
+    rootflags = "rootflags=subvol=%s" % ROOT_SUBVOLUME
+    with open(default_grub) as grub_file:
+        lines = [line.rstrip('\n') for line in grub_file]
+
+    for i, line in enumerate(lines):
+        if line.startswith('GRUB_CMDLINE_LINUX='):
+            value = line[len('GRUB_CMDLINE_LINUX='):].strip('"')
+            if rootflags not in value.split():
+                value = ("%s %s" % (value, rootflags)).strip()
+            lines[i] = 'GRUB_CMDLINE_LINUX="%s"' % value
+            break
+    else:
+        lines.append('GRUB_CMDLINE_LINUX="%s"' % rootflags)
+
+    with open(default_grub, 'w') as grub_file:
+        grub_file.write("\n".join(lines) + "\n")
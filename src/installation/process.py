@@ -34,12 +34,19 @@ import queue
 import shutil
 import subprocess
 import sys
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import encfs
 from installation import auto_partition
+from installation import btrfs_layout
 import parted3.fs_module as fs
+import parted3.block_info as block_info
+import parted3.fs_profiles as fs_profiles
+import parted3.mount_table as mount_table
 import canonical.misc as misc
+import os_prober_cache
 
 from configobj import ConfigObj
 
@@ -47,6 +54,21 @@ conf_file = '/etc/thus.conf'
 configuration = ConfigObj(conf_file)
 MHWD_SCRIPT = 'mhwd.sh'
 
+# enable_services adds ".service" to names without one of these
+SYSTEMD_UNIT_SUFFIXES = ('.service', '.socket', '.target', '.timer', '.path', '.mount')
+
+# Installed as /etc/udev/rules.d/60-ioschedulers.rules
+# NVMe drives do not need a scheduler, SSDs (and flash) a cheap one, rotational disks bfq
+IO_SCHEDULER_RULES_FILE = '60-ioschedulers.rules'
+IO_SCHEDULER_RULES = """# I/O schedulers for each kind of device (written by Thus)
+ACTION=="add|change", KERNEL=="nvme[0-9]*n[0-9]*", ATTR{queue/scheduler}="none"
+ACTION=="add|change", KERNEL=="sd[a-z]*|mmcblk[0-9]*|vd[a-z]*", ATTR{queue/rotational}=="0", ATTR{queue/scheduler}="mq-deadline"
+ACTION=="add|change", KERNEL=="sd[a-z]*|vd[a-z]*", ATTR{queue/rotational}=="1", ATTR{queue/scheduler}="bfq"
+"""
+
+# os-prober is not run by grub-mkconfig, it should not take long
+GRUB_MKCONFIG_TIMEOUT = 45
+
 ## BEGIN: RSYNC-based file copy support
 #CMD = 'unsquashfs -f -i -da 32 -fr 32 -d %(dest)s %(source)s'
 CMD = 'rsync -ar --progress %(source)s %(dest)s'
@@ -143,7 +165,7 @@ class InstallError(Exception):
 class InstallationProcess(multiprocessing.Process):
     """ Installation process thread class """
     def __init__(self, settings, callback_queue, mount_devices,
-                 fs_devices, ssd=None, alternate_package_list="", blvm=False):
+                 fs_devices, ssd=None, alternate_package_list="", blvm=False, deferred_mkfs=None):
         """ Initialize installation class """
         multiprocessing.Process.__init__(self)
 
@@ -158,7 +180,8 @@ class InstallationProcess(multiprocessing.Process):
                       'fs_devices': fs_devices,
                       'ssd': ssd,
                       'alternate_package_list': alternate_package_list,
-                      'blvm': blvm}
+                      'blvm': blvm,
+                      'deferred_mkfs': deferred_mkfs}
         self.settings.set('installer_thread_call', parameters)
 
         # This flag tells us if there is a lvm partition (from advanced install)
@@ -181,6 +204,16 @@ class InstallationProcess(multiprocessing.Process):
 
         self.fs_devices = fs_devices
 
+        # btrfs subvolumes we have created in our root filesystem (see btrfs_layout)
+        self.btrfs_subvolumes = []
+
+        # Filesystems that are created while we copy our system (see start_deferred_filesystems)
+        # Each one is a (device, fs_type, mount_point, label, mkfs options) tuple
+        self.deferred_mkfs = list(deferred_mkfs or [])
+        self.deferred_executor = None
+        self.deferred_futures = {}
+        self.auto = None
+
         self.running = True
         self.error = False
 
@@ -256,8 +289,12 @@ class InstallationProcess(multiprocessing.Process):
                                                     self.settings.get("use_lvm"),
                                                     self.settings.get("luks_key_pass"),
                                                     self.settings.get("use_home"),
-                                                    self.callback_queue)
+                                                    self.callback_queue,
+                                                    defer_home=True,
+                                                    root_fs=self.get_auto_root_fs())
                 auto.run()
+                self.auto = auto
+                self.deferred_mkfs = auto.deferred_jobs
 
                 # Get mount_devices and fs_devices
                 # (mount_devices will be used when configuring GRUB in modify_grub_default)
@@ -304,13 +341,18 @@ class InstallationProcess(multiprocessing.Process):
             try:
                 txt = _("Mounting partition %s into %s directory") % (root_partition, self.dest_dir)
                 self.queue_event('debug', txt)
-                subprocess.check_call(['mount', root_partition, self.dest_dir])
+                if self.fs_devices.get(root_partition) == 'btrfs':
+                    self.mount_btrfs_root(root_partition)
+                else:
+                    subprocess.check_call(['mount', '-o', self.get_mount_options(root_partition, '/'),
+                                           root_partition, self.dest_dir])
                 # We also mount the boot partition if it's needed
                 subprocess.check_call(['mkdir', '-p', '%s/boot' % self.dest_dir])
                 if "/boot" in self.mount_devices:
                     txt = _("Mounting partition %s into %s/boot directory") % (boot_partition, self.dest_dir)
                     self.queue_event('debug', txt)
-                    subprocess.check_call(['mount', boot_partition, "%s/boot" % self.dest_dir])
+                    subprocess.check_call(['mount', '-o', self.get_mount_options(boot_partition, '/boot'),
+                                           boot_partition, "%s/boot" % self.dest_dir])
             except subprocess.CalledProcessError as err:
                 txt = _("Couldn't mount root and boot partitions")
                 logging.error(txt)
@@ -327,6 +369,9 @@ class InstallationProcess(multiprocessing.Process):
                 # Ignore devices without a mount path (or they will be mounted at "self.dest_dir")
                 if path == "":
                     continue
+                # These will be mounted after copying our system
+                if self.is_deferred(path):
+                    continue
                 mount_part = self.mount_devices[path]
                 if mount_part != root_partition and mount_part != boot_partition and mount_part != swap_partition:
                     try:
@@ -335,7 +380,8 @@ class InstallationProcess(multiprocessing.Process):
                             os.makedirs(mount_dir)
                         txt = _("Mounting partition %s into %s directory") % (mount_part, mount_dir)
                         self.queue_event('debug', txt)
-                        subprocess.check_call(['mount', mount_part, mount_dir])
+                        subprocess.check_call(['mount', '-o', self.get_mount_options(mount_part, path),
+                                               mount_part, mount_dir])
                     except subprocess.CalledProcessError as err:
                         # We will continue as root and boot are already mounted
                         txt = _("Can't mount %s in %s") % (mount_part, mount_dir)
@@ -385,6 +431,8 @@ class InstallationProcess(multiprocessing.Process):
         all_ok = True
 
         try:
+            self.start_deferred_filesystems()
+
             self.queue_event('debug', _('Install System ...'))
             # very slow ...
             self.install_system()
@@ -392,6 +440,9 @@ class InstallationProcess(multiprocessing.Process):
             subprocess.check_call(['mkdir', '-p', '%s/var/log/' % self.dest_dir])
             self.queue_event('debug', _('System installed.'))
 
+            # Our configuration needs all our filesystems (users are created in /home)
+            self.finish_deferred_filesystems()
+
             self.queue_event('debug', _('Configuring system ...'))
             self.configure_system()
             self.queue_event('debug', _('System configured.'))
@@ -434,62 +485,141 @@ class InstallationProcess(multiprocessing.Process):
                 logging.warning(_("Can't copy Thus log to %s") % dst)
             except FileExistsError:
                 pass
-            # Unmount everything
+            # Unmount everything (children before their parents, btrfs subvolumes included)
             self.chroot_umount_special_dirs()
-            source_dirs = {"source", "source_desktop"}
-            for p in source_dirs:
-                p = os.path.join("/", p)
-                (fsname, fstype, writable) = misc.mount_info(p)
-                if fsname:
-                    try:
-                        txt = _("Unmounting %s") % p
-                        self.queue_event('debug', txt)
-                        subprocess.check_call(['umount', p])
-                    except subprocess.CalledProcessError as err:
-                        logging.error(err)
-                        try:
-                            subprocess.check_call(["umount", "-l", p])
-                        except subprocess.CalledProcessError as err:
-                            self.queue_event('warning', _("Can't unmount %s") % p)
-                            logging.warning(err)
             self.queue_event('debug', "Mounted devices: %s" % self.mount_devices)
-            for path in self.mount_devices:
-                mount_part = self.mount_devices[path]
-                mount_dir = self.dest_dir + path
-                if path != '/' and path != 'swap' and path != '':
-                    try:
-
-                        txt = _("Unmounting %s") % mount_dir
-                        self.queue_event('debug', txt)
-                        subprocess.check_call(['umount', mount_dir])
-                    except subprocess.CalledProcessError as err:
-                        logging.error(err)
-                        try:
-                            subprocess.check_call(["umount", "-l", mount_dir])
-                        except subprocess.CalledProcessError as err:
-                            # We will continue as root and boot are already mounted
-                            logging.warning(err)
-                            self.queue_event('debug', _("Can't unmount %s") % mount_dir)
-            # now we can unmount /install
-            (fsname, fstype, writable) = misc.mount_info(self.dest_dir)
-            if fsname:
-                try:
-                    txt = _("Unmounting %s") % self.dest_dir
-                    self.queue_event('debug', txt)
-                    subprocess.check_call(['umount', self.dest_dir])
-                except subprocess.CalledProcessError as err:
-                    logging.error(err)
-                    try:
-                        subprocess.check_call(["umount", "-l", self.dest_dir])
-                    except subprocess.CalledProcessError as err:
-                        logging.warning(err)
-                        self.queue_event('debug', _("Can't unmount %s") % p)
+            for mount_point in ["/source", "/source_desktop", self.dest_dir]:
+                for path in mount_table.unmount_tree(mount_point):
+                    self.queue_event('debug', _("Can't unmount %s") % path)
             # Installation finished successfully
             self.queue_event("finished", _("Installation finished successfully."))
             self.running = False
             self.error = False
             return True
 
+    def get_auto_root_fs(self):
+        """ Filesystem the automatic mode uses (the user may have chosen F2FS for a SD card or eMMC) """
+        if self.settings.get('use_f2fs'):
+            return "f2fs"
+        return "ext4"
+
+    def get_mount_options(self, device, mount_point):
+        """ Returns the mount options our filesystem profiles choose for device (see fs_profiles) """
+        fs_type = self.fs_devices.get(device, "")
+        ssd = None
+        if self.ssd is not None:
+            ssd = any(self.ssd[disk] for disk in self.ssd if disk in device)
+        return fs_profiles.get_mount_options(fs_type, device, mount_point, ssd)
+
+    def mount_btrfs_root(self, root_partition):
+        """ Mounts our btrfs root filesystem. A new one gets our subvolume layout (see btrfs_layout)
+            and all of them are mounted with compression, so our files are compressed while being copied """
+        options = self.get_mount_options(root_partition, '/')
+        subvolumes = btrfs_layout.get_subvolumes(self.mount_devices.keys())
+        if btrfs_layout.create(root_partition, subvolumes):
+            self.btrfs_subvolumes = subvolumes
+            btrfs_layout.mount(root_partition, self.dest_dir, subvolumes, options)
+        else:
+            subprocess.check_call(['mount', '-o', options, root_partition, self.dest_dir])
+
+    def is_deferred(self, mount_point):
+        """ Tells if mount_point will be mounted after copying our system """
+        for (device, fs_type, deferred_mount_point, label, opts) in self.deferred_mkfs:
+            if mount_point == deferred_mount_point or mount_point.startswith(deferred_mount_point + "/"):
+                return True
+        return False
+
+    def format_deferred(self, device, fs_type, mount_point, label, opts):
+        """ Creates a deferred filesystem. Returns None if everything went fine, an error message otherwise """
+        if self.auto is not None:
+            return self.auto.format(device, fs_type, label, opts, mount_point=mount_point)
+        (error, msg) = fs.create_fs(device, fs_type, label, opts, mount_point)
+        if error == 0:
+            logging.info(msg)
+            return None
+        logging.error(msg)
+        return _("Couldn't format partition '%s' with label '%s' as '%s'") % (device, label, fs_type)
+
+    def start_deferred_filesystems(self):
+        """ Starts creating the filesystems we don't need to copy our system (/home) """
+        if not self.deferred_mkfs:
+            return
+        workers = min(len(self.deferred_mkfs), fs.MAX_MKFS_JOBS)
+        self.deferred_executor = ThreadPoolExecutor(max_workers=workers)
+        self.deferred_futures = {}
+        for (device, fs_type, mount_point, label, opts) in self.deferred_mkfs:
+            txt = _("Creating %s filesystem in %s while the system is being copied") % (fs_type, device)
+            self.queue_event('debug', txt)
+            self.deferred_futures[device] = self.deferred_executor.submit(self.format_deferred, device,
+                                                                          fs_type, mount_point, label, opts)
+
+    def finish_deferred_filesystems(self):
+        """ Waits until our deferred filesystems are created and mounts them
+            (and the partitions that must be mounted inside them) """
+        if not self.deferred_mkfs:
+            return
+
+        self.queue_event('info', _("Waiting for the remaining filesystems to be created..."))
+        self.deferred_executor.shutdown(wait=True)
+
+        # (mount point, device, fs type, created by us)
+        mounts = []
+        for (device, fs_type, mount_point, label, opts) in self.deferred_mkfs:
+            txt = self.deferred_futures[device].result()
+            if txt is None:
+                mounts.append((mount_point, device, fs_type, True))
+            else:
+                logging.error(txt)
+                self.queue_event('warning', txt)
+
+        if self.auto is None:
+            formatted = [job[0] for job in self.deferred_mkfs]
+            for path in self.mount_devices:
+                mount_part = self.mount_devices[path]
+                if path not in ("", "swap") and self.is_deferred(path) and mount_part not in formatted:
+                    mounts.append((path, mount_part, None, False))
+
+        # Parents first
+        for (mount_point, device, fs_type, created) in sorted(mounts):
+            if created:
+                self.move_to_new_filesystem(device, mount_point)
+            if self.auto is not None:
+                self.auto.mount(device, fs_type, mount_point)
+            else:
+                mount_dir = self.dest_dir + mount_point
+                if not os.path.exists(mount_dir):
+                    os.makedirs(mount_dir)
+                txt = _("Mounting partition %s into %s directory") % (device, mount_dir)
+                self.queue_event('debug', txt)
+                subprocess.check_call(['mount', '-o', self.get_mount_options(device, mount_point), device, mount_dir])
+
+        self.deferred_mkfs = []
+
+    def move_to_new_filesystem(self, device, mount_point):
+        """ Our system copy may have put some files where a deferred filesystem will be mounted.
+            Move them to the new filesystem so they are not hidden under it """
+        mount_dir = self.dest_dir + mount_point
+        if not os.path.isdir(mount_dir) or not os.listdir(mount_dir):
+            return
+
+        logging.debug(_("Moving %s contents to %s"), mount_dir, device)
+        tmp_dir = tempfile.mkdtemp(prefix="thus-")
+        try:
+            subprocess.check_call(['mount', device, tmp_dir])
+            try:
+                subprocess.check_call(['cp', '-a', mount_dir + '/.', tmp_dir])
+            finally:
+                subprocess.check_call(['umount', tmp_dir])
+        finally:
+            os.rmdir(tmp_dir)
+
+        for name in os.listdir(mount_dir):
+            path = os.path.join(mount_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
     def get_cpu(self):
         # Check if system is an intel system. Not sure if we want to move this to hardware module when its done.
         process1 = subprocess.Popen(["hwinfo", "--cpu"], stdout=subprocess.PIPE)
@@ -499,16 +629,6 @@ class InstallationProcess(multiprocessing.Process):
         out, err = process2.communicate()
         return out.decode().lower()
 
-    def check_source_folder(self, mount_point):
-        """ Check if source folders are mounted """
-        device = None
-        with open('/proc/mounts', 'r') as fp:
-            for line in fp:
-                line = line.split()
-                if line[1] == mount_point:
-                    device = line[0]
-        return device
-
     def install_system(self):
         """ Copies all files to target """
         # mount the media location.
@@ -529,19 +649,14 @@ class InstallationProcess(multiprocessing.Process):
                 logging.error(txt)
                 self.queue_fatal_event(txt)
 
-            # Mount the installation media
-            mount_point = "/source"
-            device = self.check_source_folder(mount_point)
-            if device is None:
-                subprocess.check_call(["mount", self.media, mount_point, "-t", self.media_type, "-o", "loop"])
-            else:
-                logging.warning(_("%s is already mounted at %s as %s") % (self.media, mount_point, device))
-            mount_point = "/source_desktop"
-            device = self.check_source_folder(mount_point)
-            if device is None:
-                subprocess.check_call(["mount", self.media_desktop, mount_point, "-t", self.media_type, "-o", "loop"])
-            else:
-                logging.warning(_("%s is already mounted at %s as %s") % (self.media_desktop, mount_point, device))
+            # Mount the installation media (if they are not mounted yet)
+            mounts = mount_table.MountTable()
+            for (media, mount_point) in [(self.media, "/source"), (self.media_desktop, "/source_desktop")]:
+                mount = mounts.get(mount_point)
+                if mount is None:
+                    subprocess.check_call(["mount", media, mount_point, "-t", self.media_type, "-o", "loop"])
+                else:
+                    logging.warning(_("%s is already mounted at %s as %s") % (media, mount_point, mount.source))
 
             # walk root filesystem
             SOURCE = "/source/"
@@ -635,28 +750,12 @@ class InstallationProcess(multiprocessing.Process):
             self.queue_event('debug', _("Special dirs are not mounted. Skipping."))
             return
 
-        if self.settings.get('efi'):
-            special_dirs = ["dev/pts", "sys/firmware/efi", "sys", "proc", "dev"]
-        else:
-            special_dirs = ["dev/pts", "sys", "proc", "dev"]
-
-        for s_dir in special_dirs:
+        # dev/pts and sys/firmware/efi are unmounted before dev and sys
+        mounts = mount_table.MountTable()
+        for s_dir in ["sys", "proc", "dev"]:
             mydir = os.path.join(self.dest_dir, s_dir)
-            try:
-                subprocess.check_call(["umount", mydir])
-            except subprocess.CalledProcessError as err:
-                logging.error(err)
-                try:
-                    subprocess.check_call(["umount", "-l", mydir])
-                except subprocess.CalledProcessError as err:
-                    self.queue_event('warning', _("Unable to umount %s") % mydir)
-                    cmd = _("Command %s has failed.") % err.cmd
-                    logging.warning(cmd)
-                    out = _("Output : %s") % err.output
-                    logging.warning(out)
-            except Exception as err:
-                self.queue_event('warning', _("Unable to umount %s") % mydir)
-                logging.error(err)
+            for path in mount_table.unmount_tree(mydir, mounts):
+                self.queue_event('warning', _("Unable to umount %s") % path)
 
         self.special_dirs_mounted = False
 
@@ -681,6 +780,9 @@ class InstallationProcess(multiprocessing.Process):
             raise
         except subprocess.TimeoutExpired as err:
             logging.exception(_("Timeout running command: %s"), run)
+            # Do not leave it running while we go on (and unmount its chroot)
+            proc.kill()
+            proc.communicate()
             raise
 
     def is_running(self):
@@ -728,6 +830,12 @@ class InstallationProcess(multiprocessing.Process):
 
         root_ssd = 0
 
+        # Devices that support TRIM, they will be trimmed periodically (see configure_system)
+        self.trim_devices = []
+
+        # Partitions may have been formatted since blkid was last run
+        fs.refresh_info()
+
         for path in self.mount_devices:
             opts = 'defaults'
             chk = '0'
@@ -746,6 +854,16 @@ class InstallationProcess(multiprocessing.Process):
                 logging.debug(_("Added to fstab : UUID=%s %s %s %s 0 %s"), uuid, path, myfmt, opts, chk)
                 continue
 
+            # The user may have told us which disks are SSDs, otherwise ask sysfs
+            info = block_info.read(parti)
+            if self.ssd is not None:
+                is_ssd = any(self.ssd[i] for i in self.ssd if i in parti)
+            else:
+                is_ssd = info is not None and info.is_ssd()
+
+            # Our filesystem profiles choose the options (see fs_profiles)
+            opts = fs_profiles.get_mount_options(myfmt, parti, path, is_ssd)
+
             # Fix for home + luks, no lvm
             if "/home" in path and self.settings.get("use_luks") and not self.settings.get("use_lvm"):
                 # Modify the crypttab file
@@ -778,34 +896,35 @@ class InstallationProcess(multiprocessing.Process):
                 # We do not run fsck on btrfs partitions
                 if "btrfs" in myfmt:
                     chk = '0'
-                    opts = 'rw,relatime,space_cache,autodefrag,inode_cache'
-                elif "ext4" in myfmt:
-                    chk = '1'
-                    opts = "rw,relatime,data=ordered"
                 else:
                     chk = '1'
-                    opts = "rw,relatime"
+                # mkinitcpio needs to know (see run_mkinitcpio)
+                if "f2fs" in myfmt:
+                    self.settings.set('f2fs', True)
             else:
                 full_path = os.path.join(self.dest_dir, path)
                 subprocess.check_call(["mkdir", "-p", full_path])
 
-            if self.ssd is not None:
-                for i in self.ssd:
-                    if i in self.mount_devices[path] and self.ssd[i]:
-                        opts = 'defaults,noatime'
-                        # As of linux kernel version 3.7, the following
-                        # filesystems support TRIM: ext4, btrfs, JFS, and XFS.
-                        # If using a TRIM supported SSD, discard is a valid mount option for swap
-                        if myfmt == 'ext4' or myfmt == 'jfs' or myfmt == 'xfs' or myfmt == 'swap':
-                            opts += ',discard'
-                        elif myfmt == 'btrfs':
-                            opts = 'rw,noatime,compress=lzo,ssd,discard,space_cache,autodefrag,inode_cache'
-                        if path == '/':
-                            root_ssd = 1
+            # We do not use continuous discard (it slows down many drives), fstrim.timer trims them once a week
+            if info is not None and info.supports_discard():
+                self.trim_devices.append(parti)
+
+            if is_ssd and path == '/':
+                root_ssd = 1
+
+            # Our btrfs subvolumes use root's filesystem
+            subvolume_lines = []
+            if path == '/' and self.btrfs_subvolumes:
+                subvolume_lines = btrfs_layout.get_fstab_lines(uuid, self.btrfs_subvolumes, opts)
+                opts = btrfs_layout.get_mount_options(opts, btrfs_layout.ROOT_SUBVOLUME)
 
             all_lines.append("UUID=%s %s %s %s 0 %s" % (uuid, path, myfmt, opts, chk))
             logging.debug(_("Added to fstab : UUID=%s %s %s %s 0 %s"), uuid, path, myfmt, opts, chk)
 
+            for line in subvolume_lines:
+                all_lines.append(line)
+                logging.debug(_("Added to fstab : %s"), line)
+
         if root_ssd:
             all_lines.append("tmpfs /tmp tmpfs defaults,noatime,mode=1777 0 0")
             logging.debug(_("Added to fstab : tmpfs /tmp tmpfs defaults,noatime,mode=1777 0 0"))
@@ -900,6 +1019,9 @@ class InstallationProcess(multiprocessing.Process):
         #    grub_file.write("\n# See bug https://bugs.archlinux.org/task/37904\n")
         #    grub_file.write("GRUB_DISABLE_SUBMENU=y\n\n")
 
+        if self.btrfs_subvolumes:
+            btrfs_layout.add_grub_rootflags(default_grub)
+
         logging.debug('/etc/default/grub configuration completed successfully.')
 
     def prepare_grub_d(self):
@@ -917,6 +1039,35 @@ class InstallationProcess(multiprocessing.Process):
         except FileExistsError:
             pass
 
+    def run_grub_mkconfig(self, efi):
+        """ Generates grub.cfg. Other OSes come from the os-prober results we already have
+            (see os_prober_cache), os-prober is not run again inside the chroot """
+        try:
+            os_prober_cache.write_grub_snippet(self.dest_dir, set(self.mount_devices.values()), efi)
+        except (IOError, OSError) as err:
+            logging.warning(_("Can't add other operating systems to the boot menu: %s"), err)
+
+        # grub-mkconfig reads /etc/default/grub after our environment, so os-prober
+        # is disabled there (just for this run)
+        default_grub = os.path.join(self.dest_dir, "etc/default/grub")
+        with open(default_grub) as grub_file:
+            default_grub_text = grub_file.read()
+        with open(default_grub, 'a') as grub_file:
+            grub_file.write("\nGRUB_DISABLE_OS_PROBER=true\n")
+
+        locale = self.settings.get("locale")
+        try:
+            self.chroot(['sh', '-c', 'LANG=%s GRUB_DISABLE_OS_PROBER=true grub-mkconfig -o /boot/grub/grub.cfg' % locale],
+                        GRUB_MKCONFIG_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.error(_("grub-mkconfig has not finished in %d seconds"), GRUB_MKCONFIG_TIMEOUT)
+            # Its children (grub-mount holds our partitions) may still be running
+            for name in ["grub-mkconfig", "os-prober", "grub-mount"]:
+                subprocess.call(["killall", name], stderr=subprocess.DEVNULL)
+        finally:
+            with open(default_grub, 'w') as grub_file:
+                grub_file.write(default_grub_text)
+
     def install_bootloader_grub2_bios(self):
         """ Install boot loader in a BIOS system """
         grub_location = self.settings.get('bootloader_location')
@@ -936,13 +1087,7 @@ class InstallationProcess(multiprocessing.Process):
 
         self.install_bootloader_grub2_locales()
 
-        locale = self.settings.get("locale")
-        try:
-            self.chroot(['sh', '-c', 'LANG=%s grub-mkconfig -o /boot/grub/grub.cfg' % locale], 45)
-        except subprocess.TimeoutExpired:
-            logging.error(_("grub-mkconfig appears to be hung. Killing grub-mount and os-prober so we can continue."))
-            os.system("killall grub-mount")
-            os.system("killall os-prober")
+        self.run_grub_mkconfig(efi=False)
 
         self.chroot_umount_special_dirs()
 
@@ -1024,13 +1169,7 @@ class InstallationProcess(multiprocessing.Process):
         self.queue_event('info', _("Generating grub.cfg"))
         self.chroot_mount_special_dirs()
 
-        locale = self.settings.get("locale")
-        try:
-            self.chroot(['sh', '-c', 'LANG=%s grub-mkconfig -o /boot/grub/grub.cfg' % locale], 45)
-        except subprocess.TimeoutExpired:
-            logging.error(_("grub-mkconfig appears to be hung. Killing grub-mount and os-prober so we can continue."))
-            os.system("killall grub-mount")
-            os.system("killall os-prober")
+        self.run_grub_mkconfig(efi=True)
 
         self.chroot_umount_special_dirs()
 
@@ -1064,24 +1203,15 @@ class InstallationProcess(multiprocessing.Process):
         if not os.path.exists("/usr/bin/xfs_freeze"):
             return
 
-        xfs_boot = False
-        xfs_root = False
-
         try:
             subprocess.check_call(["sync"])
-            with open("/proc/mounts", "r") as mounts_file:
-                mounts = mounts_file.readlines()
-            # We leave a blank space in the end as we want to search exactly for this mount points
-            boot_mount_point = self.dest_dir + "/boot "
-            root_mount_point = self.dest_dir + " "
-            for line in mounts:
-                if " xfs " in line:
-                    if boot_mount_point in line:
-                        xfs_boot = True
-                    elif root_mount_point in line:
-                        xfs_root = True
+            mounts = mount_table.MountTable()
+            boot_mount_point = self.dest_dir + "/boot"
+            boot = mounts.get(boot_mount_point)
+            root = mounts.get(self.dest_dir)
+            xfs_boot = boot is not None and boot.fs_type == "xfs"
+            xfs_root = root is not None and root.fs_type == "xfs"
             if xfs_boot:
-                boot_mount_point = boot_mount_point.rstrip()
                 subprocess.check_call(["/usr/bin/xfs_freeze", "-f", boot_mount_point])
                 subprocess.check_call(["/usr/bin/xfs_freeze", "-u", boot_mount_point])
             if xfs_root:
@@ -1093,9 +1223,19 @@ class InstallationProcess(multiprocessing.Process):
     def enable_services(self, services):
         """ Enables all services that are in the list 'services' """
         for name in services:
-            self.chroot(['systemctl', 'enable', name + ".service"])
+            if not name.endswith(SYSTEMD_UNIT_SUFFIXES):
+                name += ".service"
+            self.chroot(['systemctl', 'enable', name])
             self.queue_event('debug', _('Enabled %s service.') % name)
 
+    def write_io_scheduler_rules(self):
+        """ Installs an udev rule that chooses each device's I/O scheduler """
+        rules_dir = os.path.join(self.dest_dir, "etc/udev/rules.d")
+        os.makedirs(rules_dir, exist_ok=True)
+        with open(os.path.join(rules_dir, IO_SCHEDULER_RULES_FILE), 'w') as rules_file:
+            rules_file.write(IO_SCHEDULER_RULES)
+        self.queue_event('debug', _('I/O scheduler rules written.'))
+
     def change_user_password(self, user, new_password):
         """ Changes the user's password """
         try:
@@ -1172,6 +1312,10 @@ class InstallationProcess(multiprocessing.Process):
         else:
             hooks.extend(["filesystems"])
 
+        # F2FS is not in the fallback image modules list, and its checksums need crc32
+        if self.settings.get('f2fs'):
+            modules.extend(["f2fs", "crc32_generic"])
+
         if self.settings.get('btrfs') and cpu is not 'genuineintel':
             modules.append('crc32c')
         elif self.settings.get('btrfs') and cpu is 'genuineintel':
@@ -1321,6 +1465,11 @@ class InstallationProcess(multiprocessing.Process):
         self.auto_fstab()
         self.queue_event('debug', _('fstab file generated.'))
 
+        if self.trim_devices:
+            logging.debug("%s support TRIM", ", ".join(self.trim_devices))
+            self.enable_services(['fstrim.timer'])
+        self.write_io_scheduler_rules()
+
         # Copy configured networks in Live medium to target system
         if self.network_manager == 'NetworkManager':
             self.copy_network_config()
@@ -1340,9 +1489,7 @@ class InstallationProcess(multiprocessing.Process):
         self.queue_event('debug', 'Enabled installed services.')
 
         # Wait FOREVER until the user sets the timezone
-        while self.settings.get('timezone_done') is False:
-            # wait five seconds and try again
-            time.sleep(5)
+        self.settings.wait_for('timezone_done', True)
 
         if self.settings.get("use_ntp"):
             self.enable_services(["ntpd"])
@@ -1354,9 +1501,7 @@ class InstallationProcess(multiprocessing.Process):
         self.queue_event('debug', _('Time zone set.'))
 
         # Wait FOREVER until the user sets his params
-        while self.settings.get('user_info_done') is False:
-            # wait five seconds and try again
-            time.sleep(5)
+        self.settings.wait_for('user_info_done', True)
 
         # Set user parameters
         username = self.settings.get('username')
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  os_prober_cache.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Runs os-prober (just once) and turns what it finds into GRUB menu entries,
+    so grub-mkconfig does not have to run it again """
+
+from collections import namedtuple
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import parted3.fs_module as fs
+
+# Shared by the installer UI and the installation process
+CACHE_FILE = '/var/cache/thus/os-prober.json'
+
+# Installed in /etc/grub.d, after 30_os-prober
+GRUB_D_SNIPPET = '31_thus_os_prober'
+
+# os-prober can take a while with many disks (it mounts every partition)
+OS_PROBER_TIMEOUT = 300
+
+# How long the installation process waits for the installer UI to save os-prober results
+SAVED_RESULTS_TIMEOUT = 60
+
+# Filesystem (as blkid names them) to GRUB module
+GRUB_FS_MODULES = {'ntfs': 'ntfs',
+                   'vfat': 'fat',
+                   'ext2': 'ext2',
+                   'ext3': 'ext2',
+                   'ext4': 'ext2',
+                   'btrfs': 'btrfs',
+                   'xfs': 'xfs',
+                   'f2fs': 'f2fs',
+                   'jfs': 'jfs',
+                   'reiserfs': 'reiserfs'}
+
+# Windows versions that do not need drivemap to boot from another disk (as 30_os-prober does)
+NO_DRIVEMAP = ['Windows Vista', 'Windows 7', 'Windows Server 2008']
+
+# device can be /dev/sda2@/EFI/Microsoft/Boot/bootmgfw.efi (EFI loaders).
+# kernels are Kernel tuples (only for linux entries)
+OSEntry = namedtuple('OSEntry', 'device long_name short_name type uuid fs_type kernels')
+Kernel = namedtuple('Kernel', 'boot_device label kernel initrd params boot_uuid boot_fs_type')
+
+_entries = None
+# Incremented by forget, results of a probe started before are thrown away
+_generation = 0
+# Protects _entries and _generation. It is never held while os-prober runs
+_entries_lock = threading.Lock()
+# Only one os-prober run at a time
+_probe_lock = threading.Lock()
+
+
+def get_partition(device):
+    """ Removes the EFI loader path from an os-prober device """
+    return device.split('@')[0]
+
+
+def get_fs_info(device):
+    """ Returns (uuid, filesystem) of device as blkid sees it now """
+    info = fs.get_all_info([device]).get(device, {})
+    return (info.get('UUID', ''), info.get('TYPE', ''))
+
+
+def run(command):
+    """ Runs a prober, returns its output lines """
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.DEVNULL, timeout=OS_PROBER_TIMEOUT)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+        logging.warning(_("Error running %s: %s"), command[0], err)
+        return []
+    return [line for line in output.decode(errors='replace').splitlines() if line.strip()]
+
+
+def probe_kernels(device):
+    """ Asks linux-boot-prober for the kernels of the Linux installed in device """
+    kernels = []
+    for line in run(['linux-boot-prober', device]):
+        # root:boot:label:kernel:initrd:parameters (parameters may have colons)
+        fields = line.split(':', 5)
+        if len(fields) < 6:
+            continue
+        (boot_uuid, boot_fs_type) = get_fs_info(fields[1])
+        kernels.append(Kernel(fields[1], fields[2], fields[3], fields[4], fields[5], boot_uuid, boot_fs_type))
+    return kernels
+
+
+def probe():
+    """ Runs os-prober (and linux-boot-prober for each Linux it finds) """
+    entries = []
+    for line in run(['os-prober']):
+        # device:long name:short name:type
+        fields = line.split(':')
+        if len(fields) < 4:
+            continue
+        (device, long_name, short_name, os_type) = fields[:4]
+        (uuid, fs_type) = get_fs_info(get_partition(device))
+        kernels = probe_kernels(device) if os_type == 'linux' else []
+        entries.append(OSEntry(device, long_name, short_name, os_type, uuid, fs_type, kernels))
+    return entries
+
+
+def save(entries):
+    data = []
+    for entry in entries:
+        entry_dict = entry._asdict()
+        entry_dict['kernels'] = [kernel._asdict() for kernel in entry.kernels]
+        data.append(entry_dict)
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        # Readers (the installation process) never see half a file
+        tmp_file = CACHE_FILE + ".tmp"
+        with open(tmp_file, 'w') as cache_file:
+            json.dump(data, cache_file)
+        os.replace(tmp_file, CACHE_FILE)
+    except (IOError, OSError) as err:
+        logging.warning(_("Can't save os-prober results in %s: %s"), CACHE_FILE, err)
+
+
+def load():
+    """ Returns the saved os-prober results, None if there are none """
+    if not os.path.exists(CACHE_FILE):
+        return None
+    try:
+        with open(CACHE_FILE) as cache_file:
+            entries = []
+            for entry in json.load(cache_file):
+                entry['kernels'] = [Kernel(**kernel) for kernel in entry['kernels']]
+                entries.append(OSEntry(**entry))
+            return entries
+    except (IOError, OSError, ValueError, TypeError, KeyError) as err:
+        logging.warning(_("Can't read os-prober results from %s: %s"), CACHE_FILE, err)
+        return None
+
+
+def get_entries(run_probe=None):
+    """ Returns what os-prober finds. It is only run once (its results are saved in CACHE_FILE).
+        Only the installer UI runs it, the installation process uses get_saved_entries.
+        run_probe (probe by default) runs os-prober, i.e. in a privileged child process """
+    if run_probe is None:
+        run_probe = probe
+    global _entries
+    with _probe_lock:
+        with _entries_lock:
+            if _entries is not None:
+                return _entries
+            generation = _generation
+
+        entries = load()
+        if entries is None:
+            entries = run_probe()
+
+        with _entries_lock:
+            # Our devices may have changed while os-prober was running
+            if generation == _generation:
+                _entries = entries
+                save(entries)
+        return entries
+
+
+def get_saved_entries(timeout=SAVED_RESULTS_TIMEOUT):
+    """ Returns the results saved by the installer UI, waiting for them if os-prober is still running.
+        It never runs os-prober (the installation process may be partitioning our disks) """
+    deadline = time.time() + timeout
+    entries = load()
+    while entries is None and time.time() < deadline:
+        time.sleep(1)
+        entries = load()
+    if entries is None:
+        logging.warning(_("os-prober results are not ready, other operating systems will not be in the boot menu"))
+        return []
+    return entries
+
+
+def forget():
+    """ Forget os-prober results (our devices have changed). It does not wait for a running os-prober,
+        its results will be thrown away """
+    global _entries
+    global _generation
+    with _entries_lock:
+        _entries = None
+        _generation += 1
+        try:
+            os.remove(CACHE_FILE)
+        except OSError:
+            pass
+
+
+def grub_quote(text):
+    """ Quotes text for grub.cfg """
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+def get_grub_insmods(fs_type):
+    lines = ["\tinsmod part_gpt", "\tinsmod part_msdos"]
+    if fs_type in GRUB_FS_MODULES:
+        lines.append("\tinsmod %s" % GRUB_FS_MODULES[fs_type])
+    return lines
+
+
+def get_chain_entry(entry):
+    """ Chainloads a BIOS boot loader (Windows, another GRUB...) """
+    lines = ["menuentry %s --class windows --class os {" % grub_quote("%s (on %s)" % (entry.long_name, entry.device))]
+    lines += get_grub_insmods(entry.fs_type)
+    lines.append("\tsearch --no-floppy --fs-uuid --set=root %s" % entry.uuid)
+    if not any(entry.long_name.startswith(name) for name in NO_DRIVEMAP):
+        lines.append("\tdrivemap -s (hd0) ${root}")
+    lines.append("\tchainloader +1")
+    lines.append("}")
+    return lines
+
+
+def get_efi_entry(entry):
+    """ Chainloads an EFI boot loader """
+    (partition, loader) = entry.device.split('@', 1)
+    lines = ["menuentry %s --class windows --class os {" % grub_quote("%s (on %s)" % (entry.long_name, partition))]
+    lines += get_grub_insmods(entry.fs_type)
+    lines.append("\tsearch --no-floppy --fs-uuid --set=root %s" % entry.uuid)
+    lines.append("\tchainloader %s" % loader)
+    lines.append("}")
+    return lines
+
+
+def get_linux_entries(entry):
+    """ Boots each kernel found by linux-boot-prober directly """
+    lines = []
+    for kernel in entry.kernels:
+        if not kernel.boot_uuid:
+            continue
+        label = kernel.label or entry.long_name
+        title = "%s (on %s)" % (label, entry.device)
+        lines.append("menuentry %s --class gnu-linux --class gnu --class os {" % grub_quote(title))
+        lines += get_grub_insmods(kernel.boot_fs_type)
+        lines.append("\tsearch --no-floppy --fs-uuid --set=root %s" % kernel.boot_uuid)
+        lines.append("\tlinux %s %s" % (kernel.kernel, kernel.params))
+        if kernel.initrd:
+            lines.append("\tinitrd %s" % kernel.initrd)
+        lines.append("}")
+    return lines
+
+
+def get_menu_entries(entries, exclude, efi):
+    """ Returns GRUB menu entries for the OSes in entries. Partitions in exclude (our own ones)
+        and the ones that have been formatted since os-prober saw them are left out """
+    lines = []
+    for entry in entries:
+        partition = get_partition(entry.device)
+        if partition in exclude or not entry.uuid:
+            continue
+        if get_fs_info(partition)[0] != entry.uuid:
+            logging.debug("%s is not there anymore, no boot entry for %s", partition, entry.long_name)
+            continue
+        if entry.type == 'chain' and not efi:
+            lines += get_chain_entry(entry)
+        elif entry.type == 'efi' and efi:
+            lines += get_efi_entry(entry)
+        elif entry.type == 'linux':
+            lines += get_linux_entries(entry)
+        else:
+            logging.debug("No boot entry for %s (%s)", entry.long_name, entry.type)
+    return lines
+
+
+def write_grub_snippet(dest_dir, exclude, efi):
+    """ Writes our menu entries as an /etc/grub.d script of the installed system.
+        It does nothing when grub-mkconfig runs os-prober itself (i.e. later, in the installed system) """
+    menu_entries = get_menu_entries(get_saved_entries(), exclude, efi)
+    path = os.path.join(dest_dir, "etc/grub.d", GRUB_D_SNIPPET)
+    with open(path, 'w') as snippet:
+        snippet.write("#!/bin/sh\n")
+        snippet.write("# Other operating systems, as os-prober found them while installing (written by Thus).\n")
+        snippet.write("# 30_os-prober finds them itself when os-prober is enabled.\n")
+        snippet.write('if [ "x${GRUB_DISABLE_OS_PROBER}" != "xtrue" ] && command -v os-prober > /dev/null 2>&1; then\n')
+        snippet.write("    exit 0\n")
+        snippet.write("fi\n")
+        if menu_entries:
+            snippet.write("cat << 'EOF'\n")
+            snippet.write("\n".join(menu_entries) + "\n")
+            snippet.write("EOF\n")
+    os.chmod(path, 0o755)
+    logging.debug("%d boot entries for other operating systems written to %s", len(menu_entries), path)
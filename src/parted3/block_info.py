@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  block_info.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Reads block devices' queue characteristics (rotational, discard, io sizes) from sysfs """
+
+from collections import namedtuple
+from math import gcd
+import os
+
+SYS_BLOCK = "/sys/block"
+SYS_CLASS_BLOCK = "/sys/class/block"
+
+# sysfs always counts 512 bytes sectors
+SYSFS_SECTOR_SIZE = 512
+
+# Partitions are aligned to 1MiB at least (as everybody does)
+MIN_ALIGNMENT = 1024 * 1024
+
+# Some USB bridges report bogus optimal io sizes, we ignore anything bigger than this
+MAX_ALIGNMENT = 64 * 1024 * 1024
+
+QUEUE_ATTRIBUTES = ['rotational', 'discard_granularity', 'discard_max_bytes', 'logical_block_size',
+                    'physical_block_size', 'minimum_io_size', 'optimal_io_size']
+
+
+class BlockInfo(namedtuple('BlockInfo', ['path', 'size'] + QUEUE_ATTRIBUTES)):
+    """ Characteristics of a block device. Sizes are in bytes """
+    __slots__ = ()
+
+    def is_ssd(self):
+        """ Non rotational devices are SSDs (or flash memory, or NVMe, or...) """
+        return not self.rotational
+
+    def supports_discard(self):
+        """ TRIM/discard is supported """
+        return self.discard_max_bytes > 0
+
+    def alignment(self):
+        """ Partitions should start (and end) at multiples of this size """
+        align = lcm(MIN_ALIGNMENT, self.physical_block_size)
+        if self.optimal_io_size > 0 and self.optimal_io_size % self.physical_block_size == 0:
+            optimal_align = lcm(align, self.optimal_io_size)
+            if optimal_align <= MAX_ALIGNMENT:
+                align = optimal_align
+        return align
+
+    def stripe(self):
+        """ Returns RAID geometry as (stripe unit, stripe width) or None if this is not a striped device.
+            md, dm and most hardware RAID report their chunk size as minimum io size
+            and a full stripe as optimal io size """
+        unit = self.minimum_io_size
+        width = self.optimal_io_size
+        if unit <= self.physical_block_size or width <= unit or width % unit != 0:
+            return None
+        if width > MAX_ALIGNMENT:
+            return None
+        return (unit, width)
+
+
+def lcm(a, b):
+    """ Least common multiple """
+    return a * b // gcd(a, b)
+
+
+def read_attribute(path, default=0):
+    """ Reads a numeric sysfs attribute """
+    try:
+        with open(path) as sys_file:
+            return int(sys_file.read().strip())
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def get_queue_path(name):
+    """ Returns the queue directory of a device. Partitions use their disk's queue """
+    sys_path = os.path.realpath(os.path.join(SYS_CLASS_BLOCK, name))
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        sys_path = os.path.dirname(sys_path)
+    return os.path.join(sys_path, "queue")
+
+
+def read(device):
+    """ Returns a BlockInfo for device (/dev/sda, /dev/sda1, /dev/mapper/...). None if it does not exist """
+    name = os.path.basename(os.path.realpath(device))
+    sys_path = os.path.join(SYS_CLASS_BLOCK, name)
+    if not os.path.exists(sys_path):
+        return None
+
+    queue_path = get_queue_path(name)
+    values = {}
+    for attribute in QUEUE_ATTRIBUTES:
+        values[attribute] = read_attribute(os.path.join(queue_path, attribute))
+
+    # Assume a rotational disk if we can't tell
+    if not os.path.exists(os.path.join(queue_path, "rotational")):
+        values['rotational'] = 1
+    if values['logical_block_size'] == 0:
+        values['logical_block_size'] = SYSFS_SECTOR_SIZE
+    if values['physical_block_size'] == 0:
+        values['physical_block_size'] = values['logical_block_size']
+
+    values['rotational'] = values['rotational'] == 1
+    size = read_attribute(os.path.join(sys_path, "size")) * SYSFS_SECTOR_SIZE
+
+    return BlockInfo(path="/dev/" + name, size=size, **values)
+
+
+def read_all():
+    """ Returns a dict with the BlockInfo of all our disks """
+    disks = {}
+    if os.path.exists(SYS_BLOCK):
+        for name in sorted(os.listdir(SYS_BLOCK)):
+            info = read(name)
+            if info is not None:
+                disks[info.path] = info
+    return disks
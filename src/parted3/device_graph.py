@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  device_graph.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Graph of all our block devices (disks, partitions, LUKS mappings and LVM volumes)
+
+    It's built once reading sysfs, running blkid and asking lvm for a report.
+    After that, it's kept up to date listening to kernel uevents. """
+
+import errno
+import logging
+import os
+import socket
+import threading
+
+import parted3.block_info as block_info
+import parted3.fs_module as fs
+import parted3.lvm as lvm
+import parted3.mount_table as mount_table
+
+SYS_BLOCK = "/sys/class/block"
+
+# Netlink protocol used by the kernel to send uevents (see linux/netlink.h)
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_BUFFER_SIZE = 64 * 1024
+
+# Device kinds
+DISK = 'disk'
+PARTITION = 'part'
+CRYPT = 'crypt'
+LVM = 'lvm'
+RAID = 'raid'
+MAPPER = 'dm'
+LOOP = 'loop'
+ROM = 'rom'
+
+# Partition types
+PRIMARY = 'primary'
+EXTENDED = 'extended'
+LOGICAL = 'logical'
+
+# mmc device types (SD cards and eMMC), see /sys/block/mmcblk*/device/type
+FLASH_TYPES = ['SD', 'MMC']
+
+# MBR partition ids used by extended partitions
+EXTENDED_IDS = ['0x5', '0xf', '0x85']
+
+
+def read_sysfs(path, default=""):
+    """ Returns the contents of a sysfs attribute """
+    try:
+        with open(path) as sys_file:
+            return sys_file.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+class BlockDevice(object):
+    """ A block device (a node in our device graph) """
+    def __init__(self, name):
+        self.name = name
+        self.path = "/dev/" + name
+        self.kind = DISK
+        # Size in bytes
+        self.size = 0
+        self.model = ""
+        self.removable = False
+        self.rotational = True
+        self.read_only = False
+        # SD card or eMMC
+        self.flash = False
+        # Devices this one is built on (the disk of a partition, the PVs of a LV...)
+        self.parents = []
+        self.children = []
+        self.part_number = 0
+        self.part_type = None
+        # Partition table type ('dos', 'gpt') of a disk
+        self.table = ""
+        self.fs_type = ""
+        self.label = ""
+        self.uuid = ""
+        # All info given by blkid
+        self.info = {}
+        self.mount_points = []
+        # LVM names of a logical volume
+        self.vg_name = ""
+        self.lv_name = ""
+
+    def is_ssd(self):
+        return not self.rotational
+
+    def is_flash(self):
+        return self.flash
+
+    def __repr__(self):
+        return "BlockDevice(%s, %s)" % (self.path, self.kind)
+
+
+class DeviceGraph(object):
+    """ Holds all our block devices """
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Kernel name (sda1, dm-0...): BlockDevice
+        self.devices = {}
+        # Volume group name: {'pvs': [pv paths], 'lvs': [lv names]}
+        self.volume_groups = {}
+        # Incremented each time our graph changes
+        self.generation = 0
+        self.monitor = None
+
+    def build(self):
+        """ Scans all our block devices """
+        devices = {}
+        if os.path.exists(SYS_BLOCK):
+            for name in os.listdir(SYS_BLOCK):
+                devices[name] = self.read_device(name)
+
+        with self.lock:
+            self.devices = devices
+            self.update_info(list(devices.keys()))
+            self.update_lvm()
+            self.update_mounts()
+            self.link()
+            self.generation += 1
+
+    def read_device(self, name):
+        """ Reads a block device from sysfs """
+        sys_path = os.path.join(SYS_BLOCK, name)
+        dev = BlockDevice(name)
+
+        # sysfs always counts 512 bytes sectors
+        dev.size = int(read_sysfs(os.path.join(sys_path, "size"), "0")) * 512
+        dev.read_only = read_sysfs(os.path.join(sys_path, "ro")) == "1"
+
+        # Partitions use their disk's queue
+        info = block_info.read(name)
+        if info is not None:
+            dev.rotational = info.rotational
+
+        if os.path.exists(os.path.join(sys_path, "partition")):
+            dev.kind = PARTITION
+            dev.part_number = int(read_sysfs(os.path.join(sys_path, "partition"), "0"))
+            # Our disk is our parent directory in sysfs
+            disk = os.path.basename(os.path.dirname(os.path.realpath(sys_path)))
+            dev.parents = [disk]
+            return dev
+
+        if os.path.exists(os.path.join(sys_path, "dm")):
+            dev.path = os.path.join("/dev/mapper", read_sysfs(os.path.join(sys_path, "dm", "name")))
+            dm_uuid = read_sysfs(os.path.join(sys_path, "dm", "uuid"))
+            if dm_uuid.startswith("CRYPT-"):
+                dev.kind = CRYPT
+            elif dm_uuid.startswith("LVM-"):
+                dev.kind = LVM
+            else:
+                dev.kind = MAPPER
+        elif os.path.exists(os.path.join(sys_path, "md")):
+            dev.kind = RAID
+        elif name.startswith("loop"):
+            dev.kind = LOOP
+        elif name.startswith("sr"):
+            dev.kind = ROM
+        else:
+            dev.model = read_sysfs(os.path.join(sys_path, "device", "model"))
+            dev.flash = read_sysfs(os.path.join(sys_path, "device", "type")) in FLASH_TYPES
+            if dev.flash and not dev.model:
+                dev.model = read_sysfs(os.path.join(sys_path, "device", "name"))
+            # USB and firewire disks are removable too
+            bus_path = os.path.realpath(sys_path)
+            dev.removable = read_sysfs(os.path.join(sys_path, "removable")) == "1" or \
+                "/usb" in bus_path or "/ieee1394" in bus_path or "/firewire" in bus_path
+
+        slaves_path = os.path.join(sys_path, "slaves")
+        if os.path.isdir(slaves_path):
+            dev.parents = os.listdir(slaves_path)
+
+        return dev
+
+    def update_info(self, names):
+        """ Gets filesystems info (lock must be held) """
+        paths = []
+        for name in names:
+            dev = self.devices.get(name)
+            # Don't try to read empty drives
+            if dev is not None and dev.size > 0 and dev.kind != ROM:
+                paths.append("/dev/" + name)
+
+        if not paths:
+            return
+
+        all_info = fs.get_all_info(paths)
+        for path in all_info:
+            name = os.path.basename(os.path.realpath(path))
+            dev = self.devices.get(name)
+            if dev is None:
+                continue
+            info = all_info[path]
+            dev.info = info
+            dev.fs_type = info.get('TYPE', '')
+            dev.label = info.get('LABEL', '')
+            dev.uuid = info.get('UUID', '')
+            if dev.kind != PARTITION:
+                dev.table = info.get('PTTYPE', '')
+
+    def update_lvm(self):
+        """ Gets our LVM volumes (lock must be held) """
+        lvm.refresh_inventory()
+        volume_groups = lvm.get_inventory()
+        # Orphan physical volumes
+        del volume_groups[""]
+        for vg_name in volume_groups:
+            for lv_name in volume_groups[vg_name]['lvs']:
+                dev = self.get("/dev/mapper/%s-%s" % (vg_name.replace('-', '--'),
+                                                      lv_name.replace('-', '--')))
+                if dev is not None:
+                    dev.vg_name = vg_name
+                    dev.lv_name = lv_name
+        self.volume_groups = volume_groups
+
+    def update_mounts(self):
+        """ Gets where our devices are mounted (lock must be held) """
+        for dev in self.devices.values():
+            dev.mount_points = []
+        for mount in mount_table.MountTable():
+            if not mount.source.startswith("/dev/"):
+                continue
+            dev = self.get(mount.source)
+            if dev is not None:
+                dev.mount_points.append(mount.mount_point)
+
+    def link(self):
+        """ Fill our devices children lists and pass disk properties to its partitions (lock must be held) """
+        for dev in self.devices.values():
+            dev.children = []
+        for dev in self.devices.values():
+            dev.parents = [parent for parent in dev.parents if parent in self.devices]
+            for parent in dev.parents:
+                self.devices[parent].children.append(dev.name)
+
+        for dev in self.devices.values():
+            if dev.kind != PARTITION or not dev.parents:
+                continue
+            disk = self.devices[dev.parents[0]]
+            dev.rotational = disk.rotational
+            dev.flash = disk.flash
+            dev.removable = disk.removable
+            dev.model = disk.model
+            if disk.table == 'dos':
+                if dev.info.get('PART_ENTRY_TYPE') in EXTENDED_IDS:
+                    dev.part_type = EXTENDED
+                elif dev.part_number > 4:
+                    dev.part_type = LOGICAL
+                else:
+                    dev.part_type = PRIMARY
+            else:
+                dev.part_type = PRIMARY
+
+        for dev in self.devices.values():
+            dev.children.sort(key=self.sort_key)
+
+    def sort_key(self, name):
+        """ Sorts partitions by their number """
+        dev = self.devices[name]
+        return (dev.part_number, name)
+
+    def update(self, name):
+        """ A device has been added or has changed """
+        dev = self.read_device(name)
+        with self.lock:
+            self.devices[name] = dev
+            self.update_info([name])
+            if dev.kind in (LVM, CRYPT, MAPPER) or dev.fs_type == 'LVM2_member':
+                self.update_lvm()
+            self.update_mounts()
+            self.link()
+            self.generation += 1
+
+    def remove(self, name):
+        """ A device has been removed """
+        with self.lock:
+            if name in self.devices:
+                del self.devices[name]
+                self.link()
+                self.generation += 1
+
+    def get(self, path):
+        """ Returns the device with this path (/dev/sda1, /dev/mapper/..., /dev/disk/by-uuid/...) """
+        with self.lock:
+            name = os.path.basename(os.path.realpath(path))
+            if name in self.devices:
+                return self.devices[name]
+            for dev in self.devices.values():
+                if dev.path == path:
+                    return dev
+        return None
+
+    def disks(self):
+        """ Returns all our disks (not cd-roms, loop or mapper devices), sorted by path """
+        with self.lock:
+            disks = [dev for dev in self.devices.values() if dev.kind == DISK and dev.size > 0]
+        return sorted(disks, key=lambda dev: dev.path)
+
+    def partitions(self, disk):
+        """ Returns all partitions of a disk """
+        with self.lock:
+            dev = self.get(disk)
+            if dev is None:
+                return []
+            return [self.devices[name] for name in dev.children
+                    if self.devices[name].kind == PARTITION]
+
+    def disk_of(self, path):
+        """ Returns the disk a partition (or a mapping built on it) lives in """
+        with self.lock:
+            dev = self.get(path)
+            while dev is not None and dev.kind != DISK and dev.parents:
+                dev = self.devices[dev.parents[0]]
+            return dev
+
+    def start_monitor(self):
+        """ Keep our graph updated """
+        if self.monitor is None:
+            self.monitor = UeventMonitor(self)
+            self.monitor.start()
+
+    def stop_monitor(self):
+        if self.monitor is not None:
+            self.monitor.stop()
+            self.monitor = None
+
+
+def parse_uevent(data):
+    """ Kernel uevents are 'action@devpath' followed by KEY=value strings, all separated by zeros """
+    event = {}
+    for field in data.split(b'\0')[1:]:
+        field = field.decode(errors='replace')
+        if '=' in field:
+            (key, value) = field.split('=', 1)
+            event[key] = value
+    return event
+
+
+class UeventMonitor(threading.Thread):
+    """ Listens to kernel uevents and updates our device graph when a block device changes """
+    def __init__(self, graph):
+        super(UeventMonitor, self).__init__()
+        self.daemon = True
+        self.graph = graph
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            # Multicast group 1 receives the kernel uevents
+            sock.bind((0, 1))
+        except (OSError, AttributeError) as err:
+            logging.warning(_("Can't listen to kernel uevents, device list won't be updated"))
+            logging.warning(err)
+            return
+
+        sock.settimeout(1)
+
+        while not self.stop_event.is_set():
+            try:
+                data = sock.recv(UEVENT_BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError as err:
+                if err.errno == errno.ENOBUFS:
+                    # We have lost some events, scan everything again
+                    self.graph.build()
+                    continue
+                logging.warning(err)
+                break
+
+            event = parse_uevent(data)
+            if event.get('SUBSYSTEM') != 'block' or 'DEVNAME' not in event:
+                continue
+
+            name = os.path.basename(event['DEVNAME'])
+            logging.debug("uevent: %s %s", event.get('ACTION'), name)
+            if event.get('ACTION') == 'remove':
+                self.graph.remove(name)
+            else:
+                self.graph.update(name)
+
+        sock.close()
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    """ Returns our device graph (it's only built once) """
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = DeviceGraph()
+            _graph.build()
+            _graph.start_monitor()
+    return _graph
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  device_wait.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Waits for some device nodes (or /dev/disk links) to appear, watching their directories with inotify """
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import time
+
+# Seconds we wait for our devices
+DEFAULT_TIMEOUT = 30
+
+# When inotify is not available we check our devices this often (in seconds)
+POLL_INTERVAL = 0.1
+
+# inotify events (see sys/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# udev creates device nodes and renames its links into place
+WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_ATTRIB
+
+EVENT_BUFFER_SIZE = 64 * 1024
+
+_libc = None
+
+
+def get_libc():
+    """ Loads libc (just once). Returns None if it can't be loaded """
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            _libc.inotify_init1.argtypes = [ctypes.c_int]
+            _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError) as err:
+            logging.warning(err)
+            _libc = False
+    return _libc or None
+
+
+def get_watch_dir(path):
+    """ Returns the nearest existing directory where path will appear """
+    directory = os.path.dirname(path)
+    while directory and not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return directory or "/"
+
+
+class Inotify(object):
+    """ Minimal inotify wrapper, we only need to know that something has changed """
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watched = set()
+
+    def watch(self, directory):
+        if directory in self.watched:
+            return
+        if self.libc.inotify_add_watch(self.fd, directory.encode(), WATCH_MASK) >= 0:
+            self.watched.add(directory)
+
+    def wait(self, timeout):
+        """ Waits until something changes in our directories (or timeout seconds pass) """
+        (readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                # We do not care about the events themselves
+                while os.read(self.fd, EVENT_BUFFER_SIZE):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def wait_for_devices(paths, timeout=DEFAULT_TIMEOUT):
+    """ Waits until all paths exist (/dev/sda1, /dev/mapper/..., /dev/disk/by-uuid/...).
+        Returns True if they do, False if we give up after timeout seconds """
+    paths = list(paths)
+    start = time.time()
+    deadline = start + timeout
+
+    inotify = None
+    libc = get_libc()
+    if libc is not None:
+        try:
+            inotify = Inotify(libc)
+        except OSError as err:
+            logging.warning(_("Can't use inotify to wait for our devices: %s"), err)
+
+    try:
+        while True:
+            missing = []
+            for path in paths:
+                if inotify is not None:
+                    # Watch before checking, so we can't miss it
+                    inotify.watch(get_watch_dir(path))
+                if not os.path.exists(path):
+                    missing.append(path)
+
+            if not missing:
+                logging.debug("Devices %s ready after %.3f seconds", ", ".join(paths), time.time() - start)
+                return True
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.warning(_("Timeout (%s seconds) waiting for devices: %s"), timeout, ", ".join(missing))
+                return False
+
+            if inotify is not None:
+                inotify.wait(remaining)
+            else:
+                time.sleep(min(POLL_INTERVAL, remaining))
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+
+def wait_for_uuid(uuid, timeout=DEFAULT_TIMEOUT):
+    """ Waits until udev creates the /dev/disk/by-uuid link of a filesystem """
+    return wait_for_devices([os.path.join("/dev/disk/by-uuid", uuid)], timeout)
@@ -22,42 +22,114 @@
 
 """ Functions to work with filesystems """
 
+import os
 import subprocess
 import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import canonical.misc as misc
 import logging
+import parted3.block_info as block_info
+import parted3.fs_profiles as fs_profiles
+import parted3.tool_progress as tool_progress
 
 # constants
 NAMES = ['ext2', 'ext3', 'ext4', 'fat16', 'fat32', 'ntfs', 'jfs',
-           'reiserfs', 'xfs', 'btrfs', 'swap']
+           'reiserfs', 'xfs', 'btrfs', 'f2fs', 'swap']
 
 COMMON_MOUNT_POINTS = ['/', '/boot', '/home', '/usr', '/var']
 COMMON_MOUNT_POINTS_EFI = ['/', '/boot/efi', '/boot', '/home', '/usr', '/var']
 
-@misc.raise_privileges
+# How many filesystems we create at the same time
+MAX_MKFS_JOBS = 4
+
+# Block size we use with ext filesystems (mke2fs default for anything but tiny filesystems)
+EXT_BLOCK_SIZE = 4096
+
+# Part of a resize operation spent checking the filesystem (see resize)
+NTFS_CHECK_WEIGHT = 0.3
+EXT_CHECK_WEIGHT = 0.4
+
+# e2fsck exit codes below this mean there are no errors left
+E2FSCK_UNCORRECTED_ERRORS = 4
+
+# Filesystems mounted here are not needed to copy our system,
+# they can be created while it's being copied (see InstallationProcess)
+DEFERRABLE_MOUNT_POINTS = ['/home']
+
+# blkid info of all our devices, see get_info
+_info_cache = None
+_info_lock = threading.Lock()
+
 def get_info(part):
-    """ Get partition info using blkid """
-    try:
-        ret = subprocess.check_output(shlex.split('blkid %s' % part)).decode().strip()
-    except subprocess.CalledProcessError as err:
-        logging.warning(err)
-        ret = ''
-    partdic = {}
-    for info in ret.split():
-        if '=' in info:
-            info = info.split('=')
-            partdic[info[0]] = info[1].strip('"')
-    return(partdic)
+    """ Get partition info using blkid
+        blkid is run only once for all partitions, its results are cached
+        (call refresh_info if a partition changes) """
+    global _info_cache
+    with _info_lock:
+        if _info_cache is None:
+            _info_cache = {}
+            all_info = get_all_info()
+            for path in all_info:
+                _info_cache[path] = all_info[path]
+                _info_cache[os.path.realpath(path)] = all_info[path]
+        partdic = _info_cache.get(part) or _info_cache.get(os.path.realpath(part))
+    if partdic is None:
+        # blkid has not seen this one yet
+        partdic = refresh_info(part)
+    return partdic.copy()
+
+def refresh_info(part=None):
+    """ Forget what blkid told us about part (or about all our partitions if part is None) """
+    global _info_cache
+    if part is None:
+        with _info_lock:
+            _info_cache = None
+        return None
+
+    partdic = get_all_info([part]).get(part, {})
+    with _info_lock:
+        if _info_cache is not None:
+            _info_cache[part] = partdic
+            _info_cache[os.path.realpath(part)] = partdic
+    return partdic
 
-@misc.raise_privileges
 def get_type(part):
     """ Get filesystem type using blkid """
+    return get_info(part).get('TYPE', '')
+
+@misc.raise_privileges
+def get_all_info(parts=None):
+    """ Get info of all partitions (or just the ones in parts) running blkid only once.
+        Returns a dict {device path: {key: value}} """
+    cmd = ['blkid', '-c', '/dev/null', '-o', 'export']
+    if parts:
+        # Low level probing also gives us partition table info
+        cmd.insert(1, '-p')
+        cmd.extend(parts)
     try:
-        ret = subprocess.check_output(shlex.split('blkid -o value -s TYPE %s' % part)).decode().strip()
+        ret = subprocess.check_output(cmd).decode()
     except subprocess.CalledProcessError as err:
-        logging.warning(err)
-        ret = ''
-    return ret
+        # blkid returns 2 if some device has nothing it can identify
+        ret = err.output.decode()
+
+    all_info = {}
+    partdic = {}
+    for line in ret.split('\n') + ['']:
+        line = line.strip()
+        if not line:
+            if 'DEVNAME' in partdic:
+                all_info[partdic['DEVNAME']] = partdic
+            partdic = {}
+        elif '=' in line:
+            (key, value) = line.split('=', 1)
+            # Values are escaped as shell strings
+            try:
+                value = ''.join(shlex.split(value))
+            except ValueError:
+                pass
+            partdic[key] = value
+    return all_info
 
 @misc.raise_privileges
 def label_fs(fstype, part, label):
@@ -72,7 +144,8 @@ def label_fs(fstype, part, label):
              'jfs':'jfs_tune -L %(label)s %(part)s',
              'reiserfs':'reiserfstune -l %(label)s %(part)s',
              'xfs':'xfs_admin -l %(label)s %(part)s',
-             'btrfs':'btrfs filesystem label %(part)s %(label)s'}
+             'btrfs':'btrfs filesystem label %(part)s %(label)s',
+             'f2fs':'f2fslabel %(part)s %(label)s'}
     fstype = fstype.lower()
     # OK, the below is a quick cheat.  vars() returns all variables
     # in a dictionary.  So 'part' and 'label' will be defined
@@ -84,35 +157,24 @@ def label_fs(fstype, part, label):
         logging.error(err)
         ret = (1, err)
         # check_call returns exit code.  0 should mean success
+    refresh_info(part)
     return ret
 
 @misc.raise_privileges
-def create_fs(part, fstype, label='', other_opts=''):
+def create_fs(part, fstype, label='', other_opts='', mount_point=None):
     """ Create filesystem using mkfs """
 
-    # Set some default options
-    # -m 1 reserves 1% for root, because I think 5% is too much on
-    # newer bigger drives.
-    # Also turn on dir_index for ext.  Not sure about other fs opts
+    # Default options come from our filesystem profiles (see fs_profiles),
+    # they depend on the device and on where the filesystem will be mounted
 
     # The return value is tuple.  First arg is 0 for success, 1 for fail
     # Secong arg is either output from call if successful
     # or exception if failure
 
-    opt_dic = {'ext2':'-m 1',
-               'ext3':'-m 1 -O dir_index',
-               'ext4':'-m 1 -O dir_index',
-               'fat16':'',
-               'fat32':'',
-               'ntfs':'',
-               'jfs':'',
-               'reiserfs':'',
-               'btrfs':'',
-               'xfs':'',
-               'swap':''}
     fstype = fstype.lower()
     if not other_opts:
-        other_opts = opt_dic[fstype]
+        other_opts = fs_profiles.get_mkfs_options(fstype, part, mount_point)
+    other_opts = add_stripe_options(fstype, part, other_opts)
     comdic = {'ext2':'mkfs.ext2 -L "%(label)s" %(other_opts)s %(part)s',
              'ext3':'mkfs.ext3 -L "%(label)s" %(other_opts)s %(part)s',
              'ext4':'mkfs.ext4 -L "%(label)s" %(other_opts)s %(part)s',
@@ -123,6 +185,7 @@ def create_fs(part, fstype, label='', other_opts=''):
              'reiserfs':'mkfs.reiserfs -q -l "%(label)s" %(other_opts)s %(part)s',
              'xfs':'mkfs.xfs -f -L "%(label)s" %(other_opts)s %(part)s',
              'btrfs':'mkfs.btrfs -f -L "%(label)s" %(other_opts)s %(part)s',
+             'f2fs':'mkfs.f2fs -f -l "%(label)s" %(other_opts)s %(part)s',
              'swap':'mkswap %(part)s'}
     try:
         result = subprocess.check_output(shlex.split(comdic[fstype] % vars())).decode()
@@ -130,24 +193,71 @@ def create_fs(part, fstype, label='', other_opts=''):
     except subprocess.CalledProcessError as err:
         logging.error(err)
         ret = (1, err)
+    refresh_info(part)
     return ret
 
-@misc.raise_privileges
+def get_stripe_options(fstype, part):
+    """ Returns mkfs options that tell the filesystem about the RAID stripe under part (if any) """
+    info = block_info.read(part)
+    if info is None:
+        return ''
+    stripe = info.stripe()
+    if stripe is None:
+        return ''
+
+    (unit, width) = stripe
+    fstype = fstype.lower()
+    if fstype in ['ext2', 'ext3', 'ext4']:
+        if unit % EXT_BLOCK_SIZE != 0:
+            return ''
+        return '-b %d -E stride=%d,stripe-width=%d' % (EXT_BLOCK_SIZE, unit // EXT_BLOCK_SIZE,
+                                                       width // EXT_BLOCK_SIZE)
+    elif fstype == 'xfs':
+        return '-d su=%d,sw=%d' % (unit, width // unit)
+    return ''
+
+def add_stripe_options(fstype, part, options):
+    """ Adds the stripe options to our mkfs options (unless they already have theirs) """
+    stripe_options = get_stripe_options(fstype, part)
+    if not stripe_options:
+        return options
+    logging.debug("%s is striped, using '%s' to create its filesystem", part, stripe_options)
+    return fs_profiles.merge_options(options, stripe_options)
+
+def create_filesystems(jobs, callback=None):
+    """ Creates several filesystems at the same time (MAX_MKFS_JOBS at most).
+        jobs is a list of (part, fstype, label, other_opts) tuples.
+        callback(part, ret) is called (from the calling thread) as each one finishes.
+        Returns a dict with create_fs result for each partition """
+    results = {}
+    if not jobs:
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(len(jobs), MAX_MKFS_JOBS)) as executor:
+        futures = {}
+        for (part, fstype, label, other_opts) in jobs:
+            futures[executor.submit(create_fs, part, fstype, label, other_opts)] = part
+        for future in as_completed(futures):
+            part = futures[future]
+            results[part] = future.result()
+            if callback is not None:
+                callback(part, results[part])
+    return results
+
+def is_deferrable(mount_point):
+    """ Tells if a filesystem mounted in mount_point can be created after copying our system """
+    for deferrable in DEFERRABLE_MOUNT_POINTS:
+        if mount_point == deferrable or mount_point.startswith(deferrable + "/"):
+            return True
+    return False
+
 def is_ssd(disk_path):
     """ Check if is sdd """
-    ssd = False
-    try:
-        process1 = subprocess.Popen(["hdparm", "-I", disk_path], stdout=subprocess.PIPE)
-        process2 = subprocess.Popen(["grep", "Rotation Rate"], stdin=process1.stdout, stdout=subprocess.PIPE)
-        process1.stdout.close()
-        output = process2.communicate()[0].decode()
-        if "Solid State" in output:
-            ssd = True
-    except subprocess.CalledProcessError as err:
-        logging.error(err)
+    info = block_info.read(disk_path)
+    if info is None:
         logging.warning(_("Can't verify if %s is a Solid State Drive or not"), disk_path)
-
-    return ssd
+        return False
+    return info.is_ssd()
 
 # To shrink a partition:
 # 1. Shrink fs
@@ -157,36 +267,71 @@ def is_ssd(disk_path):
 # 1. Expand partition
 # 2. Expand fs (resize)
 
-def resize(part, fs_type, new_size_in_mb):
-    """ Resize partition """
+def resize(part, fs_type, new_size_in_mb, progress=None, cancel=None):
+    """ Resize partition.
+        progress(fraction, text, cancelable) is called as the tools progress.
+        cancel is a threading.Event, it is only honoured while the filesystem is not being modified """
     fs_type = fs_type.lower()
 
     res = False
 
-    if 'ntfs' in fs_type:
-        res = resize_ntfs(part, new_size_in_mb)
-    elif 'fat' in fs_type:
-        res = resize_fat(part, new_size_in_mb)
-    elif 'ext' in fs_type:
-        res = resize_ext(part, new_size_in_mb)
-    else:
-        logging.error(_("Sorry but filesystem %s can't be resized"), fs_type)
+    try:
+        if 'ntfs' in fs_type:
+            res = resize_ntfs(part, new_size_in_mb, progress, cancel)
+        elif 'fat' in fs_type:
+            res = resize_fat(part, new_size_in_mb)
+        elif 'ext' in fs_type:
+            res = resize_ext(part, new_size_in_mb, progress, cancel)
+        else:
+            logging.error(_("Sorry but filesystem %s can't be resized"), fs_type)
+    except tool_progress.Cancelled:
+        logging.warning(_("Resizing %s has been cancelled"), part)
+        res = False
+    except tool_progress.Stalled:
+        logging.error(_("Resizing %s has been stopped, it was not progressing"), part)
+        res = False
 
+    refresh_info(part)
     return res
 
+def run_resize_step(command, parser, progress, cancel, start, end, text, cancelable=True, input_data=None):
+    """ Runs one of the tools of a resize operation. Its progress goes from start to end (0 to 1) """
+    def on_fraction(fraction):
+        if progress is not None:
+            progress(start + (end - start) * fraction, text, cancelable)
+
+    if not cancelable:
+        # Last chance to cancel
+        tool_progress.check_cancelled(cancel)
+    on_fraction(0)
+    (returncode, output) = tool_progress.run(command, parser, on_fraction, cancel, cancelable, input_data)
+    logging.debug(output)
+    if returncode == 0:
+        on_fraction(1)
+    return returncode
+
 @misc.raise_privileges
-def resize_ntfs(part, new_size_in_mb):
+def resize_ntfs(part, new_size_in_mb, progress=None, cancel=None):
     """ Resize a ntfs partition """
-    logging.debug("ntfsresize -P --size %s %s", str(new_size_in_mb)+"M", part)
+    size = str(new_size_in_mb) + "M"
 
-    try:
-        result = subprocess.check_output(["ntfsresize", "-v", "-P", "--size", str(new_size_in_mb)+"M", part])
-    except subprocess.CalledProcessError as err:
-        result = None
-        logging.error(err)
+    # A dry run checks everything (and can be cancelled) before touching the filesystem
+    logging.debug("ntfsresize --no-action --size %s %s", size, part)
+    returncode = run_resize_step(["ntfsresize", "--no-action", "--size", size, part],
+                                 tool_progress.NtfsresizeParser(), progress, cancel, 0, NTFS_CHECK_WEIGHT,
+                                 _("Checking %s...") % part)
+    if returncode != 0:
+        logging.error(_("ntfsresize can't resize %s (exit code %d)"), part, returncode)
         return False
 
-    logging.debug(result)
+    logging.debug("ntfsresize --size %s %s", size, part)
+    # ntfsresize asks before resizing
+    returncode = run_resize_step(["ntfsresize", "--size", size, part],
+                                 tool_progress.NtfsresizeParser(), progress, cancel, NTFS_CHECK_WEIGHT, 1,
+                                 _("Shrinking %s...") % part, cancelable=False, input_data=b"y\n")
+    if returncode != 0:
+        logging.error(_("ntfsresize failed resizing %s (exit code %d)"), part, returncode)
+        return False
 
     return True
 
@@ -198,24 +343,27 @@ def resize_fat(part, new_size_in_mb):
     return False
 
 @misc.raise_privileges
-def resize_ext(part, new_size_in_mb):
+def resize_ext(part, new_size_in_mb, progress=None, cancel=None):
     """ Resize an ext partition """
 
     # first we need to e2fsck -f /dev/sdx#
-
-    try:
-        print("about to call e2fsck on" + part)
-        subprocess.check_output(["e2fsck", "-fy", part])
-    except subprocess.CalledProcessError as err:
-        logging.error(err)
+    # (-C 1 writes its progress to stdout)
+    returncode = run_resize_step(["e2fsck", "-f", "-y", "-C", "1", part],
+                                 tool_progress.E2fsckParser(), progress, cancel, 0, EXT_CHECK_WEIGHT,
+                                 _("Checking %s...") % part)
+    if returncode >= E2FSCK_UNCORRECTED_ERRORS:
+        logging.error(_("e2fsck has found errors in %s (exit code %d)"), part, returncode)
         return False
 
-    logging.debug("resize2fs %s %sM", part, str(new_size_in_mb))
+    # Our sizes are in MB, resize2fs counts MiB
+    size = str(int(new_size_in_mb * 1000 * 1000 / 1024)) + "K"
+    logging.debug("resize2fs -p %s %s", part, size)
 
-    try:
-        subprocess.check_output(["resize2fs", part, str(new_size_in_mb)+"M"])
-    except subprocess.CalledProcessError as err:
-        logging.error(err)
+    returncode = run_resize_step(["resize2fs", "-p", part, size],
+                                 tool_progress.Resize2fsParser(), progress, cancel, EXT_CHECK_WEIGHT, 1,
+                                 _("Shrinking %s...") % part, cancelable=False)
+    if returncode != 0:
+        logging.error(_("resize2fs failed resizing %s (exit code %d)"), part, returncode)
         return False
 
     return True
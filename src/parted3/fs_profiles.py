@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fs_profiles.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Chooses mkfs and mount options for each filesystem from its device (SSD or not, size) and mount point """
+
+import logging
+import shlex
+import threading
+
+from configobj import ConfigObj
+
+import parted3.block_info as block_info
+import parted3.superblock as superblock
+
+# Profiles can be overriden in thus.conf, see get_override
+CONF_FILE = '/etc/thus.conf'
+CONF_SECTION = 'filesystems'
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+# ext3/4 journal is around 0.4% of the filesystem (16MiB at least, 1GiB at most)
+EXT_JOURNAL_RATIO = 256
+EXT_JOURNAL_MIN_SIZE = 16 * MiB
+EXT_JOURNAL_MAX_SIZE = 1 * GiB
+
+# Root daemons need some reserved space, other filesystems (/home) don't
+EXT_RESERVED_MOUNT_POINTS = ['/', '/var']
+
+# mkfs.xfs gives tiny logs to small filesystems, metadata heavy loads (pacman) are faster with a bigger one
+XFS_BIG_LOG_MIN_SIZE = 16 * GiB
+XFS_LOG_SIZE = 64 * MiB
+
+# On SSDs compression costs CPU time and saves little, use a cheaper zstd level there
+BTRFS_ZSTD_LEVEL_SSD = 1
+BTRFS_ZSTD_LEVEL_HDD = 3
+
+# F2FS features for SD cards and eMMC: checksums and transparent compression (needs extra_attr)
+F2FS_FEATURES = 'extra_attr,inode_checksum,sb_checksum,compression'
+
+# lz4 is cheap enough for the slow CPUs that come with this kind of storage.
+# Compressing every file writes less to the flash (it wears less).
+# Only for filesystems that have the compression feature (kept ones may not have it)
+F2FS_COMPRESSION = ['compress_algorithm=lz4', 'compress_chksum', 'compress_extension=*']
+
+# Options whose suboptions we can merge (-E a -E b is -E a,b)
+MERGEABLE_OPTIONS = ['-E', '-d']
+
+# Other names our filesystems are known by
+FS_ALIASES = {'fat16': 'vfat',
+              'fat32': 'vfat',
+              'ntfs-3g': 'ntfs',
+              'linux-swap': 'swap'}
+
+_overrides = None
+_overrides_lock = threading.Lock()
+
+
+def normalize(fs_type):
+    """ Returns the name our profiles use for fs_type """
+    fs_type = fs_type.lower()
+    return FS_ALIASES.get(fs_type, fs_type)
+
+
+def get_device_traits(device, ssd=None):
+    """ Returns (is ssd, size in bytes) of device. ssd (if not None) overrides what sysfs tells us """
+    info = block_info.read(device) if device else None
+    if info is None:
+        return (bool(ssd), 0)
+    if ssd is None:
+        ssd = info.is_ssd()
+    return (ssd, info.size)
+
+
+def get_overrides():
+    """ Reads the [filesystems] section of thus.conf (just once) """
+    global _overrides
+    with _overrides_lock:
+        if _overrides is None:
+            try:
+                _overrides = ConfigObj(CONF_FILE).get(CONF_SECTION, {})
+            except Exception as err:
+                logging.warning(_("Can't read filesystem profiles from %s: %s"), CONF_FILE, err)
+                _overrides = {}
+        return _overrides
+
+
+def get_override(fs_type, kind, ssd):
+    """ Returns the options thus.conf sets for fs_type or None. kind is 'MKFS' or 'MOUNT'.
+        SSD_MOUNT_OPTIONS (or HDD_MOUNT_OPTIONS) wins over MOUNT_OPTIONS, e.g.:
+
+        [filesystems]
+            [[btrfs]]
+            MKFS_OPTIONS = -m dup -d single
+            SSD_MOUNT_OPTIONS = "rw,noatime,compress=zstd:1,ssd,space_cache=v2" """
+    section = get_overrides().get(fs_type)
+    if not section:
+        return None
+    for key in ["%s_%s_OPTIONS" % ('SSD' if ssd else 'HDD', kind), "%s_OPTIONS" % kind]:
+        if key in section:
+            value = section[key]
+            # ConfigObj splits unquoted values with commas
+            if isinstance(value, list):
+                value = ",".join(value)
+            return value
+    return None
+
+
+def merge_options(options, extra):
+    """ Adds extra options to options. Suboptions of MERGEABLE_OPTIONS given in both are merged,
+        the ones already in options win """
+    args = shlex.split(options)
+    extra_args = shlex.split(extra)
+    i = 0
+    while i < len(extra_args):
+        arg = extra_args[i]
+        if arg in MERGEABLE_OPTIONS and arg in args and i + 1 < len(extra_args):
+            pos = args.index(arg) + 1
+            if pos < len(args):
+                current = args[pos].split(',')
+                keys = [suboption.split('=')[0] for suboption in current]
+                for suboption in extra_args[i + 1].split(','):
+                    if suboption.split('=')[0] not in keys:
+                        current.append(suboption)
+                args[pos] = ','.join(current)
+            i += 2
+        else:
+            args.append(arg)
+            i += 1
+    return ' '.join(shlex.quote(arg) for arg in args)
+
+
+def get_ext_mkfs_options(fs_type, ssd, size, mount_point):
+    if mount_point is None or mount_point in EXT_RESERVED_MOUNT_POINTS:
+        opts = ['-m', '1']
+    else:
+        opts = ['-m', '0']
+    if fs_type == 'ext2':
+        return opts
+
+    opts += ['-O', 'dir_index']
+    if size > 0:
+        journal = min(max(size // EXT_JOURNAL_RATIO, EXT_JOURNAL_MIN_SIZE), EXT_JOURNAL_MAX_SIZE)
+        opts += ['-J', 'size=%d' % (journal // MiB)]
+    if fs_type == 'ext4':
+        # Do not zero inode tables and journal now, the kernel does it in the background
+        opts += ['-E', 'lazy_itable_init=1,lazy_journal_init=1']
+    return opts
+
+
+def get_xfs_mkfs_options(ssd, size, mount_point):
+    if size >= XFS_BIG_LOG_MIN_SIZE:
+        return ['-l', 'size=%dm' % (XFS_LOG_SIZE // MiB)]
+    return []
+
+
+def get_btrfs_mkfs_options(ssd, size, mount_point):
+    # Keep two copies of metadata, even on SSDs (newer btrfs-progs do the same)
+    return ['-m', 'dup', '-d', 'single']
+
+
+def get_f2fs_mkfs_options(ssd, size, mount_point):
+    return ['-O', F2FS_FEATURES]
+
+
+def get_mkfs_options(fs_type, device, mount_point=None, ssd=None):
+    """ Returns the mkfs options for a new fs_type filesystem in device """
+    fs_type = normalize(fs_type)
+    (ssd, size) = get_device_traits(device, ssd)
+
+    opts = get_override(fs_type, 'MKFS', ssd)
+    if opts is not None:
+        return opts
+
+    if fs_type in ['ext2', 'ext3', 'ext4']:
+        opts = get_ext_mkfs_options(fs_type, ssd, size, mount_point)
+    elif fs_type == 'xfs':
+        opts = get_xfs_mkfs_options(ssd, size, mount_point)
+    elif fs_type == 'btrfs':
+        opts = get_btrfs_mkfs_options(ssd, size, mount_point)
+    elif fs_type == 'f2fs':
+        opts = get_f2fs_mkfs_options(ssd, size, mount_point)
+    else:
+        opts = []
+    return ' '.join(opts)
+
+
+def get_mount_options(fs_type, device, mount_point=None, ssd=None):
+    """ Returns the mount options (as used in fstab) for fs_type filesystem in device """
+    fs_type = normalize(fs_type)
+    (ssd, size) = get_device_traits(device, ssd)
+
+    opts = get_override(fs_type, 'MOUNT', ssd)
+    if opts is not None:
+        return opts
+
+    # Reading a file should not write to an SSD
+    atime = 'noatime' if ssd else 'relatime'
+
+    if fs_type in ['ext3', 'ext4', 'xfs']:
+        # lazytime keeps timestamps updates in memory
+        opts = ['rw', atime, 'lazytime']
+    elif fs_type == 'btrfs':
+        level = BTRFS_ZSTD_LEVEL_SSD if ssd else BTRFS_ZSTD_LEVEL_HDD
+        opts = ['rw', atime, 'lazytime', 'compress=zstd:%d' % level, 'space_cache=v2']
+        if ssd:
+            opts.append('ssd')
+        else:
+            opts.append('autodefrag')
+    elif fs_type == 'f2fs':
+        opts = ['rw', atime, 'lazytime']
+        if device and superblock.has_f2fs_compression(device):
+            opts += F2FS_COMPRESSION
+    elif fs_type == 'swap':
+        opts = ['defaults']
+    elif ssd:
+        opts = ['defaults', 'noatime']
+    else:
+        opts = ['defaults']
+    return ','.join(opts)
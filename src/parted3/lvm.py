@@ -25,85 +25,126 @@
 
 import subprocess
 import logging
+import json
+import threading
 import canonical.misc as misc
 import show_message as show
 
+# Our cached lvm report, see get_inventory
+_report = None
+_report_lock = threading.Lock()
+
 @misc.raise_privileges
+def get_report():
+    """ Get all our physical volumes, volume groups and logical volumes with just one lvm call.
+        Returns a dict with three lists ('pv', 'vg' and 'lv'), each item a dict of lvm fields """
+    report = {'pv': [], 'vg': [], 'lv': []}
+    try:
+        result = subprocess.check_output(["lvm", "fullreport", "--reportformat", "json"],
+                                         stderr=subprocess.DEVNULL).decode()
+        result = json.loads(result)
+    except (subprocess.CalledProcessError, OSError, ValueError) as err:
+        logging.warning(_("Can't get LVM report"))
+        logging.warning(err)
+        return report
+
+    # lvm gives us one report for each volume group (and one for orphan physical volumes)
+    for vg_report in result.get('report', []):
+        vg_name = ""
+        for vg in vg_report.get('vg', []):
+            vg_name = vg.get('vg_name', "")
+        for key in report:
+            for item in vg_report.get(key, []):
+                item.setdefault('vg_name', vg_name)
+                report[key].append(item)
+    return report
+
+def get_inventory():
+    """ Returns all our volume groups as a dict {volume group: {'pvs': [paths], 'lvs': [names]}}
+        plus orphan physical volumes under the "" key. lvm is only asked once, its report is cached """
+    global _report
+    with _report_lock:
+        if _report is None:
+            _report = get_report()
+        report = _report
+
+    inventory = {"": {'pvs': [], 'lvs': []}}
+    for vg in report['vg']:
+        inventory[vg['vg_name']] = {'pvs': [], 'lvs': []}
+    for pv in report['pv']:
+        inventory.setdefault(pv['vg_name'], {'pvs': [], 'lvs': []})['pvs'].append(pv['pv_name'])
+    for lv in report['lv']:
+        inventory.setdefault(lv['vg_name'], {'pvs': [], 'lvs': []})['lvs'].append(lv['lv_name'])
+    return inventory
+
+def refresh_inventory():
+    """ Our volumes have changed, forget our cached report """
+    global _report
+    with _report_lock:
+        _report = None
+
 def get_lvm_partitions():
     """ Get all partition volumes """
-    vgmap = {}
-    result = subprocess.getoutput("pvdisplay")
-    for line in result.split("\n"):
-        if "PV Name" in line:
-            pvn = line.split()[-1]
-        if "VG Name" in line:
-            vgn = line.split()[-1]
-            if vgn in vgmap:
-                vgmap[vgn].append(pvn)
-            else:
-                vgmap[vgn] = [pvn]
-    return vgmap
+    inventory = get_inventory()
+    return dict((vg, inventory[vg]['pvs']) for vg in inventory if vg)
 
-@misc.raise_privileges
 def get_volume_groups():
     """ Get all volume groups """
-    volume_groups = []
-    result = subprocess.getoutput("vgdisplay")
-    for line in result.split("\n"):
-        if "VG Name" in line:
-            volume_groups.append(line.split()[-1])
-    return volume_groups
+    return sorted(vg for vg in get_inventory() if vg)
 
-@misc.raise_privileges
 def get_logical_volumes(volume_group):
     """ Get all logical volumes from a volume group """
-    logical_volumes = []
-    result = subprocess.getoutput("lvdisplay %s" % volume_group)
-    for line in result.split("\n"):
-        if "LV Name" in line:
-            logical_volumes.append(line.split()[-1])
-    return logical_volumes
+    inventory = get_inventory()
+    if volume_group in inventory:
+        return list(inventory[volume_group]['lvs'])
+    return []
+
+def get_physical_volumes():
+    """ Get all physical volumes (even the ones not used by any volume group) """
+    inventory = get_inventory()
+    return [pv for vg in sorted(inventory) for pv in inventory[vg]['pvs']]
 
 # When removing, we use -f flag to avoid warnings and confirmation messages
 
 @misc.raise_privileges
-def remove_logical_volume(logical_volume):
-    """ Removes a logical volume """
+def remove(command, names, error_txt):
+    """ Runs an lvm removal command on all names at once """
+    if not names:
+        return True
     try:
-        subprocess.check_call(["lvremove", "-f", logical_volume])
+        subprocess.check_call([command, "-f"] + list(names))
+        return True
     except subprocess.CalledProcessError as err:
-        txt = _("Can't remove logical volume %s") % logical_volume
+        txt = error_txt % ", ".join(names)
         logging.error(txt)
         logging.error(err)
         debugtxt = ("%s\n%s" % (txt, err))
         show.error(debugtxt)
+        return False
+    finally:
+        refresh_inventory()
+
+def remove_logical_volumes(logical_volumes):
+    """ Removes some logical volumes (given as vg/lv or /dev/vg/lv) """
+    return remove("lvremove", logical_volumes, _("Can't remove logical volume %s"))
+
+def remove_volume_groups(volume_groups):
+    """ Removes entire volume groups (and all their logical volumes) """
+    return remove("vgremove", volume_groups, _("Can't remove volume group %s"))
+
+def remove_physical_volumes(physical_volumes):
+    """ Removes some physical volumes """
+    return remove("pvremove", physical_volumes, _("Can't remove physical volume %s"))
+
+def remove_logical_volume(logical_volume):
+    """ Removes a logical volume """
+    return remove_logical_volumes([logical_volume])
 
-@misc.raise_privileges
 def remove_volume_group(volume_group):
     """ Removes an entire volume group """
-    # Before removing the volume group, remove its logical volumes
-    logical_volumes = get_logical_volumes(volume_group)
-    for logical_volume in logical_volumes:
-        remove_logical_volume(logical_volume)
-
-    # Now, remove the volume group
-    try:
-        subprocess.check_call(["vgremove", "-f", volume_group])
-    except subprocess.CalledProcessError as err:
-        txt = _("Can't remove volume group %s") % volume_group
-        logging.error(txt)
-        logging.error(err)
-        debugtxt = ("%s\n%s" % (txt, err))
-        show.error(debugtxt)
+    # vgremove -f removes its logical volumes too
+    return remove_volume_groups([volume_group])
 
-@misc.raise_privileges
 def remove_physical_volume(physical_volume):
     """ Removes a physical volume """
-    try:
-        subprocess.check_call(["pvremove", "-f", physical_volume])
-    except subprocess.CalledProcessError as err:
-        txt = _("Can't remove physical volume %s") % physical_volume
-        logging.error(txt)
-        logging.error(err)
-        debugtxt = ("%s\n%s" % (txt, err))
-        show.error(debugtxt)
+    return remove_physical_volumes([physical_volume])
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  mount_table.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Reads the mount table (/proc/self/mountinfo) once and looks mounts up by mount point,
+    source device or parent. Also unmounts whole trees, children first (as umount -R does) """
+
+from collections import namedtuple
+import logging
+import os
+import re
+import subprocess
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+# Spaces, tabs, newlines and backslashes are written as octal escapes (\040)
+ESCAPE_RE = re.compile(r"\\([0-7]{3})")
+
+
+class Mount(namedtuple('Mount', 'mount_id parent_id device_number root mount_point options '
+                                'fs_type source super_options')):
+    """ A line of /proc/self/mountinfo """
+    __slots__ = ()
+
+    def is_writable(self):
+        return 'rw' in self.options.split(',')
+
+
+def unescape(text):
+    return ESCAPE_RE.sub(lambda match: chr(int(match.group(1), 8)), text)
+
+
+def parse_line(line):
+    """ Returns a Mount, None if line can't be parsed. Format (see proc(5)):
+        36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue """
+    fields = line.split()
+    if '-' not in fields:
+        return None
+    separator = fields.index('-')
+    if separator < 6 or len(fields) < separator + 3:
+        return None
+    super_options = fields[separator + 3] if len(fields) > separator + 3 else ''
+    return Mount(int(fields[0]), int(fields[1]), fields[2], unescape(fields[3]), unescape(fields[4]),
+                 fields[5], fields[separator + 1], unescape(fields[separator + 2]), super_options)
+
+
+def is_inside(path, directory):
+    """ path is directory or is below it """
+    directory = directory.rstrip('/') or '/'
+    return path == directory or path.startswith(directory.rstrip('/') + '/')
+
+
+class MountTable(object):
+    """ Snapshot of the mount table. It is not updated by itself, call refresh after (un)mounting """
+    def __init__(self, path=MOUNTINFO):
+        self.path = path
+        self.mounts = []
+        self.by_id = {}
+        self.by_mount_point = {}
+        self.by_source = {}
+        self.children = {}
+        self.refresh()
+
+    def refresh(self):
+        """ Reads the mount table again """
+        self.mounts = []
+        try:
+            with open(self.path) as mountinfo:
+                for line in mountinfo:
+                    mount = parse_line(line)
+                    if mount is not None:
+                        self.mounts.append(mount)
+        except IOError as err:
+            logging.warning(_("Can't read the mount table: %s"), err)
+
+        self.by_id = {}
+        self.by_mount_point = {}
+        self.by_source = {}
+        self.children = {}
+        for mount in self.mounts:
+            self.by_id[mount.mount_id] = mount
+            # Mounts are listed in the order they were mounted, the last one hides the others
+            self.by_mount_point[mount.mount_point] = mount
+            self.children.setdefault(mount.parent_id, []).append(mount)
+            sources = {mount.source}
+            if mount.source.startswith('/dev/'):
+                sources.add(os.path.realpath(mount.source))
+            for source in sources:
+                self.by_source.setdefault(source, []).append(mount)
+
+    def __iter__(self):
+        return iter(self.mounts)
+
+    def get(self, mount_point):
+        """ Returns what is mounted at mount_point (None if nothing is) """
+        return self.by_mount_point.get(mount_point.rstrip('/') or '/')
+
+    def is_mounted(self, mount_point):
+        return self.get(mount_point) is not None
+
+    def get_by_source(self, device):
+        """ Returns the mounts of device (a device can be mounted in several places) """
+        mounts = self.by_source.get(device)
+        if mounts is None and device.startswith('/dev/'):
+            mounts = self.by_source.get(os.path.realpath(device))
+        return list(mounts or [])
+
+    def get_parent(self, mount):
+        return self.by_id.get(mount.parent_id)
+
+    def get_tree(self, mount_point):
+        """ Returns the mounts at (or below) mount_point in the order they have to be
+            unmounted: children before their parents, the last mounted first """
+        inside = [mount for mount in self.mounts if is_inside(mount.mount_point, mount_point)]
+        ids = set(mount.mount_id for mount in inside)
+
+        ordered = []
+
+        def add(mount):
+            for child in reversed(self.children.get(mount.mount_id, [])):
+                if child.mount_id in ids:
+                    add(child)
+            ordered.append(mount)
+
+        for mount in reversed(inside):
+            if mount.parent_id not in ids:
+                add(mount)
+        return ordered
+
+
+def unmount_tree(mount_point, table=None, lazy=False):
+    """ Unmounts everything mounted at (or below) mount_point, children first.
+        If lazy, whatever is busy is detached (umount -l) instead.
+        Returns the mount points that are still mounted """
+    if table is None:
+        table = MountTable()
+    failed = []
+    for mount in table.get_tree(mount_point):
+        # A parent can't be unmounted if one of its children is still there
+        if any(is_inside(path, mount.mount_point) for path in failed):
+            failed.append(mount.mount_point)
+            continue
+        logging.debug("Unmounting %s", mount.mount_point)
+        if subprocess.call(["umount", mount.mount_point]) == 0:
+            continue
+        if lazy and subprocess.call(["umount", "-l", mount.mount_point]) == 0:
+            logging.warning(_("%s is busy, it has been detached"), mount.mount_point)
+            continue
+        logging.warning(_("Can't unmount %s"), mount.mount_point)
+        failed.append(mount.mount_point)
+    table.refresh()
+    return failed
@@ -28,6 +28,7 @@ import os
 import canonical.misc as misc
 import logging
 import show_message as show
+import parted3.block_info as block_info
 
 # To be able to test this installer in other systems
 # that do not have pyparted3 installed
@@ -205,25 +206,46 @@ def get_size_txt(length, sector_size):
     return size_txt
 
 
+def get_alignment_grain(dev):
+    """ Returns (in sectors) where partitions should start and end, as the device topology tells """
+    info = block_info.read(dev.path)
+    if info is None:
+        align = block_info.MIN_ALIGNMENT
+    else:
+        align = info.alignment()
+    return max(1, align // dev.sectorSize)
+
+
+def get_alignments(dev):
+    """ Returns parted alignments for partitions' first and last sectors """
+    grain = get_alignment_grain(dev)
+    start_alignment = parted.Alignment(offset=0, grainSize=grain)
+    # A partition ends just before an aligned sector
+    end_alignment = parted.Alignment(offset=grain - 1, grainSize=grain)
+    return (start_alignment, end_alignment)
+
+
 @misc.raise_privileges
 def create_partition(diskob, part_type, geom):
     # A lot of this is similar to Anaconda, but customized to fit our needs
     nstart = geom.start
     nend = geom.end
-    if nstart < 2048:
-        nstart = 2048
+    (start_alignment, end_alignment) = get_alignments(diskob.device)
+    if nstart < start_alignment.grainSize:
+        nstart = start_alignment.grainSize
     # Just in case you try to create partition larger than disk.
     # This case should be caught in the frontend!
     # Never let user specify a length exceeding the free space.
     if nend > diskob.device.length - 1:
         nend = diskob.device.length - 1
-    nalign = diskob.partitionAlignment
-    if not nalign.isAligned(geom, nstart):
-        nstart = nalign.alignNearest(geom, nstart)
-    if not nalign.isAligned(geom, nend):
-        nend = nalign.alignDown(geom, nend)
+    # Align to the device topology (physical sector, optimal io size, RAID stripe)
+    if not start_alignment.isAligned(geom, nstart):
+        nstart = start_alignment.alignUp(geom, nstart)
+    if not end_alignment.isAligned(geom, nend):
+        nend = end_alignment.alignDown(geom, nend)
     if part_type == 1:
-        nstart += nalign.grainSize
+        # Leave room for the logical partition's EBR
+        nstart += start_alignment.grainSize
     mingeom = parted.Geometry(device=diskob.device, start=nstart, end=nend-1)
     maxgeom = parted.Geometry(device=diskob.device, start=nstart, end=nend)
     if diskob.maxPartitionLength < maxgeom.length:
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  resize_limits.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Finds out (in the background) how much our filesystems can be shrunk """
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import re
+import subprocess
+import threading
+
+import canonical.misc as misc
+import parted3.superblock as superblock
+
+# Sizes are in bytes. If a filesystem can't be shrunk, reason tells why
+ResizeLimits = namedtuple('ResizeLimits', 'min_size max_size can_shrink reason')
+
+# How many filesystems we analyze at the same time
+MAX_WORKERS = 4
+
+# "You might resize at 18373283840 bytes or 18374 MB (freeing 33 MB)."
+NTFS_MIN_SIZE_RE = re.compile(r"You might resize at (\d+) bytes")
+
+# "Estimated minimum size of the filesystem: 1234567" (in filesystem blocks)
+EXT_MIN_SIZE_RE = re.compile(r"Estimated minimum size of the filesystem: (\d+)")
+
+# btrfs needs some unallocated space to be able to relocate its chunks
+BTRFS_MARGIN = 1024 * 1024 * 1024
+
+# Filesystems that fs_module.resize knows how to shrink
+SHRINKABLE = ['ntfs', 'ext2', 'ext3', 'ext4']
+
+
+def get_ntfs_min_size(part):
+    """ Asks ntfsresize. It fails if Windows is hibernated or the volume needs a chkdsk """
+    try:
+        result = subprocess.check_output(['ntfsresize', '--info', '--no-progress-bar', part],
+                                         stderr=subprocess.STDOUT).decode()
+    except subprocess.CalledProcessError as err:
+        logging.warning(_("Can't get the minimum size of NTFS partition %s: %s"), part, err.output)
+        return None
+    match = NTFS_MIN_SIZE_RE.search(result)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def get_ext_min_size(part):
+    """ Asks resize2fs (-P only reads the filesystem) """
+    usage = superblock.read_usage(part, 'ext')
+    if usage is None:
+        return None
+    try:
+        result = subprocess.check_output(['resize2fs', '-P', part], stderr=subprocess.STDOUT).decode()
+    except subprocess.CalledProcessError as err:
+        logging.warning(_("Can't get the minimum size of ext partition %s: %s"), part, err.output)
+        return None
+    match = EXT_MIN_SIZE_RE.search(result)
+    if match is None:
+        return None
+    return int(match.group(1)) * usage.block_size
+
+
+def get_used_size(part, fs_type):
+    """ Bytes used in part as its superblock tells. None if we can't read it """
+    usage = superblock.read_usage(part, fs_type)
+    if usage is None:
+        return None
+    return (usage.total - usage.free) * usage.block_size
+
+
+def get_limits(part, fs_type, size):
+    """ Returns the ResizeLimits of part (size is the partition size in bytes) """
+    fs_type = fs_type.lower()
+    try:
+        if 'ntfs' in fs_type:
+            min_size = get_ntfs_min_size(part)
+            if min_size is None:
+                return ResizeLimits(size, size, False, _("Windows may be hibernated or need a disk check"))
+        elif 'ext' in fs_type:
+            min_size = get_ext_min_size(part)
+            if min_size is None:
+                return ResizeLimits(size, size, False, _("The filesystem needs to be checked"))
+        elif 'xfs' in fs_type:
+            return ResizeLimits(size, size, False, _("XFS filesystems can't be shrunk"))
+        elif 'btrfs' in fs_type:
+            used = get_used_size(part, 'btrfs')
+            min_size = size if used is None else min(size, used + BTRFS_MARGIN)
+        else:
+            min_size = get_used_size(part, fs_type)
+            if min_size is None:
+                return ResizeLimits(size, size, False, _("Unknown filesystem"))
+    except Exception as err:
+        logging.warning(_("Can't get the resize limits of %s: %s"), part, err)
+        return ResizeLimits(size, size, False, str(err))
+
+    if not any(name in fs_type for name in SHRINKABLE):
+        return ResizeLimits(min_size, size, False, _("%s filesystems can't be shrunk yet") % fs_type)
+
+    return ResizeLimits(min(min_size, size), size, min_size < size, "")
+
+
+class ResizeLimitService(object):
+    """ Computes the resize limits of our partitions in child processes, just once for each one.
+        Our tools need privileges, they are raised there and not in the UI process """
+    def __init__(self):
+        self.executor = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def submit(self, part, fs_type, size, callback=None):
+        """ Starts computing part's limits. callback(part, limits) is called (from a thread
+            of our executor) when they are ready """
+        key = (part, fs_type, size)
+        with self.lock:
+            future = self.futures.get(key)
+            if future is None:
+                future = self.executor.submit(misc.run_privileged, get_limits, part, fs_type, size)
+                self.futures[key] = future
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(part, f.result()))
+        return future
+
+    def get(self, part, fs_type, size):
+        """ Returns part's limits, None if they are not ready yet """
+        with self.lock:
+            future = self.futures.get((part, fs_type, size))
+        if future is None or not future.done():
+            return None
+        return future.result()
+
+    def forget(self, part=None):
+        """ Forget part's limits (all of them if part is None), i.e. after resizing it """
+        with self.lock:
+            for key in list(self.futures.keys()):
+                if part is None or key[0] == part:
+                    del self.futures[key]
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  superblock.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Reads filesystems' superblocks to know their size and free space without running any tool """
+
+from collections import namedtuple
+import logging
+import os
+import struct
+import sys
+from array import array
+
+import canonical.misc as misc
+
+# Sizes are in blocks of block_size bytes
+Usage = namedtuple('Usage', 'block_size total free')
+
+# Number of bits set in each byte value
+POPCOUNT = bytes(bin(i).count('1') for i in range(256))
+
+# Bitmaps and FATs are read in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+
+XFS_MAGIC = b'XFSB'
+
+BTRFS_SUPERBLOCK_OFFSET = 64 * 1024
+BTRFS_MAGIC = b'_BHRfS_M'
+
+F2FS_SUPERBLOCK_OFFSET = 1024
+F2FS_MAGIC = 0xF2F52010
+# Feature flags (after uuid, volume name, extension list and versions)
+F2FS_FEATURE_OFFSET = 2180
+F2FS_FEATURE_COMPRESSION = 0x2000
+
+NTFS_OEM_ID = b'NTFS    '
+NTFS_MFT_RECORD_BITMAP = 6
+NTFS_ATTR_DATA = 0x80
+NTFS_ATTR_END = 0xFFFFFFFF
+# Fixups are applied to every 512 bytes of an MFT record
+NTFS_FIXUP_BLOCK_SIZE = 512
+
+FAT_FSINFO_LEAD_SIG = 0x41615252
+FAT_FSINFO_STRUCT_SIG = 0x61417272
+FAT_FSINFO_UNKNOWN = 0xFFFFFFFF
+
+
+def pread(fd, size, offset):
+    """ Reads size bytes at offset. Fails if there're not enough bytes """
+    data = os.pread(fd, size, offset)
+    if len(data) < size:
+        raise ValueError("Short read at offset %d" % offset)
+    return data
+
+
+def count_bits(data):
+    """ Counts how many bits are set """
+    return sum(data.translate(POPCOUNT))
+
+
+def read_ext(fd):
+    """ Reads an ext2/3/4 superblock """
+    sb = pread(fd, 1024, EXT_SUPERBLOCK_OFFSET)
+    (magic,) = struct.unpack_from('<H', sb, 56)
+    if magic != EXT_MAGIC:
+        return None
+    (blocks, reserved, free) = struct.unpack_from('<III', sb, 4)
+    (log_block_size,) = struct.unpack_from('<I', sb, 24)
+    (incompat,) = struct.unpack_from('<I', sb, 96)
+    if incompat & EXT_FEATURE_INCOMPAT_64BIT:
+        (blocks_hi, reserved_hi, free_hi) = struct.unpack_from('<III', sb, 0x150)
+        blocks |= blocks_hi << 32
+        free |= free_hi << 32
+    return Usage(1024 << log_block_size, blocks, free)
+
+
+def read_xfs(fd):
+    """ Reads a XFS superblock (same values xfs_db gives us) """
+    sb = pread(fd, 512, 0)
+    if sb[:4] != XFS_MAGIC:
+        return None
+    (block_size,) = struct.unpack_from('>I', sb, 4)
+    (dblocks,) = struct.unpack_from('>Q', sb, 8)
+    (fdblocks,) = struct.unpack_from('>Q', sb, 144)
+    return Usage(block_size, dblocks, fdblocks)
+
+
+def read_btrfs(fd):
+    """ Reads a btrfs superblock. As 'btrfs filesystem show' does,
+        we return this device's size and how much of it has been allocated """
+    sb = pread(fd, 4096, BTRFS_SUPERBLOCK_OFFSET)
+    if sb[64:72] != BTRFS_MAGIC:
+        return None
+    (sector_size,) = struct.unpack_from('<I', sb, 144)
+    # dev_item describes this device
+    (dev_total, dev_used) = struct.unpack_from('<QQ', sb, 209)
+    return Usage(sector_size, dev_total // sector_size, (dev_total - dev_used) // sector_size)
+
+
+def read_f2fs(fd):
+    """ Reads a F2FS superblock. Block counts are kept in its last checkpoint """
+    sb = pread(fd, 1024, F2FS_SUPERBLOCK_OFFSET)
+    (magic,) = struct.unpack_from('<I', sb, 0)
+    if magic != F2FS_MAGIC:
+        return None
+    (log_block_size, log_blocks_per_seg) = struct.unpack_from('<II', sb, 16)
+    (cp_blkaddr,) = struct.unpack_from('<I', sb, 76)
+    block_size = 1 << log_block_size
+
+    # There are two checkpoint packs (one per segment), the newest one is valid
+    checkpoint = None
+    for blkaddr in (cp_blkaddr, cp_blkaddr + (1 << log_blocks_per_seg)):
+        cp = pread(fd, 64, blkaddr * block_size)
+        (version, user_blocks, valid_blocks) = struct.unpack_from('<QQQ', cp, 0)
+        if checkpoint is None or version > checkpoint[0]:
+            checkpoint = (version, user_blocks, valid_blocks)
+
+    (version, user_blocks, valid_blocks) = checkpoint
+    if valid_blocks > user_blocks:
+        return None
+    return Usage(block_size, user_blocks, user_blocks - valid_blocks)
+
+
+def read_ntfs(fd):
+    """ NTFS does not store its free space anywhere, we have to count
+        the clusters marked as free in its $Bitmap file """
+    boot = pread(fd, 512, 0)
+    if boot[3:11] != NTFS_OEM_ID:
+        return None
+
+    (sector_size, sectors_per_cluster) = struct.unpack_from('<HB', boot, 11)
+    if sectors_per_cluster > 0x80:
+        sectors_per_cluster = 1 << (256 - sectors_per_cluster)
+    cluster_size = sector_size * sectors_per_cluster
+    (total_sectors, mft_lcn) = struct.unpack_from('<QQ', boot, 0x28)
+    (clusters_per_record,) = struct.unpack_from('<b', boot, 0x40)
+    if clusters_per_record > 0:
+        record_size = clusters_per_record * cluster_size
+    else:
+        record_size = 1 << -clusters_per_record
+    total_clusters = total_sectors // sectors_per_cluster
+
+    # The first MFT records are always contiguous
+    offset = mft_lcn * cluster_size + NTFS_MFT_RECORD_BITMAP * record_size
+    record = bytearray(pread(fd, record_size, offset))
+    if record[:4] != b'FILE':
+        return None
+
+    # Undo the update sequence (fixups) at the end of each block
+    (usa_offset, usa_count) = struct.unpack_from('<HH', record, 4)
+    usn = record[usa_offset:usa_offset + 2]
+    for i in range(1, usa_count):
+        end = i * NTFS_FIXUP_BLOCK_SIZE
+        if record[end - 2:end] != usn:
+            return None
+        record[end - 2:end] = record[usa_offset + 2 * i:usa_offset + 2 * i + 2]
+
+    # Look for the unnamed $DATA attribute
+    (attr_offset,) = struct.unpack_from('<H', record, 0x14)
+    while attr_offset + 8 <= record_size:
+        (attr_type, attr_length) = struct.unpack_from('<II', record, attr_offset)
+        if attr_type == NTFS_ATTR_END or attr_length == 0:
+            return None
+        (non_resident, name_length) = struct.unpack_from('<BB', record, attr_offset + 8)
+        if attr_type == NTFS_ATTR_DATA and name_length == 0:
+            break
+        attr_offset += attr_length
+    else:
+        return None
+
+    bitmap_size = (total_clusters + 7) // 8
+
+    if not non_resident:
+        (value_length, value_offset) = struct.unpack_from('<IH', record, attr_offset + 0x10)
+        start = attr_offset + value_offset
+        bitmap = bytes(record[start:start + min(value_length, bitmap_size)])
+        runs = []
+    else:
+        bitmap = b''
+        (runs_offset,) = struct.unpack_from('<H', record, attr_offset + 0x20)
+        runs = decode_runlist(record, attr_offset + runs_offset, attr_offset + attr_length)
+
+    used = 0
+    pending = bitmap_size
+    for (lcn, length) in runs:
+        run_offset = 0
+        run_size = length * cluster_size
+        while run_offset < run_size and pending > 0:
+            size = min(CHUNK_SIZE, run_size - run_offset, pending)
+            if lcn is None:
+                # Sparse run, nothing is used there
+                chunk = b''
+            else:
+                chunk = pread(fd, size, lcn * cluster_size + run_offset)
+            if size == pending:
+                bitmap = chunk
+            else:
+                used += count_bits(chunk)
+            run_offset += size
+            pending -= size
+
+    # Bits past our last cluster do not count
+    extra_bits = bitmap_size * 8 - total_clusters
+    if bitmap and extra_bits:
+        bitmap = bitmap[:-1] + bytes([bitmap[-1] & (0xFF >> extra_bits)])
+    used += count_bits(bitmap)
+
+    return Usage(cluster_size, total_clusters, total_clusters - used)
+
+
+def decode_runlist(record, offset, end):
+    """ Decodes a NTFS run list. Returns a list of (first cluster, length) tuples """
+    runs = []
+    lcn = 0
+    while offset < end and record[offset] != 0:
+        header = record[offset]
+        length_size = header & 0x0F
+        offset_size = header >> 4
+        offset += 1
+        length = int.from_bytes(record[offset:offset + length_size], 'little')
+        offset += length_size
+        if offset_size == 0:
+            runs.append((None, length))
+        else:
+            lcn += int.from_bytes(record[offset:offset + offset_size], 'little', signed=True)
+            runs.append((lcn, length))
+        offset += offset_size
+    return runs
+
+
+def read_fat(fd):
+    """ Reads a FAT boot sector. FAT32 may have its free space in its FSInfo sector,
+        otherwise we count the free entries of the first FAT """
+    boot = pread(fd, 512, 0)
+    if boot[510:512] != b'\x55\xaa':
+        return None
+
+    (sector_size, sectors_per_cluster, reserved, fats, root_entries, total16) = \
+        struct.unpack_from('<HBHBHH', boot, 11)
+    (fat_size16,) = struct.unpack_from('<H', boot, 22)
+    (total32, fat_size32) = struct.unpack_from('<II', boot, 32)
+    (fsinfo_sector,) = struct.unpack_from('<H', boot, 48)
+
+    if sector_size == 0 or sectors_per_cluster == 0:
+        return None
+
+    fat_size = fat_size16 or fat_size32
+    total_sectors = total16 or total32
+    root_sectors = (root_entries * 32 + sector_size - 1) // sector_size
+    data_sectors = total_sectors - (reserved + fats * fat_size + root_sectors)
+    clusters = data_sectors // sectors_per_cluster
+    cluster_size = sector_size * sectors_per_cluster
+
+    if clusters >= 65525:
+        fsinfo = pread(fd, 512, fsinfo_sector * sector_size)
+        (lead_sig,) = struct.unpack_from('<I', fsinfo, 0)
+        (struct_sig, free) = struct.unpack_from('<II', fsinfo, 484)
+        if lead_sig == FAT_FSINFO_LEAD_SIG and struct_sig == FAT_FSINFO_STRUCT_SIG and \
+           free != FAT_FSINFO_UNKNOWN and free <= clusters:
+            return Usage(cluster_size, clusters, free)
+
+    # First two entries are reserved
+    fat_offset = reserved * sector_size
+    if clusters < 4085:
+        # FAT12, two entries every three bytes
+        fat = pread(fd, (clusters + 2) * 3 // 2 + 1, fat_offset)
+        free = 0
+        for cluster in range(2, clusters + 2):
+            pos = cluster * 3 // 2
+            entry = fat[pos] | (fat[pos + 1] << 8)
+            entry = entry >> 4 if cluster & 1 else entry & 0x0FFF
+            if entry == 0:
+                free += 1
+    elif clusters < 65525:
+        fat = pread(fd, (clusters + 2) * 2, fat_offset)
+        # Zero is zero in any byte order
+        free = array('H', fat[4:]).count(0)
+    else:
+        free = 0
+        entry_offset = 2
+        while entry_offset < clusters + 2:
+            count = min(CHUNK_SIZE // 4, clusters + 2 - entry_offset)
+            entries = array('I', pread(fd, count * 4, fat_offset + entry_offset * 4))
+            if sys.byteorder != 'little':
+                entries.byteswap()
+            # Upper four bits are reserved
+            free += sum(1 for entry in entries if entry & 0x0FFFFFFF == 0)
+            entry_offset += count
+
+    return Usage(cluster_size, clusters, free)
+
+
+def read_f2fs_features(fd):
+    """ Reads the feature flags of a F2FS superblock (None if it is not F2FS) """
+    sb = pread(fd, F2FS_FEATURE_OFFSET + 4, F2FS_SUPERBLOCK_OFFSET)
+    (magic,) = struct.unpack_from('<I', sb, 0)
+    if magic != F2FS_MAGIC:
+        return None
+    (features,) = struct.unpack_from('<I', sb, F2FS_FEATURE_OFFSET)
+    return features
+
+
+READERS = {'ext': read_ext,
+           'xfs': read_xfs,
+           'btrfs': read_btrfs,
+           'f2fs': read_f2fs,
+           'ntfs': read_ntfs,
+           'fat': read_fat}
+
+
+@misc.raise_privileges
+def read_usage(part, fs_type):
+    """ Returns a Usage tuple. None if we don't know how to read this filesystem
+        (or if it does not look like what fs_type says it is) """
+    fs_type = fs_type.lower()
+    reader = None
+    for name in sorted(READERS):
+        if name in fs_type:
+            reader = READERS[name]
+            break
+
+    if reader is None:
+        return None
+
+    try:
+        fd = os.open(part, os.O_RDONLY)
+    except OSError as err:
+        logging.warning(err)
+        return None
+
+    try:
+        return reader(fd)
+    except (OSError, ValueError, struct.error, IndexError) as err:
+        logging.warning(_("Can't read %s superblock of %s: %s"), fs_type, part, err)
+        return None
+    finally:
+        os.close(fd)
+
+
+@misc.raise_privileges
+def has_f2fs_compression(part):
+    """ Tells if the F2FS filesystem in part has been created with the compression feature
+        (the kernel refuses compress_* mount options otherwise) """
+    try:
+        fd = os.open(part, os.O_RDONLY)
+    except OSError as err:
+        logging.warning(err)
+        return False
+
+    try:
+        features = read_f2fs_features(fd)
+    except (OSError, ValueError, struct.error) as err:
+        logging.warning(_("Can't read %s superblock of %s: %s"), 'f2fs', part, err)
+        return False
+    finally:
+        os.close(fd)
+    return features is not None and bool(features & F2FS_FEATURE_COMPRESSION)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  tool_progress.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Runs slow filesystem tools (e2fsck, resize2fs, ntfsresize) reading their progress as they go """
+
+import logging
+import os
+import re
+import select
+import subprocess
+import time
+
+# Seconds a tool may stay silent before our watchdog thinks it is stuck
+STALL_TIMEOUT = 600
+
+# How often we check if we have been cancelled (in seconds)
+POLL_INTERVAL = 0.5
+
+READ_SIZE = 4096
+
+
+class Cancelled(Exception):
+    """ The user has cancelled the operation """
+    pass
+
+
+class Stalled(Exception):
+    """ A tool has not written anything for too long """
+    pass
+
+
+class E2fsckParser(object):
+    """ e2fsck -C 1 writes "pass current max device" lines """
+    PASSES = 5
+    LINE_RE = re.compile(r"^(\d+) (\d+) (\d+) ")
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+        fraction = None
+        for line in lines:
+            match = self.LINE_RE.match(line)
+            if match:
+                (pass_number, current, maximum) = [int(value) for value in match.groups()]
+                if maximum > 0:
+                    fraction = (pass_number - 1 + current / maximum) / self.PASSES
+        return fraction
+
+
+class Resize2fsParser(object):
+    """ resize2fs -p writes "Begin pass N (max = M)" and then a bar of 40 X characters """
+    PASSES = 4
+    BAR_LENGTH = 40
+    PASS_RE = re.compile(r"Begin pass (\d+)")
+
+    def __init__(self):
+        self.pass_number = 0
+        self.marks = 0
+
+    def feed(self, text):
+        fraction = None
+        # A new pass may begin in the middle of our text
+        pieces = self.PASS_RE.split(text)
+        self.marks += pieces[0].count("X")
+        for i in range(1, len(pieces), 2):
+            self.pass_number = int(pieces[i])
+            self.marks = pieces[i + 1].count("X")
+        if self.pass_number > 0:
+            done = min(self.marks, self.BAR_LENGTH) / self.BAR_LENGTH
+            fraction = (self.pass_number - 1 + done) / self.PASSES
+        return fraction
+
+
+class NtfsresizeParser(object):
+    """ ntfsresize writes "12.34 percent completed" for each of its phases
+        (checking the filesystem, relocating data...) """
+    PHASES = 2
+    PERCENT_RE = re.compile(r"(\d+(?:\.\d+)?) percent completed")
+
+    def __init__(self):
+        self.buffer = ""
+        self.phase = 0
+        self.percent = 0
+
+    def feed(self, text):
+        self.buffer += text
+        matches = list(self.PERCENT_RE.finditer(self.buffer))
+        if not matches:
+            return None
+        # Keep what may be the beginning of another percentage
+        self.buffer = self.buffer[matches[-1].end():]
+        for match in matches:
+            percent = float(match.group(1))
+            if percent < self.percent:
+                # Next phase
+                self.phase += 1
+            self.percent = percent
+        phase = min(self.phase, self.PHASES - 1)
+        return min((phase + self.percent / 100) / self.PHASES, 1.0)
+
+
+def check_cancelled(cancel):
+    """ Raises Cancelled if cancel (a threading.Event) is set """
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+
+def stop(proc):
+    """ Terminates a tool (and waits for it) """
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run(command, parser, callback=None, cancel=None, cancelable=True, input_data=None,
+        stall_timeout=STALL_TIMEOUT):
+    """ Runs command feeding its output to parser. callback(fraction) is called each time it progresses.
+        While it is cancelable, setting cancel (a threading.Event) terminates it (raising Cancelled)
+        and so does our watchdog if it stalls (raising Stalled). Tools that are changing the filesystem
+        (not cancelable) are never terminated, the watchdog just warns about them.
+        Returns (exit code, output) """
+    logging.debug("Running %s", " ".join(command))
+    if cancelable:
+        check_cancelled(cancel)
+
+    stdin = subprocess.PIPE if input_data is not None else subprocess.DEVNULL
+    proc = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if input_data is not None:
+        proc.stdin.write(input_data)
+        proc.stdin.close()
+
+    fd = proc.stdout.fileno()
+    output = []
+    last_activity = time.time()
+    try:
+        while True:
+            if cancelable and cancel is not None and cancel.is_set():
+                logging.warning(_("Cancelling %s"), command[0])
+                stop(proc)
+                raise Cancelled()
+
+            (readable, writable, exceptional) = select.select([fd], [], [], POLL_INTERVAL)
+            if readable:
+                data = os.read(fd, READ_SIZE)
+                if not data:
+                    break
+                last_activity = time.time()
+                text = data.decode(errors='replace')
+                output.append(text)
+                fraction = parser.feed(text)
+                if fraction is not None and callback is not None:
+                    callback(fraction)
+            elif time.time() - last_activity > stall_timeout:
+                if cancelable:
+                    logging.error(_("%s has not done anything for %d seconds, stopping it"),
+                                  command[0], stall_timeout)
+                    stop(proc)
+                    raise Stalled()
+                logging.warning(_("%s has not done anything for %d seconds, still waiting for it"),
+                                command[0], stall_timeout)
+                last_activity = time.time()
+    finally:
+        proc.stdout.close()
+
+    return (proc.wait(), "".join(output))
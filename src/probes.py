@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  probes.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Runs our slow disk and OS probes in the background while the user is in the first screens """
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import threading
+
+import canonical.misc as misc
+
+# Probe names
+GRAPH = 'graph'
+DEVICES = 'devices'
+OS_DICT = 'os_dict'
+OS_PROBER = 'os_prober'
+LVM = 'lvm'
+SSD = 'ssd'
+
+PROBES = [GRAPH, DEVICES, OS_DICT, OS_PROBER, LVM, SSD]
+
+# Probes run again when a device is added or removed. LVM and SSD just copy what our graph
+# knows. OS_DICT and OS_PROBER mount partitions, they are slow and are not run again
+DEVICE_PROBES = [GRAPH, DEVICES, LVM, SSD]
+
+
+def read_partitions():
+    """ Returns /proc/partitions contents. It changes when a device is added or removed """
+    try:
+        with open("/proc/partitions") as partitions:
+            return partitions.read()
+    except IOError:
+        return ""
+
+
+class ProbeService(object):
+    """ Runs each probe in a worker thread and caches its result.
+        get() returns the cached result (waiting for it if it's not ready yet) """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=len(PROBES))
+        # Probes that mount partitions need privileges. They are raised in this child process,
+        # not in our threads (that would raise them for the whole UI while they run)
+        self.privileged = ProcessPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.partitions = None
+
+    def start(self):
+        """ Start all probes """
+        import os_prober_cache
+        # os-prober results are saved (for the installation process), they may be from other devices
+        os_prober_cache.forget()
+        with self.lock:
+            self.partitions = read_partitions()
+            for name in PROBES:
+                self.futures[name] = self.executor.submit(self.run_probe, name)
+
+    def refresh(self, name=None):
+        """ Run a probe again (all probes if name is None). Call refresh(LVM) after changing
+            volume groups or logical volumes """
+        if name is None:
+            self.start()
+            return
+        if name == OS_PROBER:
+            import os_prober_cache
+            os_prober_cache.forget()
+        with self.lock:
+            self.futures[name] = self.executor.submit(self.run_probe, name)
+
+    def future(self, name):
+        """ Returns the future that will hold probe's result """
+        with self.lock:
+            if name not in self.futures:
+                self.futures[name] = self.executor.submit(self.run_probe, name)
+            return self.futures[name]
+
+    def get(self, name, timeout=None):
+        """ Returns probe's result. Probes are run again if our devices have changed """
+        partitions = read_partitions()
+        if self.partitions != partitions:
+            logging.debug("Devices have changed, probing them again")
+            self.partitions = partitions
+            for probe in DEVICE_PROBES:
+                self.refresh(probe)
+        return self.future(name).result(timeout)
+
+    def get_os_names(self):
+        """ Returns {partition: OS name}. Where bootinfo has found nothing we use os-prober's
+            name (if it has already finished, we do not wait for it) """
+        oses = dict(self.get(OS_DICT))
+        prober = self.future(OS_PROBER)
+        if prober.done() and prober.exception() is None:
+            (oslist, osvers) = prober.result()
+            for device in oslist:
+                # EFI loaders are listed as partition@path
+                partition = device.split('@')[0]
+                if oses.get(partition, _("unknown")) == _("unknown"):
+                    oses[partition] = oslist[device]
+        return oses
+
+    def run_probe(self, name):
+        logging.debug("Running probe '%s'", name)
+        try:
+            if name == GRAPH:
+                import parted3.device_graph as device_graph
+                return device_graph.get_graph()
+            elif name == DEVICES:
+                # Importing parted is slow, do it here and not when Thus starts
+                import parted3.partition_module as pm
+                return pm.get_devices()
+            elif name == OS_DICT:
+                import bootinfo
+                return self.run_privileged(bootinfo.get_os_dict)
+            elif name == OS_PROBER:
+                import os_prober_cache
+                # os-prober mounts the same partitions get_os_dict does
+                self.future(OS_DICT).result()
+                return misc.os_prober(lambda: self.run_privileged(os_prober_cache.probe))
+            elif name == LVM:
+                return self.probe_lvm()
+            elif name == SSD:
+                return self.probe_ssd()
+        except Exception as err:
+            logging.error(_("Error probing '%s': %s"), name, err)
+            raise
+
+    def run_privileged(self, func, *args):
+        """ Runs func(*args) with raised privileges in our child process, returns its result """
+        return self.privileged.submit(misc.run_privileged, func, *args).result()
+
+    def probe_lvm(self):
+        """ Returns a dict with our logical volumes ({volume group: [logical volumes]}) """
+        graph = self.future(GRAPH).result()
+        volumes = {}
+        with graph.lock:
+            for vg in graph.volume_groups:
+                volumes[vg] = list(graph.volume_groups[vg]['lvs'])
+        return volumes
+
+    def probe_ssd(self):
+        """ Returns a dict telling which of our disks are SSDs """
+        graph = self.future(GRAPH).result()
+        ssd = {}
+        for disk_path in self.future(DEVICES).result():
+            dev = graph.get(disk_path)
+            if dev is not None:
+                ssd[disk_path] = dev.is_ssd()
+        return ssd
@@ -237,6 +237,8 @@ class Slides(Gtk.Box):
                     logging.debug("Restarting installation process...")
                     p = self.settings.get('installer_thread_call')
 
+                    from installation import process as installation_process
+
                     self.process = installation_process.InstallationProcess(
                         self.settings,
                         self.callback_queue,
@@ -244,7 +246,8 @@ class Slides(Gtk.Box):
                         p['fs_devices'],
                         p['ssd'],
                         p['alternate_package_list'],
-                        p['blvm'])
+                        p['blvm'],
+                        p.get('deferred_mkfs'))
 
                     self.process.start()
                     return True
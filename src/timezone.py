@@ -30,8 +30,6 @@ import os
 import threading
 import multiprocessing
 import queue
-import urllib.request
-import urllib.error
 import time
 import queue
 import datetime
@@ -39,9 +37,7 @@ import show_message as show
 import config
 import logging
 import canonical.tz as tz
-import dbus
 import subprocess
-from urllib.request import urlopen
 import canonical.misc as misc
 
 _geoname_url = 'http://geoname-lookup.ubuntu.com/?query=%s&release=%s'
@@ -300,6 +296,7 @@ class AutoTimezoneThread(threading.Thread):
         self.stop_event.set()
 
     def get_prop(self, obj, iface, prop):
+        import dbus
         try:
             return obj.Get(iface, prop, dbus_interface=dbus.PROPERTIES_IFACE)
         except dbus.DBusException as e:
@@ -329,6 +326,7 @@ class AutoTimezoneThread(threading.Thread):
 
         # ok, now get our timezone
 
+        import urllib.request
         try:
             url = "http://geo.manjaro.org"
             conn = urllib.request.urlopen(url)
@@ -354,6 +352,7 @@ class GenerateMirrorListThread(threading.Thread):
         self.stop_event.set()
 
     def get_prop(self, obj, iface, prop):
+        import dbus
         try:
             return obj.Get(iface, prop, dbus_interface=dbus.PROPERTIES_IFACE)
         except dbus.DBusException as e:
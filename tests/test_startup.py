@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_startup.py
+#
+#  Copyright 2013 Manjaro (http://manjaro.org)
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+""" Fails when importing thus.py (what happens before our main window appears) takes longer than
+    thus.STARTUP_BUDGET. Run with: python -m unittest discover tests """
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a new interpreter, so nothing has been imported (or cached by us) yet.
+# --profile-imports makes thus.py time each module (see import_timer)
+STARTUP_SCRIPT = """
+import json
+import sys
+import time
+import types
+
+try:
+    import gi
+except ImportError:
+    # No GTK here, its import cost is not measured
+    from unittest import mock
+    gi = types.ModuleType('gi')
+    gi.repository = mock.MagicMock()
+    gi.repository.Gtk.Window = type('Window', (), {})
+    sys.modules['gi'] = gi
+    sys.modules['gi.repository'] = gi.repository
+
+sys.path.insert(0, %r)
+start = time.perf_counter()
+import thus
+elapsed = time.perf_counter() - start
+
+import import_timer
+print(json.dumps({'elapsed': elapsed,
+                  'budget': thus.STARTUP_BUDGET,
+                  'report': import_timer.install().report()}))
+"""
+
+
+class StartupTest(unittest.TestCase):
+    def test_startup_budget(self):
+        """ Importing thus.py in a cold interpreter must take less than STARTUP_BUDGET """
+        output = subprocess.check_output([sys.executable, "-c", STARTUP_SCRIPT % BASE_DIR, "--profile-imports"],
+                                         cwd=BASE_DIR)
+        result = json.loads(output.decode().splitlines()[-1])
+        self.assertLess(result['elapsed'], result['budget'],
+                        "Startup took %.3f seconds, our budget is %.3f seconds. Slowest modules:\n%s" %
+                        (result['elapsed'], result['budget'], "\n".join(result['report'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -48,38 +48,32 @@ locale_code, encoding = locale.getdefaultlocale()
 lang = gettext.translation(APP_NAME, LOCALE_DIR, [locale_code], None, True)
 lang.install()
 
-from gi.repository import Gtk, Gdk, GObject, GLib
 import os
 import sys
-import getopt
-import locale
-import multiprocessing
-import logging
 
 # Insert the src directory at the front of the path
 BASE_DIR = os.path.dirname(__file__) or '.'
 SRC_DIR = os.path.join(BASE_DIR, 'src')
 sys.path.insert(0, SRC_DIR)
 
-import config
+# This must be done before importing anything else (see parse_options)
+import import_timer
+if "-p" in sys.argv or "--profile-imports" in sys.argv:
+    import_timer.install()
+
+from gi.repository import Gtk, Gdk, GObject, GLib
+import getopt
+import importlib
+import locale
+import multiprocessing
+import logging
 
-import language
-import location
-import check
-import keymap
-import timezone
-import user_info
-import slides
+import config
+import probes
 import canonical.misc as misc
 import info
-import updater
 import show_message as show
 
-from installation import ask as installation_ask
-from installation import automatic as installation_automatic
-from installation import alongside as installation_alongside
-from installation import advanced as installation_advanced
-
 # Command line options
 cmd_line = None
 
@@ -87,6 +81,24 @@ cmd_line = None
 MAIN_WINDOW_WIDTH = 800
 MAIN_WINDOW_HEIGHT = 526
 
+# Maximum time (in seconds) our main window should take to appear (see --profile-imports
+# and tests/test_startup.py)
+STARTUP_BUDGET = 3.0
+
+# Page modules are only imported when its page is built (see Main.get_page)
+PAGES = {
+    "language": ("language", "Language"),
+    "location": ("location", "Location"),
+    "check": ("check", "Check"),
+    "keymap": ("keymap", "Keymap"),
+    "timezone": ("timezone", "Timezone"),
+    "installation_ask": ("installation.ask", "InstallationAsk"),
+    "installation_automatic": ("installation.automatic", "InstallationAutomatic"),
+    "installation_alongside": ("installation.alongside", "InstallationAlongside"),
+    "installation_advanced": ("installation.advanced", "InstallationAdvanced"),
+    "user_info": ("user_info", "UserInfo"),
+    "slides": ("slides", "Slides")}
+
 # At least this GTK version is needed
 _gtk_version_needed = "3.9.6"
 
@@ -200,8 +212,14 @@ class Main(Gtk.Window):
         # to the main thread (installer_*.py)
         self.callback_queue = multiprocessing.JoinableQueue()
 
-        # Load all pages
+        # Start probing our disks now, so their info is ready when the
+        # user reaches the installation screens
+        self.probes = probes.ProbeService()
+        self.probes.start()
+
+        # Register all pages
         # (each one is a screen, a step in the install process)
+        # Pages are not built here but the first time they're needed (see get_page)
 
         self.pages = dict()
 
@@ -215,18 +233,9 @@ class Main(Gtk.Window):
         params['main_progressbar'] = self.ui.get_object('progressbar1')
         params['alternate_package_list'] = ""
         params['testing'] = cmd_line.testing
+        params['probes'] = self.probes
 
-        self.pages["language"] = language.Language(params)
-        self.pages["location"] = location.Location(params)
-        self.pages["check"] = check.Check(params)
-        self.pages["keymap"] = keymap.Keymap(params)
-        self.pages["timezone"] = timezone.Timezone(params)
-        self.pages["installation_ask"] = installation_ask.InstallationAsk(params)
-        self.pages["installation_automatic"] = installation_automatic.InstallationAutomatic(params)
-        self.pages["installation_alongside"] = installation_alongside.InstallationAlongside(params)
-        self.pages["installation_advanced"] = installation_advanced.InstallationAdvanced(params)
-        self.pages["user_info"] = user_info.UserInfo(params)
-        self.pages["slides"] = slides.Slides(params)
+        self.params = params
 
         self.connect("delete-event", Gtk.main_quit)
         self.ui.connect_signals(self)
@@ -242,7 +251,7 @@ class Main(Gtk.Window):
         self.set_icon_from_file(icon_dir)
 
         # Set the first page to show
-        self.current_page = self.pages["language"]
+        self.current_page = self.get_page("language")
 
         self.main_box.add(self.current_page)
 
@@ -266,6 +275,7 @@ class Main(Gtk.Window):
         self.show_all()
 
         self.current_page.prepare('forwards')
+        self.schedule_warm_up()
 
         # Hide backwards button
         self.backwards_button.hide()
@@ -277,12 +287,44 @@ class Main(Gtk.Window):
         # Hide progress bar as it's value is zero
         self.progressbar.set_fraction(0)
         self.progressbar.hide()
-        self.progressbar_step = 1.0 / (len(self.pages) - 2)
+        self.progressbar_step = 1.0 / (len(PAGES) - 2)
 
         with open(tmp_running, "w") as tmp_file:
             tmp_file.write("Thus %d\n" % 1234)
 
-        GLib.timeout_add(1000, self.pages["slides"].manage_events_from_cb_queue)
+        GLib.timeout_add(1000, self.manage_events_from_cb_queue)
+
+        import_timer.log_report(STARTUP_BUDGET)
+
+    def get_page(self, name):
+        """ Returns page 'name', building it the first time it's asked for """
+        if name not in self.pages:
+            logging.debug("Building page %s", name)
+            module_name, class_name = PAGES[name]
+            module = importlib.import_module(module_name)
+            self.pages[name] = getattr(module, class_name)(self.params)
+        return self.pages[name]
+
+    def schedule_warm_up(self):
+        """ If asked to, build our next page when GTK has nothing better to do """
+        if cmd_line.warm_up:
+            GLib.idle_add(self.warm_up_next_page, priority=GLib.PRIORITY_LOW)
+
+    def warm_up_next_page(self):
+        """ Builds the page that comes after the current one (if it's not built yet) """
+        if self.current_page is not None:
+            next_page = self.current_page.get_next_page()
+            if next_page in PAGES and next_page not in self.pages:
+                self.get_page(next_page)
+        # Run only once
+        return False
+
+    def manage_events_from_cb_queue(self):
+        """ Installer events are managed by the slides page.
+            Build it as soon as there's something in the queue """
+        if "slides" not in self.pages and self.callback_queue.empty():
+            return True
+        return self.get_page("slides").manage_events_from_cb_queue()
 
     def on_exit_button_clicked(self, widget, data=None):
         """ Quit Thus """
@@ -313,11 +355,12 @@ class Main(Gtk.Window):
                 self.set_progressbar_step(self.progressbar_step)
                 self.main_box.remove(self.current_page)
 
-                self.current_page = self.pages[next_page]
+                self.current_page = self.get_page(next_page)
 
                 if self.current_page is not None:
                     self.current_page.prepare('forwards')
                     self.main_box.add(self.current_page)
+                    self.schedule_warm_up()
 
                     if self.current_page.get_prev_page() is not None:
                         # There is a previous page, show button
@@ -337,7 +380,7 @@ class Main(Gtk.Window):
             # self.current_page.store_values()
 
             self.main_box.remove(self.current_page)
-            self.current_page = self.pages[prev_page]
+            self.current_page = self.get_page(prev_page)
 
             if self.current_page is not None:
                 self.current_page.prepare('backwards')
@@ -409,9 +452,11 @@ def parse_options():
     import argparse
     parser = argparse.ArgumentParser(description="Thus v%s - Manjaro Installer" % info.THUS_VERSION)
     parser.add_argument("-d", "--debug", help=_("Sets Thus log level to 'debug'"), action="store_true")
+    parser.add_argument("-p", "--profile-imports", help=_("Log how long each module takes to load"), action="store_true")
     parser.add_argument("-u", "--update", help=_("Update Thus to the latest version (-uu will force the update)"), action="count")
     parser.add_argument("-t", "--testing", help=_("Do not perform any changes (useful for developers)"), action="store_true")
     parser.add_argument("-v", "--verbose", help=_("Show logging messages to stdout"), action="store_true")
+    parser.add_argument("-w", "--warm-up", help=_("Prepare the next screen while the current one is idle"), action="store_true")
     parser.add_argument("-z", "--z_hidden", help=_("Show options in development (DO NOT USE THIS!)"), action="store_true")
 
     return parser.parse_args()
@@ -435,6 +480,7 @@ def init_thus():
         force = False
         if cmd_line.update == 2:
             force = True
+        import updater
         upd = updater.Updater(force)
         if upd.update():
             # Remove /tmp/.setup-running to be able to run another